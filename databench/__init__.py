@@ -4,8 +4,9 @@
 from __future__ import absolute_import
 
 __version__ = '0.7.3'
-__all__ = ['Analysis', 'AnalysisZMQ', 'App', 'Datastore', 'Meta', 'MetaZMQ',
-           'on', 'on_action', 'Readme', 'run', 'testing', 'utils']
+__all__ = ['ActionExecutor', 'Analysis', 'AnalysisZMQ', 'App', 'Datastore',
+           'Meta', 'MetaZMQ', 'on', 'on_action', 'Readme', 'run', 'testing',
+           'utils']
 
 from .analysis import Analysis, on, on_action
 from .analysis_zmq import AnalysisZMQ
@@ -13,6 +14,7 @@ from .app import App
 from .cli import run
 from .datastore import Datastore
 from .datastore_legacy import DatastoreLegacy
+from .executor import ActionExecutor
 from .meta import Meta
 from .meta_zmq import MetaZMQ
 from .readme import Readme
@@ -17,7 +17,7 @@ class Dummypi(databench.Analysis):
         """Run when button is pressed."""
 
         inside = 0
-        for draws in range(1, self.data['samples']):
+        for draws in range(1, self.data.view('samples')):
             # generate points and check whether they are inside the unit circle
             r1 = random.random()
             r2 = random.random()
@@ -22,7 +22,7 @@ class Dummypi_Py(databench.Analysis):
         """Run when button is pressed."""
 
         inside = 0
-        for draws in range(1, self.data['samples']):
+        for draws in range(1, self.data.view('samples')):
             # generate points and check whether they are inside the unit circle
             r1, r2 = (random(), random())
             if r1 ** 2 + r2 ** 2 < 1.0:
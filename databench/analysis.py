@@ -3,12 +3,18 @@
 from __future__ import absolute_import, unicode_literals, division
 
 from . import utils
-from .datastore import Datastore
+from .datastore import Datastore, RawJSONPatch, StateUpdate
+from .executor import ActionExecutor, check_kind, in_worker, ioloop_call
+import contextlib
+import functools
 import inspect
 import logging
+import numbers
 import random
 import string
+import tornado.concurrent
 import tornado.gen
+import tornado.ioloop
 import wrapt
 
 log = logging.getLogger(__name__)
@@ -41,40 +47,84 @@ class ActionHandler(object):
         return inspect.getsource(self.f)
 
 
-def on(f):
+def _action_handler(executor):
+    """Decorator that makes an action handler a coroutine.
+
+    With an executor, the handler runs on the pool of that kind.
+    """
+    if executor is not None:
+        check_kind(executor)
+
+    @wrapt.decorator
+    @tornado.gen.coroutine
+    def _execute(wrapped, instance, args, kwargs):
+        if executor is not None and instance is not None:
+            return _in_executor(instance, executor, wrapped, args, kwargs)
+        return wrapped(*args, **kwargs)
+
+    return _execute
+
+
+def _in_executor(instance, executor, wrapped, args, kwargs):
+    result = yield instance.run_in_executor(executor, wrapped, args, kwargs)
+    raise tornado.gen.Return(result)
+
+
+def on(f=None, executor=None):
     """Decorator for action handlers.
 
     The action name is inferred from the function name.
 
     This also decorates the method with `tornado.gen.coroutine` so that
     `~tornado.concurrent.Future` can be yielded.
+
+    :param str executor: run the handler on a ``thread`` or ``process``
+        pool, see :class:`databench.executor.ActionExecutor`
+
+    .. code-block:: python
+
+        @databench.on(executor='thread')
+        def run(self):
+            ...
     """
+    if f is None:
+        return functools.partial(on, executor=executor)
+
     action = f.__name__
     f.action = action
 
-    @wrapt.decorator
-    @tornado.gen.coroutine
-    def _execute(wrapped, instance, args, kwargs):
-        return wrapped(*args, **kwargs)
-
-    return _execute(f)
+    return _action_handler(executor)(f)
 
 
-def on_action(action):
+def on_action(action, executor=None):
     """Decorator for action handlers.
 
     :param str action: explicit action name
+    :param str executor: run the handler on a ``thread`` or ``process``
+        pool, see :class:`databench.executor.ActionExecutor`
 
     This also decorates the method with `tornado.gen.coroutine` so that
     `~tornado.concurrent.Future` can be yielded.
     """
-    @wrapt.decorator
-    @tornado.gen.coroutine
-    def _execute(wrapped, instance, args, kwargs):
-        return wrapped(*args, **kwargs)
+    def decorator(f):
+        f.action = action
+        return _action_handler(executor)(f)
+
+    return decorator
 
-    _execute.action = action
-    return _execute
+
+def valid_revisions(revisions):
+    """Whether revisions from a frontend can be used for a resync.
+
+    :param revisions: revisions for ``data`` and ``class_data``
+    :rtype: bool
+    """
+    if not isinstance(revisions, dict):
+        return False
+    return all(revision is None or
+               (isinstance(revision, numbers.Integral) and
+                not isinstance(revision, bool))
+               for revision in revisions.values())
 
 
 class Analysis(object):
@@ -134,16 +184,47 @@ class Analysis(object):
 
     **Communicating with the frontend**: The default is to change state with
     :meth:`.set_state` or :meth:`.set_class_state` and let that
-    change propagate to all frontends. Directly calling :meth:`.emit` is also
-    possible.
+    change propagate to all frontends. All state changes within one IOLoop
+    iteration are merged into a single message (see :meth:`.emit_state`).
+    Multi-step updates can be grouped in a :meth:`.transaction`.
+    Directly calling :meth:`.emit` is also possible.
+
+    **Large state values**: Set the class attribute ``json_patch = True``
+    to send changes to state values as JSON patches to the frontend. This
+    reduces the traffic for small changes to large dictionaries and lists.
+    Full values are sent until the frontend received the state with
+    :meth:`.emit_snapshot` or :meth:`.resync`, so that every patch has a
+    value in the frontend to apply to.
+
+    **CPU-bound actions**: Action handlers decorated with
+    ``@databench.on(executor='thread')`` or ``executor='process'`` run on a
+    pool of threads or processes and do not block the IOLoop for other
+    connections. :meth:`.emit`, :meth:`.set_state` and
+    :meth:`.set_class_state` can be used as usual. See
+    :class:`databench.executor.ActionExecutor` for the restrictions.
+
+    **Numpy arrays**: Set the class attribute ``binary_arrays = True`` to
+    send numpy arrays in state values and emitted messages as binary
+    data instead of JSON lists. The frontend receives them as
+    TypedArrays with a ``shape`` attribute. ``bytes`` are sent as
+    ``uint8`` arrays. Language kernels send emitted arrays to the main
+    process without copying them and send all messages of an IOLoop
+    iteration together, so do not modify an array in place in the same
+    iteration in which it was emitted.
 
     :ivar Datastore data: data scoped for this instance/connection
     :ivar Datastore class_data: data scoped across all instances
     :ivar list cli_args: command line arguments
     :ivar dict request_args: request arguments
+    :cvar bool json_patch: send state changes as JSON patches
+    :cvar bool binary_arrays: send numpy arrays as binary data
+    :cvar dict executors: action pools by kind, set by :class:`.Meta`
     """
 
     _databench_analysis = True
+    json_patch = False
+    binary_arrays = False
+    executors = None
 
     def __init__(self):
         self.data = None
@@ -159,6 +240,10 @@ class Analysis(object):
         )
         self.log_frontend = logging.getLogger(__name__ + '.frontend')
         self.log_backend = logging.getLogger(__name__ + '.backend')
+        self._state_buffer = {}
+        self._state_revisions = {}
+        self._state_flushed = None
+        self._state_synced = False  # the frontend has a base for patches
 
         self.init_datastores()
         return self
@@ -172,10 +257,106 @@ class Analysis(object):
 
         Overwrite this method to use other datastore backends.
         """
-        self.data = Datastore(self.id_)
-        self.data.subscribe(lambda data: self.emit('data', data))
-        self.class_data = Datastore(type(self).__name__)
-        self.class_data.subscribe(lambda data: self.emit('class_data', data))
+        self.data = Datastore(self.id_, json_patch=self.json_patch,
+                              binary=self.binary_arrays)
+        self.data.subscribe(lambda data: self.emit_state('data', data),
+                            raw=True)
+        self.class_data = Datastore(type(self).__name__,
+                                    json_patch=self.json_patch,
+                                    binary=self.binary_arrays,
+                                    evictable=False)
+        self.class_data.subscribe(
+            lambda data: self.emit_state('class_data', data), raw=True)
+
+    def close_datastores(self):
+        """Close the datastores of this analysis instance.
+
+        The stored data is kept and the datastore domains become idle (see
+        :class:`.Datastore` for eviction of idle domains).
+        """
+        for datastore in (self.data, self.class_data):
+            if datastore is not None:
+                datastore.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Buffer changes to ``data`` and ``class_data`` and commit them
+        together.
+
+        .. code-block:: python
+
+            @databench.on
+            def run(self):
+                with self.transaction():
+                    self.set_state(status='running', progress=0.0)
+                    self.set_class_state(
+                        runs=self.class_data.get('runs', 0) + 1)
+
+        See :meth:`.Datastore.transaction`.
+        """
+        with self.data.transaction(), self.class_data.transaction():
+            yield self
+
+    def emit_snapshot(self, force=False):
+        """Emit the complete state in one ``__snapshot`` message.
+
+        The message contains the state of ``data`` and ``class_data`` and
+        their revisions. Nothing is emitted when both are empty.
+
+        :param bool force: also emit an empty snapshot
+        :rtype: tornado.concurrent.Future
+        """
+        self._state_synced = True
+        load, revisions = {}, {}
+        for signal, datastore in (('data', self.data),
+                                  ('class_data', self.class_data)):
+            if datastore is None:
+                continue
+            snapshot = datastore.snapshot()
+            load[signal] = snapshot
+            revisions[signal] = snapshot.revision
+        if not force and not any(load.values()):
+            return None
+        return self.emit('__snapshot', StateUpdate(load, revisions))
+
+    def resync(self, revisions):
+        """Emit the state that changed after the given revisions.
+
+        This is used when a frontend reconnects to an existing analysis
+        instance and only needs the changes it missed. A snapshot replaces
+        the state of the frontend instead when the revisions are invalid or
+        when the journal of a datastore does not go back far enough, for
+        example after its domain was evicted.
+
+        :param dict revisions: last revision seen by the frontend for
+            ``data`` and ``class_data``
+        :rtype: tornado.concurrent.Future
+        """
+        if not valid_revisions(revisions):
+            return self.emit_snapshot(force=True)
+        self._state_synced = True
+
+        keys = []
+        for signal, datastore in (('data', self.data),
+                                  ('class_data', self.class_data)):
+            if datastore is None:
+                continue
+            revision = revisions.get(signal)
+            if revision is None:
+                if len(datastore.data):
+                    return self.emit_snapshot(force=True)
+                continue
+            if not datastore.journal_covers(revision):
+                return self.emit_snapshot(force=True)
+            keys.append((datastore, datastore.changes_since(revision)))
+
+        results = [r
+                   for datastore, changed in keys
+                   for key in changed
+                   for r in datastore.trigger_callbacks(
+                       key, callbacks=datastore.subscriptions)]
+        return tornado.gen.multi([r for r in results
+                                  if tornado.concurrent.is_future(r)])
 
     @staticmethod
     def __create_id():
@@ -186,6 +367,21 @@ class Analysis(object):
         self.emit_to_frontend = emit_fn
         return self
 
+    def run_in_executor(self, executor, fn, args=(), kwargs=None):
+        """Run an action handler on a pool of threads or processes.
+
+        :param str executor: ``thread`` or ``process``
+        :param fn: undecorated action handler bound to this instance
+        :param list args: positional arguments
+        :param dict kwargs: keyword arguments
+        :rtype: tornado.concurrent.Future
+        """
+        if self.executors is not None and executor in self.executors:
+            action_executor = self.executors[executor]
+        else:
+            action_executor = ActionExecutor.default(executor)
+        return action_executor.run(self, fn, args, kwargs)
+
     def emit(self, signal, message='__nomessagetoken__'):
         """Emit a signal to the frontend.
 
@@ -194,6 +390,9 @@ class Analysis(object):
         :returns: return value from frontend emit function
         :rtype: tornado.concurrent.Future
         """
+        if in_worker():
+            return ioloop_call(self.emit, signal, message)
+
         # call pre-emit hooks
         if signal == 'log':
             self.log_backend.info(message)
@@ -202,8 +401,77 @@ class Analysis(object):
         elif signal == 'error':
             self.log_backend.error(message)
 
+        # keep the order of messages
+        self.flush_state()
+
         return self.emit_to_frontend(signal, message)
 
+    def emit_state(self, signal, key_value):
+        """Emit a state change merged with other state changes.
+
+        State changes are buffered and sent as one message per signal at the
+        end of the current IOLoop iteration or before the next :meth:`emit`,
+        whichever comes first. Later values for the same key replace
+        earlier ones. A JSON patch for a key that is already buffered is
+        replaced by the full value, as is every patch before the state was
+        sent with :meth:`emit_snapshot` or :meth:`resync`. The emitted
+        message is a
+        :class:`.StateUpdate` with the latest revision of the merged changes.
+
+        :param str signal: name of the signal, e.g. ``data``
+        :param dict key_value: changed keys and their values
+        :returns: resolves when the merged message was emitted
+        :rtype: tornado.concurrent.Future
+        """
+        buffer = self._state_buffer.setdefault(signal, {})
+        for key, value in key_value.items():
+            if isinstance(value, RawJSONPatch) and \
+               (key in buffer or not self._state_synced):
+                value = value.value
+            buffer[key] = value
+        revision = getattr(key_value, 'revision', None)
+        if revision is not None:
+            self._state_revisions[signal] = max(
+                revision, self._state_revisions.get(signal, revision))
+        if self._state_flushed is not None:
+            return self._state_flushed
+
+        ioloop = tornado.ioloop.IOLoop.current(instance=False)
+        if ioloop is None:
+            # no IOLoop to merge messages on
+            return self.flush_state()
+
+        self._state_flushed = tornado.concurrent.Future()
+        ioloop.add_callback(self.flush_state)
+        return self._state_flushed
+
+    def flush_state(self):
+        """Emit buffered state changes now."""
+        if not self._state_buffer:
+            return
+
+        buffer, flushed = self._state_buffer, self._state_flushed
+        revisions = self._state_revisions
+        self._state_buffer, self._state_flushed = {}, None
+        self._state_revisions = {}
+        try:
+            results = [
+                self.emit_to_frontend(
+                    signal, StateUpdate(message, revisions.get(signal)))
+                for signal, message in buffer.items()
+            ]
+        except Exception as e:
+            if flushed is not None:
+                flushed.set_exception(e)
+            raise
+
+        if flushed is not None:
+            tornado.concurrent.chain_future(
+                tornado.gen.multi([r for r in results
+                                   if tornado.concurrent.is_future(r)]),
+                flushed,
+            )
+
     """Events."""
 
     @on
@@ -246,9 +514,9 @@ class Analysis(object):
     @on
     def set_state(self, updater=None, **kwargs):
         """Set state in Datastore."""
-        yield self.data.set_state(updater, **kwargs)
+        yield ioloop_call(self.data.set_state, updater, **kwargs)
 
     @on
     def set_class_state(self, updater=None, **kwargs):
         """Set state in class Datastore."""
-        yield self.class_data.set_state(updater, **kwargs)
+        yield ioloop_call(self.class_data.set_state, updater, **kwargs)
@@ -1,96 +1,103 @@
-import json
 import logging
-import subprocess
 import tornado.gen
-import zmq
-import zmq.eventloop.zmqstream
 
 from .analysis import Analysis
+from . import utils
 
 log = logging.getLogger(__name__)
 
 
 class AnalysisZMQ(Analysis):
+    # arrays arrive as binary buffers only if the kernel analysis opted in
+    binary_arrays = True
+
     def __init__(self):
         pass
 
     def init_databench(self, id_):
         super(AnalysisZMQ, self).init_databench(id_)
-        self.zmq_handshake = False
+        self.kernel = None
+        self.zmq_init_messages = []
+        self.zmq_sync = {}
         return self
 
-    def on_connect(self, executable, zmq_publish):
-        self.zmq_publish = zmq_publish
-
-        # determine a port_subscribe
-        context = zmq.Context()
-        socket = context.socket(zmq.PUB)
-        port_subscribe = socket.bind_to_random_port(
-            'tcp://127.0.0.1',
-            min_port=3000, max_port=9000,
-        )
-        socket.close()
-        context.destroy()
-        log.debug('determined: port_subscribe={}'.format(port_subscribe))
-
-        # zmq subscription to listen for messages from backend
-        log.debug('main listening on port: {}'.format(port_subscribe))
-        self.zmq_sub_ctx = zmq.Context()
-        self.zmq_sub = self.zmq_sub_ctx.socket(zmq.SUB)
-        self.zmq_sub.setsockopt(zmq.SUBSCRIBE, b'')
-        self.zmq_sub.bind('tcp://127.0.0.1:{}'.format(port_subscribe))
-
-        self.zmq_stream_sub = zmq.eventloop.zmqstream.ZMQStream(
-            self.zmq_sub,
-            tornado.ioloop.IOLoop.current(),
-        )
-        self.zmq_stream_sub.on_recv(self.zmq_listener)
-
-        # launch the language kernel process
-        e_params = executable + [
-            '--analysis-id={}'.format(self.id_),
-            '--zmq-publish={}'.format(port_subscribe),
-        ]
-        log.debug('launching: {}'.format(e_params))
-        self.kernel_process = subprocess.Popen(e_params, shell=False)
+    @property
+    def zmq_handshake(self):
+        return self.kernel is not None and self.kernel.handshake
+
+    def on_connect(self, kernel):
+        """Connect to a kernel.
+
+        :param KernelZMQ kernel: a started kernel
+        """
+        self.kernel = kernel
+        self.kernel.assign(self)
         log.debug('finished on_connect for {}'.format(self.id_))
 
+    @tornado.gen.coroutine
     def on_disconnected(self):
-        # In autoreload, this callback needs to be processed synchronously.
-        log.debug('terminating kernel process {}'.format(self.id_))
-        if self.kernel_process is not None:
-            try:
-                self.kernel_process.terminate()
-            except subprocess.OSError:
-                pass
-        self.zmq_stream_sub.close()
-        self.zmq_sub.close()
-        self.zmq_sub_ctx.destroy()
-        self.zmq_handshake = False
+        # In autoreload, the release needs to start synchronously.
+        if self.kernel is not None:
+            yield self.kernel.release(self.id_)
+
+    def emit_snapshot(self, force=False):
+        """Request a snapshot from the kernel.
+
+        The state is held by the datastores in the kernel. The request is
+        sent with the ``connect`` action and the kernel emits the snapshot
+        before it runs the action.
+
+        :param bool force: request the snapshot from a connected kernel
+            right away, also when the state is empty
+        """
+        self.zmq_sync = {}
+        if force and self.kernel is not None and \
+           not self.kernel.router.legacy:
+            self.kernel.send({'analysis_id': self.id_, 'signal': '__sync',
+                              'load': None, '__sync': {'force': True}})
+
+    def resync(self, revisions):
+        """Request the changes after the given revisions from the kernel.
+
+        See :meth:`emit_snapshot`.
+        """
+        self.zmq_sync = {'revisions': revisions}
+
+    def on_kernel_restart(self):
+        """Replay the initialization in a restarted kernel.
+
+        The state of the analysis instance in the old kernel process is
+        lost.
+        """
+        log.info('replaying initialization of {}'.format(self.id_))
+        for data in self.zmq_init_messages:
+            self.kernel.send(data)
 
     def zmq_send(self, data):
-        self.zmq_publish.send('{}|{}'.format(
-            self.id_,
-            json.dumps(data),
-        ).encode('utf-8'))
-
-    def zmq_listener(self, multipart):
-        # log.debug('main received multipart: {}'.format(multipart))
-        msg = json.loads((b''.join(multipart)).decode('utf-8'))
-
-        # zmq handshake
-        if '__zmq_handshake' in msg:
-            self.zmq_handshake = True
-            self.zmq_send({'__zmq_ack': None})
+        data = dict(data, analysis_id=self.id_)
+        if data.get('signal') == 'connect':
+            data['__sync'] = self.zmq_sync
+        if data.get('signal') in ('connect', 'args', 'connected'):
+            self.zmq_init_messages.append(data)
+        self.kernel.send(data)
+
+    def zmq_listener(self, header, frames):
+        """Forward a message from the kernel to the frontend.
+
+        The routing header is decoded. The frames that follow are the
+        message encoded for the frontend by the kernel, with binary buffers
+        in frames of their own. They are joined and forwarded verbatim.
+        """
+        if 'signal' not in header or not frames:
             return
-
-        # check message is for this analysis
-        if 'analysis_id' not in msg or \
-           msg['analysis_id'] != self.id_:
+        frame = utils.EncodedFrame(b''.join(frames),
+                                   header.get('binary', False))
+
+        # messages for the backend log are decoded
+        if header['signal'] in ('log', 'warn', 'error'):
+            message = frame.decode()
+            self.emit(message['signal'],
+                      message.get('load', '__nomessagetoken__'))
             return
 
-        # execute callback
-        if 'frame' in msg and \
-           'signal' in msg['frame'] and \
-           'load' in msg['frame']:
-            self.emit(msg['frame']['signal'], msg['frame']['load'])
+        self.emit(header['signal'], frame)
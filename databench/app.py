@@ -3,6 +3,8 @@
 from __future__ import absolute_import, unicode_literals, division
 
 from . import __version__ as DATABENCH_VERSION
+from .executor import ActionExecutor, PROCESS_POOLS
+from .kernel_zmq import KernelPubSub, KernelRouter
 from .meta import Meta
 from .meta_zmq import MetaZMQ
 from .readme import Readme
@@ -33,15 +35,73 @@ class App(object):
     """Databench app. Creates a Tornado app.
 
     :param str analyses_path: An import path of the analyses.
-    :param int zmq_port: Force to use the given ZMQ port for publishing.
+    :param int zmq_port: Force to use the given ZMQ port for kernels.
+    :param str zmq_transport:
+        ``tcp`` (default) or ``ipc`` for Unix domain sockets to kernels.
     :param list cli_args: Command line arguments.
     :param bool debug: Switch on debugging.
+    :param int kernel_pool:
+        Number of pre-started Python kernels per analysis. Can be
+        overwritten per analysis with ``kernel_pool`` in ``index.yaml``.
+    :param int kernel_processes:
+        Number of multiplexed Python kernel processes per analysis that host
+        all its analysis instances. Can be overwritten per analysis with
+        ``kernel_processes`` in ``index.yaml``.
+    :param float kernel_max_memory:
+        Maximum address space of a Python kernel process in MB.
+    :param float kernel_max_cpu:
+        Maximum CPU time of a Python kernel process in seconds.
+    :param float kernel_idle_timeout:
+        Terminate Python kernels that are idle for this many seconds. They
+        are restarted when the frontend sends the next message.
+
+    :param int thread_pool_size:
+        Number of threads for action handlers with ``executor='thread'``.
+    :param int process_pool_size:
+        Number of processes for action handlers with ``executor='process'``.
+
+    The kernel supervision options can be overwritten per analysis in
+    ``index.yaml`` as well.
+
+    Kernels of compiled languages are built before they are started, see
+    :attr:`kernel_builds`. Set ``kernel_build`` for an analysis in
+    ``index.yaml`` to use another build command for its kernel.
+
+    Python kernels connect to the ROUTER socket of :class:`.KernelRouter`.
+    Kernels of other languages use the legacy PUB/SUB transport of
+    :class:`.KernelPubSub` by default, see :attr:`kernel_transports`. Set
+    ``kernel_transport: router`` for an analysis in ``index.yaml`` once its
+    kernel supports the ROUTER socket.
     """
 
+    #: build commands by kernel type that run in the analysis directory
+    kernel_builds = {
+        'go': ['go', 'install'],
+    }
+
+    #: transports by kernel type for kernels other than Python kernels
+    kernel_transports = {
+        'go': 'pubsub',
+    }
+
     def __init__(self, analyses_path=None, zmq_port=None, cli_args=None,
-                 debug=False):
+                 debug=False, kernel_pool=0, kernel_processes=0,
+                 zmq_transport='tcp', kernel_max_memory=None,
+                 kernel_max_cpu=None, kernel_idle_timeout=None,
+                 thread_pool_size=None, process_pool_size=None):
         self.cli_args = cli_args
         self.debug = debug
+        self.kernel_pool = kernel_pool
+        self.kernel_processes = kernel_processes
+        self.kernel_max_memory = kernel_max_memory
+        self.kernel_max_cpu = kernel_max_cpu
+        self.kernel_idle_timeout = kernel_idle_timeout
+        self.executors = {
+            'thread': ActionExecutor('thread', thread_pool_size),
+        }
+        if PROCESS_POOLS:
+            self.executors['process'] = ActionExecutor('process',
+                                                       process_pool_size)
 
         self.info = {
             'title': 'Databench',
@@ -60,35 +120,37 @@ class App(object):
              {'info': self.info, 'metas': self.metas}),
         ]
 
-        self.init_zmq(zmq_port)
+        self.init_zmq(zmq_port, zmq_transport)
         self.analyses_info()
         self.meta_analyses()
         self.register_metas()
         self.routes += self.static_routes(self.analyses_path,
                                           self.info['static'])
 
-    def init_zmq(self, zmq_port=None):
-        # check whether we have to determine zmq_port ourselves first
-        if zmq_port is None:
-            context = zmq.Context()
-            socket = context.socket(zmq.PUB)
-            zmq_port = socket.bind_to_random_port(
-                'tcp://127.0.0.1', min_port=6000,
-            )
-            socket.close()
-            context.destroy()
-            log.debug('determined: zmq_port={}'.format(zmq_port))
-        self.zmq_port = zmq_port
-
-        self.zmq_pub_ctx = zmq.Context()
-        self.zmq_pub = self.zmq_pub_ctx.socket(zmq.PUB)
-        self.zmq_pub.bind('tcp://127.0.0.1:{}'.format(zmq_port))
-        log.debug('main publishing to port {}'.format(zmq_port))
-
-        self.zmq_pub_stream = zmq.eventloop.zmqstream.ZMQStream(
-            self.zmq_pub,
-            tornado.ioloop.IOLoop.current(),
+    def init_zmq(self, zmq_port=None, zmq_transport='tcp'):
+        self.kernel_router = KernelRouter(zmq_port, zmq_transport)
+        self.zmq_port = self.kernel_router.port
+        self.zmq_endpoint = self.kernel_router.endpoint
+        self.kernel_pubsub = None
+
+    def kernel_transport(self, analysis_info):
+        """Transport for the kernel of an analysis in another language.
+
+        The PUB/SUB transport is created for the first legacy kernel.
+
+        :returns: :class:`.KernelRouter` or :class:`.KernelPubSub`
+        """
+        transport = analysis_info.get(
+            'kernel_transport',
+            self.kernel_transports.get(analysis_info.get('kernel'), 'router'),
         )
+        if transport == 'router':
+            return self.kernel_router
+        elif transport == 'pubsub':
+            if self.kernel_pubsub is None:
+                self.kernel_pubsub = KernelPubSub()
+            return self.kernel_pubsub
+        raise ValueError('unknown kernel transport {}'.format(transport))
 
     @staticmethod
     def first_valid_directory(paths, default=None):
@@ -215,11 +277,16 @@ class App(object):
             if analysis_kernel is None:
                 meta = self.meta_analysis_nokernel(name, path)
             elif analysis_kernel == 'py':
-                meta = self.meta_analysis_py(name, path)
+                meta = self.meta_analysis_py(
+                    name, path, **self.kernel_options(analysis_info))
             elif analysis_kernel == 'pyspark':
-                meta = self.meta_analysis_pyspark(name, path)
+                meta = self.meta_analysis_pyspark(
+                    name, path, **self.kernel_options(analysis_info))
             elif analysis_kernel == 'go':
-                meta = self.meta_analysis_go(name, path)
+                meta = self.meta_analysis_go(
+                    name, path,
+                    kernel_build=self.kernel_build(analysis_info),
+                    router=self.kernel_transport(analysis_info))
 
             if meta is None:
                 continue
@@ -228,6 +295,24 @@ class App(object):
             meta.info.update(analysis_info)
             self.metas.append(meta)
 
+    def kernel_options(self, analysis_info):
+        """Kernel process options for Python kernels."""
+        options = {
+            option: analysis_info.get(option, getattr(self, option))
+            for option in ('kernel_pool', 'kernel_processes',
+                           'kernel_max_memory', 'kernel_max_cpu',
+                           'kernel_idle_timeout')
+        }
+        options['kernel_build'] = self.kernel_build(analysis_info)
+        return options
+
+    def kernel_build(self, analysis_info):
+        """Build command for the kernel of an analysis or None."""
+        return analysis_info.get(
+            'kernel_build',
+            self.kernel_builds.get(analysis_info.get('kernel')),
+        )
+
     def meta_analysis_nokernel(self, name, path):
         try:
             analysis_file = importlib.import_module('.' + name + '.analysis',
@@ -251,40 +336,55 @@ class App(object):
             path,
             self.extra_routes(name, path),
             self.cli_args,
+            executors=self.executors,
         )
 
-    def meta_analysis_py(self, name, path):
+    def executor_stats(self):
+        """Queue depth and utilization of the action pools.
+
+        :rtype: dict
+        """
+        return {kind: executor.stats()
+                for kind, executor in self.executors.items()}
+
+    def meta_analysis_py(self, name, path, **kernel_options):
         log.debug('creating MetaZMQ for {}'.format(name))
         return MetaZMQ(
             name,
             ['python', os.path.join(path, 'analysis.py'),
-             '--zmq-subscribe={}'.format(self.zmq_port)],
-            self.zmq_pub_stream,
+             '--zmq-router={}'.format(self.zmq_endpoint)],
+            self.kernel_router,
             path,
             self.extra_routes(name, path),
+            **kernel_options
         )
 
-    def meta_analysis_pyspark(self, name, path):
+    def meta_analysis_pyspark(self, name, path, **kernel_options):
         log.debug('creating MetaZMQ for {}'.format(name))
         return MetaZMQ(
             name,
-            ['pyspark', '{}/analysis.py'.format(path),
-             '--zmq-subscribe={}'.format(self.zmq_port)],
-            self.zmq_pub_stream,
+            ['spark-submit', os.path.join(path, 'analysis.py'),
+             '--zmq-router={}'.format(self.zmq_endpoint)],
+            self.kernel_router,
             path,
             self.extra_routes(name, path),
+            **kernel_options
         )
 
-    def meta_analysis_go(self, name, path):
-        log.info('installing {}'.format(name))
-        os.system('cd {}; go install'.format(path))
+    def meta_analysis_go(self, name, path, kernel_build=None, router=None):
         log.debug('creating MetaZMQ for {}'.format(name))
+        if router is None:
+            router = self.kernel_transport({'kernel': 'go'})
+        executable = [name]
+        if not router.legacy:
+            executable.append('--zmq-router={}'.format(self.zmq_endpoint))
         return MetaZMQ(
             name,
-            [name, '--zmq-subscribe={}'.format(self.zmq_port)],
-            self.zmq_pub_stream,
+            executable,
+            router,
             path,
             self.extra_routes(name, path),
+            kernel_build=kernel_build,
         )
 
     def extra_routes(self, name, path):
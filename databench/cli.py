@@ -40,6 +40,68 @@ def main(**kwargs):
     parser.add_argument('--coverage', default=False,
                         help=argparse.SUPPRESS)
 
+    parser.add_argument('--serializer', dest='serializer',
+                        default=os.environ.get('DATABENCH_SERIALIZER', 'json'),
+                        help='JSON serializer: json, ujson, orjson or auto '
+                             'for the fastest installed (default json)')
+
+    parser.add_argument('--kernel-pool', dest='kernel_pool',
+                        type=int, default=0,
+                        help='number of pre-started Python kernels to keep '
+                             'ready per analysis (default 0)')
+    parser.add_argument('--kernel-processes', dest='kernel_processes',
+                        type=int, default=0,
+                        help='number of Python kernel processes per analysis '
+                             'that each host many analysis instances '
+                             '(default 0: one process per connection)')
+
+    parser.add_argument('--zmq-transport', dest='zmq_transport',
+                        default='tcp', choices=('tcp', 'ipc'),
+                        help='transport to language kernels: tcp or ipc '
+                             'for Unix domain sockets (default tcp)')
+
+    kernel_args = parser.add_argument_group('Kernel supervision')
+    kernel_args.add_argument('--kernel-max-memory', dest='kernel_max_memory',
+                             type=float, default=None,
+                             help='maximum address space of a Python kernel '
+                                  'process in MB')
+    kernel_args.add_argument('--kernel-max-cpu', dest='kernel_max_cpu',
+                             type=float, default=None,
+                             help='maximum CPU time of a Python kernel '
+                                  'process in seconds')
+    kernel_args.add_argument('--kernel-idle-timeout',
+                             dest='kernel_idle_timeout',
+                             type=float, default=None,
+                             help='terminate kernels that are idle for this '
+                                  'many seconds and restart them on the '
+                                  'next message')
+
+    executor_args = parser.add_argument_group('Action pools')
+    executor_args.add_argument('--thread-pool-size', dest='thread_pool_size',
+                               type=int, default=None,
+                               help='number of threads for action handlers '
+                                    'with executor=\'thread\'')
+    executor_args.add_argument('--process-pool-size',
+                               dest='process_pool_size',
+                               type=int, default=None,
+                               help='number of processes for action '
+                                    'handlers with executor=\'process\'')
+
+    datastore_args = parser.add_argument_group('Datastore')
+    datastore_args.add_argument('--datastore-ttl', dest='datastore_ttl',
+                                type=float, default=None,
+                                help='evict datastores that are idle for '
+                                     'this many seconds')
+    datastore_args.add_argument('--datastore-max-idle',
+                                dest='datastore_max_idle',
+                                type=int, default=None,
+                                help='maximum number of idle datastores '
+                                     'kept in memory')
+    datastore_args.add_argument('--datastore-spill', dest='datastore_spill',
+                                default=None,
+                                help='directory to write evicted datastores '
+                                     'to instead of deleting them')
+
     ssl_args = parser.add_argument_group('SSL')
     ssl_args.add_argument('--ssl-certfile', dest='ssl_certfile',
                           default=os.environ.get('SSLCERTFILE'),
@@ -52,6 +114,8 @@ def main(**kwargs):
                           help='SSL port for webserver')
 
     args, analyses_args = parser.parse_known_args()
+    if args.datastore_ttl is not None and args.datastore_ttl <= 0:
+        parser.error('--datastore-ttl must be positive')
 
     # coverage
     cov = None
@@ -62,6 +126,8 @@ def main(**kwargs):
 
     # this is included here so that is included in coverage
     from .app import App, SingleApp
+    from .datastore import Datastore
+    from . import utils
 
     # log
     logging.basicConfig(level=getattr(logging, args.loglevel))
@@ -80,7 +146,15 @@ def main(**kwargs):
         logging.debug('Arguments passed to analyses: {}'.format(analyses_args))
 
     if not kwargs:
-        app = App(args.analyses, cli_args=analyses_args, debug=args.watch)
+        app = App(args.analyses, cli_args=analyses_args, debug=args.watch,
+                  kernel_pool=args.kernel_pool,
+                  kernel_processes=args.kernel_processes,
+                  zmq_transport=args.zmq_transport,
+                  kernel_max_memory=args.kernel_max_memory,
+                  kernel_max_cpu=args.kernel_max_cpu,
+                  kernel_idle_timeout=args.kernel_idle_timeout,
+                  thread_pool_size=args.thread_pool_size,
+                  process_pool_size=args.process_pool_size)
     else:
         app = SingleApp(cli_args=analyses_args, debug=args.watch, **kwargs)
 
@@ -93,6 +167,27 @@ def main(**kwargs):
             cov.save()
         return
 
+    # serialization
+    try:
+        serializer = utils.use_serializer(args.serializer)
+    except ValueError as e:
+        parser.error(str(e))
+    except ImportError:
+        parser.error('the {0} serializer needs the {0} package: '
+                     'pip install databench[{0}]'.format(args.serializer))
+    logging.info('Using the {} serializer.'.format(serializer.name))
+
+    # datastore eviction
+    Datastore.idle_ttl = args.datastore_ttl
+    Datastore.max_idle_domains = args.datastore_max_idle
+    if args.datastore_spill:
+        if not os.path.isdir(args.datastore_spill):
+            os.makedirs(args.datastore_spill)
+        Datastore.spill_path = args.datastore_spill
+    if args.datastore_ttl is not None:
+        tornado.ioloop.PeriodicCallback(
+            Datastore.evict, 1000.0 * min(args.datastore_ttl, 60.0)).start()
+
     # HTTP server
     tornado_app = app.tornado_app()
     tornado_app.listen(args.port, args.host)
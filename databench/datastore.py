@@ -1,17 +1,243 @@
-from .utils import json_encoder_default
-from collections import defaultdict
-import json
+from . import utils
+from .utils import RawJSON
+from collections import defaultdict, deque, OrderedDict
+import base64
+import contextlib
+import io
 import logging
+import os
+import time
+
+try:
+    from urllib.parse import quote  # Python 3
+except ImportError:
+    from urllib import quote  # Python 2
 
 log = logging.getLogger(__name__)
 
 
-def decode(value):
-    return json.loads(value)
+def decode(value, buffers=None, copy=True):
+    value = utils.loads(value)
+    if buffers:
+        value = utils.restore_buffers(value, buffers, copy)
+    return value
+
+
+def encode(value, buffers=None):
+    if buffers is not None:
+        value = utils.extract_buffers(value, buffers, content_ids=True)
+    return utils.dumps(value)
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError('{} is read-only'.format(type(self).__name__))
+
+
+class ReadOnlyDict(dict):
+    """A dict that cannot be modified."""
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
 
 
-def encode(value):
-    return json.dumps(value, default=json_encoder_default)
+class ReadOnlyList(list):
+    """A list that cannot be modified."""
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = clear = extend = insert = pop = remove = _read_only
+    reverse = sort = _read_only
+
+
+def freeze(value):
+    """Convert decoded JSON into nested read-only containers."""
+    if isinstance(value, dict):
+        return ReadOnlyDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return ReadOnlyList(freeze(v) for v in value)
+    return value
+
+
+def _escape(key):
+    return key.replace('~', '~0').replace('/', '~1')
+
+
+def json_patch(before, after, path=''):
+    """Structural difference between two decoded JSON values.
+
+    :returns: RFC 6902 operations (``add``, ``remove`` and ``replace``)
+        that turn ``before`` into ``after``
+    :rtype: list
+    """
+    if isinstance(before, dict) and isinstance(after, dict):
+        ops = [{'op': 'remove', 'path': path + '/' + _escape(k)}
+               for k in before if k not in after]
+        for k, v in after.items():
+            if k not in before:
+                ops.append({'op': 'add', 'path': path + '/' + _escape(k),
+                            'value': v})
+            else:
+                ops += json_patch(before[k], v, path + '/' + _escape(k))
+        return ops
+
+    if isinstance(before, list) and isinstance(after, list):
+        n = min(len(before), len(after))
+        ops = [op
+               for i in range(n)
+               for op in json_patch(before[i], after[i],
+                                    '{}/{}'.format(path, i))]
+        ops += [{'op': 'remove', 'path': '{}/{}'.format(path, i)}
+                for i in reversed(range(n, len(before)))]
+        ops += [{'op': 'add', 'path': '{}/{}'.format(path, i), 'value': v}
+                for i, v in enumerate(after[n:], n)]
+        return ops
+
+    if type(before) is type(after) and before == after:
+        return []
+    return [{'op': 'replace', 'path': path, 'value': after}]
+
+
+class RawJSONPatch(RawJSON):
+    """An encoded JSON patch for a datastore value.
+
+    The patch is encoded as ``{"__patch": [operations]}``. The full
+    value is kept in ``value`` for receivers that do not have the
+    previous value.
+
+    :param str encoded: encoded patch
+    :param RawJSON value: full value after the patch was applied
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, encoded, value):
+        super(RawJSONPatch, self).__init__(encoded)
+        self.value = value
+
+    def decode(self):
+        """Return the full decoded value."""
+        return self.value.decode()
+
+
+class StateUpdate(dict):
+    """Changed keys and values passed to subscribers.
+
+    :param dict key_value: changed keys and values
+    :param int revision: revision of the change
+    """
+
+    def __init__(self, key_value, revision=None):
+        super(StateUpdate, self).__init__(key_value)
+        self.revision = revision
+
+
+class Journal(object):
+    """Bounded log of the keys changed in a domain.
+
+    :param int maxlen: maximum number of entries
+    :param int start: revision after which the journal is complete
+    """
+    __slots__ = ('entries', 'maxlen', 'start')
+
+    def __init__(self, maxlen, start):
+        self.entries = deque()
+        self.maxlen = maxlen
+        self.start = start
+
+    def append(self, revision, key):
+        self.entries.append((revision, key))
+        if len(self.entries) > self.maxlen:
+            self.start = self.entries.popleft()[0]
+
+    def since(self, revision):
+        """Keys changed after revision.
+
+        :returns: changed keys or None if the journal does not go back to
+            that revision
+        :rtype: list
+        """
+        if revision < self.start:
+            return None
+        keys = OrderedDict()
+        for entry_revision, key in reversed(self.entries):
+            if entry_revision <= revision:
+                break
+            keys[key] = None
+        return list(reversed(keys))
+
+
+class Subscription(object):
+    """A callback for changes to all or some keys of a datastore domain.
+
+    :param callback: Function with signature ({key: value}) => None.
+    :param bool raw: receive :class:`databench.utils.RawJSON` values
+    :param keys: only receive changes for these keys
+    :param str prefix: only receive changes for keys with this prefix
+    """
+    __slots__ = ('callback', 'raw', 'keys', 'prefix')
+
+    def __init__(self, callback, raw=False, keys=None, prefix=None):
+        if keys is not None and prefix is not None:
+            raise ValueError('subscribe to either keys or a prefix')
+        self.callback = callback
+        self.raw = raw
+        self.keys = frozenset(keys) if keys is not None else None
+        self.prefix = prefix
+
+    def matches(self, key):
+        if self.keys is not None:
+            return key in self.keys
+        if self.prefix is not None:
+            return key.startswith(self.prefix)
+        return True
+
+
+class SubscriberIndex(object):
+    """Subscriptions of a datastore domain indexed by key and prefix.
+
+    The index is updated when subscriptions are added or removed so that
+    looking up the subscribers of a key only touches interested
+    subscriptions.
+    """
+
+    def __init__(self):
+        self.unfiltered = []
+        self.by_key = defaultdict(list)
+        self.by_prefix = defaultdict(list)
+
+    def __len__(self):
+        lists = [self.unfiltered]
+        lists += self.by_key.values()
+        lists += self.by_prefix.values()
+        return sum(len(subscriptions) for subscriptions in lists)
+
+    def _lists(self, subscription):
+        if subscription.keys is not None:
+            return [self.by_key[k] for k in subscription.keys]
+        if subscription.prefix is not None:
+            return [self.by_prefix[subscription.prefix]]
+        return [self.unfiltered]
+
+    def add(self, subscription):
+        for subscriptions in self._lists(subscription):
+            subscriptions.append(subscription)
+
+    def remove(self, subscription):
+        for subscriptions in self._lists(subscription):
+            subscriptions.remove(subscription)
+
+        # drop empty entries
+        if subscription.keys is not None:
+            for k in subscription.keys:
+                if not self.by_key[k]:
+                    del self.by_key[k]
+        elif subscription.prefix is not None and \
+                not self.by_prefix[subscription.prefix]:
+            del self.by_prefix[subscription.prefix]
+
+    def match(self, key):
+        """Subscriptions interested in key."""
+        matches = self.unfiltered + self.by_key.get(key, [])
+        for prefix, subscriptions in self.by_prefix.items():
+            if key.startswith(prefix):
+                matches += subscriptions
+        return matches
 
 
 class Datastore(object):
@@ -26,39 +252,216 @@ class Datastore(object):
 
     :param bool release_storage:
         Release storage when the last datastore for a domain closes.
+
+    :param bool json_patch:
+        Send changes of values to raw subscribers as JSON patches (see
+        :func:`json_patch`) when the patch is smaller than the new value.
+
+    :param bool binary:
+        Store numpy arrays as binary buffers instead of JSON lists (see
+        :func:`databench.utils.extract_buffers`). Raw subscribers receive
+        the buffers with the encoded value.
+
+    :param bool evictable:
+        Whether the domain can be evicted when it is idle. Domains of
+        ``class_data`` are kept for the lifetime of the process.
+
+    **Reads**: Indexing and :meth:`get` return a modifiable copy that is
+    decoded on every read, so it can be changed and written back.
+    :meth:`view` is the fast path for reads: it returns a read-only view
+    that is decoded once and cached until the entry changes.
+
+    **Eviction**: A domain is idle when all its datastores are closed.
+    Domains of datastores that are not ``evictable`` do not become idle.
+    Idle domains are evicted when they have been idle for more than
+    ``idle_ttl`` seconds or when there are more than ``max_idle_domains``
+    of them, starting with the domain that has been idle the longest.
+    When ``spill_path`` is set, evicted domains are written to that
+    directory and restored when a datastore for that domain is created
+    again. See :meth:`evict` and :meth:`stats`.
+
+    **Revisions**: Every change is assigned a revision from a clock that
+    is shared across domains and increases monotonically, also across
+    restarts of the process. The revisions of the keys are available with
+    :meth:`revision` and a bounded journal of changes with
+    :meth:`changes_since`. Subscribers receive a :class:`StateUpdate` with
+    the revision of the change.
+
+    **Transactions**: Writes inside a :meth:`transaction` are buffered and
+    committed at the end of the transaction with one notification per
+    subscriber.
+
+    :cvar float idle_ttl: seconds before an idle domain is evicted
+    :cvar int max_idle_domains: maximum number of idle domains in memory
+    :cvar str spill_path: directory to write evicted domains to
+    :cvar int journal_size: maximum number of changes kept per domain
     """
     global_data = defaultdict(dict)  # the actual stored data
+    global_cache = defaultdict(dict)  # read-only decoded values
     stores = defaultdict(list)  # list of instances by domain
-
-    def __init__(self, domain, release_storage=False):
+    indexes = defaultdict(SubscriberIndex)  # subscriptions by domain
+    idle_domains = OrderedDict()  # time when domains became idle
+    global_revisions = defaultdict(dict)  # revision of every key
+    global_buffers = defaultdict(dict)  # binary data of arrays by key
+    journals = {}  # Journal by domain
+    clock = 0  # last issued revision
+    idle_ttl = None
+    max_idle_domains = None
+    spill_path = None
+    journal_size = 1000
+
+    def __init__(self, domain, release_storage=False, json_patch=False,
+                 binary=False, evictable=True):
         self.domain = domain
         self.release_storage = release_storage
-        self.callbacks = []
+        self.json_patch = json_patch
+        self.binary = binary
+        self.evictable = evictable
+        self.subscriptions = []
+        self.closed = False
+        self.pending = None  # buffered writes of a transaction
+
+        Datastore.idle_domains.pop(self.domain, None)
+        if self.domain not in Datastore.global_data:
+            Datastore.restore(self.domain)
         Datastore.stores[self.domain].append(self)
 
     @property
     def data(self):
         return Datastore.global_data[self.domain]
 
-    def subscribe(self, callback):
+    @property
+    def cache(self):
+        return Datastore.global_cache[self.domain]
+
+    @property
+    def revisions(self):
+        return Datastore.global_revisions[self.domain]
+
+    @property
+    def buffers(self):
+        return Datastore.global_buffers[self.domain]
+
+    @staticmethod
+    def next_revision():
+        """Issue a new revision.
+
+        Revisions are microseconds since the epoch and strictly increasing.
+
+        :rtype: int
+        """
+        Datastore.clock = max(Datastore.clock + 1, int(time.time() * 1e6))
+        return Datastore.clock
+
+    def revision(self, key=None):
+        """Revision of the last change to key or to any key in the domain.
+
+        :rtype: int
+        """
+        if key is not None:
+            return self.revisions.get(key)
+        return max(self.revisions.values()) if self.revisions else None
+
+    def changes_since(self, revision):
+        """Keys that changed after the given revision.
+
+        All keys are returned when the journal does not go back far enough.
+
+        :param int revision: last revision seen
+        :rtype: list
+        """
+        journal = Datastore.journals.get(self.domain)
+        keys = journal.since(revision) if journal is not None else None
+        if keys is None:
+            return list(self.data)
+        return [key for key in keys if key in self.data]
+
+    def journal_covers(self, revision):
+        """Whether the journal has all changes after the given revision.
+
+        :param int revision: last revision seen
+        :rtype: bool
+        """
+        journal = Datastore.journals.get(self.domain)
+        return journal is not None and revision >= journal.start
+
+    def subscribe(self, callback, raw=False, keys=None, prefix=None):
         """Subscribe to changes in the datastore with a callback.
 
         :param callback: Function with signature ({key: value}) => None.
+        :param bool raw:
+            Receive values as :class:`databench.utils.RawJSON` with the
+            stored encoding instead of decoded values.
+        :param keys: Only receive changes for these keys.
+        :param str prefix: Only receive changes for keys with this prefix.
         """
-        self.callbacks.append(callback)
+        subscription = Subscription(callback, raw, keys, prefix)
+        self.subscriptions.append(subscription)
+        Datastore.indexes[self.domain].add(subscription)
         return self
 
     def all_callbacks(self):
-        return [callback
+        """All subscriptions of this domain.
+
+        :rtype: list[Subscription]
+        """
+        return [subscription
                 for datastore in Datastore.stores[self.domain]
-                for callback in datastore.callbacks]
+                for subscription in datastore.subscriptions]
 
-    def trigger_callbacks(self, key, callbacks=None):
-        if callbacks is None:
-            callbacks = self.all_callbacks()
+    def trigger_callbacks(self, key, callbacks=None, patch=None):
+        """Trigger callbacks for a key.
 
-        value = self.get(key)
-        return [callback({key: value}) for callback in callbacks]
+        :param key: changed key
+        :param callbacks: list of :class:`Subscription` or none for all
+            subscribed
+        :param str patch: encoded JSON patch for raw subscribers
+        :rtype: Iterable[tornado.concurrent.Future]
+        """
+        return self.notify({key: patch}, callbacks)
+
+    def notify(self, patches, callbacks=None):
+        """Trigger callbacks once for a set of changed keys.
+
+        Every subscriber is called once with all the changed keys it is
+        subscribed to.
+
+        :param dict patches: changed keys and their encoded JSON patches
+            for raw subscribers (or None)
+        :param callbacks: list of :class:`Subscription` or none for all
+            subscribed
+        :rtype: Iterable[tornado.concurrent.Future]
+        """
+        index = Datastore.indexes[self.domain]
+        keys_by_subscription = OrderedDict()
+        for key in patches:
+            if callbacks is None:
+                matches = index.match(key)
+            else:
+                matches = [c for c in callbacks if c.matches(key)]
+            for c in matches:
+                keys_by_subscription.setdefault(c, []).append(key)
+
+        # only decode when a subscriber needs the decoded value
+        raw_values, values = {}, {}
+        for c, keys in keys_by_subscription.items():
+            for key in keys:
+                if c.raw and key not in raw_values:
+                    raw_values[key] = RawJSON(self.data[key],
+                                              self.buffers.get(key))
+                    if patches[key] is not None:
+                        raw_values[key] = RawJSONPatch(patches[key],
+                                                       raw_values[key])
+                elif not c.raw and key not in values:
+                    values[key] = self.get(key)
+
+        results = []
+        for c, keys in keys_by_subscription.items():
+            source = raw_values if c.raw else values
+            revision = max(self.revisions.get(key) or 0 for key in keys)
+            results.append(c.callback(StateUpdate(
+                {key: source[key] for key in keys}, revision or None)))
+        return results
 
     def trigger_all_callbacks(self, callbacks=None):
         """Trigger callbacks for all keys on all or a subset of subscribers.
@@ -68,18 +471,34 @@ class Datastore(object):
         """
         return [ret
                 for key in self
-                for ret in self.trigger_callbacks(key, callbacks=None)]
+                for ret in self.trigger_callbacks(key, callbacks=callbacks)]
+
+    def snapshot(self):
+        """All keys and values of the domain as one update.
+
+        The values are the stored encodings as
+        :class:`databench.utils.RawJSON`.
+
+        :rtype: StateUpdate
+        """
+        return StateUpdate({key: RawJSON(value, self.buffers.get(key))
+                            for key, value in self.data.items()},
+                           self.revision())
 
     def get_encoded(self, key):
+        if self.pending is not None and key in self.pending:
+            return encode(self.pending[key])
         if key not in self.data:
             raise IndexError
         return self.data[key]
 
     def __getitem__(self, key):
-        """Return entry at key."""
+        """Return entry at key. Same as :meth:`get`."""
+        if self.pending is not None and key in self.pending:
+            return self._pending_copy(key)
         if key not in self.data:
             raise IndexError
-        return decode(self.data[key])
+        return self._copy(key)
 
     def __setitem__(self, key, value):
         """Set value at given key."""
@@ -89,24 +508,156 @@ class Datastore(object):
     def get(self, key, default=None):
         """Return entry at key.
 
+        The entry is a modifiable copy that is decoded on every call. Use
+        :meth:`view` to read it without a copy.
+
         Return a default value if the key is not present.
         """
+        if self.pending is not None and key in self.pending:
+            return self._pending_copy(key)
         if key not in self.data:
             return default
-        return decode(self.data[key])
+        return self._copy(key)
+
+    def view(self, key, default=None):
+        """Return a read-only view of the entry at key.
+
+        The view is decoded once and cached until the entry changes, so
+        repeated reads are free. Dictionaries and lists are returned as
+        :class:`ReadOnlyDict` and :class:`ReadOnlyList` that raise a
+        `TypeError` on modification. Use :meth:`get` for a modifiable copy.
+
+        Return a default value if the key is not present.
+        """
+        if self.pending is not None and key in self.pending:
+            return freeze(self._pending_copy(key))
+        if key not in self.data:
+            return default
+        if key not in self.cache:
+            self.cache[key] = freeze(decode(self.data[key],
+                                            self.buffers.get(key),
+                                            copy=False))
+        return self.cache[key]
+
+    def _copy(self, key):
+        """Return a modifiable value. Immutable values come from the cache."""
+        if key in self.cache and not isinstance(self.cache[key],
+                                                (dict, list)) and \
+           key not in self.buffers:
+            return self.cache[key]
+
+        value = decode(self.data[key], self.buffers.get(key))
+        if not isinstance(value, (dict, list)) and key not in self.buffers:
+            self.cache[key] = value
+        return value
+
+    def _pending_copy(self, key):
+        buffers = {} if self.binary else None
+        return decode(encode(self.pending[key], buffers), buffers)
 
     def set(self, key, value):
         """Set a value at key and return a Future.
 
+        Inside a :meth:`transaction`, the value is buffered until the
+        transaction is committed.
+
         :rtype: Iterable[tornado.concurrent.Future]
         """
-        value_encoded = encode(value)
+        if self.pending is not None:
+            self.pending[key] = value
+            return []
 
-        if key in self.data and self.data[key] == value_encoded:
+        changed, patch = self._write(key, value)
+        if not changed:
             return []
+        return self.trigger_callbacks(key, patch=patch)
+
+    def _write(self, key, value):
+        """Encode and store a value without triggering callbacks.
+
+        :returns: whether the value changed and an encoded JSON patch
+        :rtype: tuple
+        """
+        buffers = {} if self.binary else None
+        value_encoded = encode(value, buffers)
+
+        if key in self.data and self.data[key] == value_encoded:
+            return False, None
+
+        patch = None
+        if self.json_patch and key in self.data and \
+           not buffers and key not in self.buffers:
+            after = decode(value_encoded)
+            patch = encode({'__patch': json_patch(self.view(key), after)})
+            if len(patch) >= len(value_encoded):
+                patch = None
+            self.cache[key] = freeze(after)
+        else:
+            self.cache.pop(key, None)
 
         self.data[key] = value_encoded
-        return self.trigger_callbacks(key)
+        if buffers:
+            self.buffers[key] = buffers
+        else:
+            self.buffers.pop(key, None)
+        self.record(key)
+        return True, patch
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Buffer writes and commit them together.
+
+        .. code-block:: python
+
+            with self.data.transaction():
+                self.data['samples'] = self.data['samples'] + [value]
+                self.data['count'] = len(self.data['samples'])
+
+        Reads inside the transaction see the buffered values. Values are
+        encoded and compared to the stored values only once when the
+        transaction is committed, so they should not be modified after
+        they are set. Every subscriber receives one notification with the
+        final values of all changed keys. The buffered writes are dropped
+        when an exception is raised. Nested transactions are part of the
+        outermost transaction.
+        """
+        if self.pending is not None:
+            yield self
+            return
+
+        self.pending = OrderedDict()
+        try:
+            yield self
+        except BaseException:
+            self.pending = None
+            raise
+        pending, self.pending = self.pending, None
+        self.commit(pending)
+
+    def commit(self, pending):
+        """Store the given values and notify subscribers once.
+
+        :param dict pending: keys and values to store
+        :rtype: Iterable[tornado.concurrent.Future]
+        """
+        patches = OrderedDict()
+        for key, value in pending.items():
+            changed, patch = self._write(key, value)
+            if changed:
+                patches[key] = patch
+        if not patches:
+            return []
+        return self.notify(patches)
+
+    def record(self, key):
+        """Assign a new revision to key and add it to the journal."""
+        revision = Datastore.next_revision()
+        self.revisions[key] = revision
+        if self.domain not in Datastore.journals:
+            Datastore.journals[self.domain] = Journal(Datastore.journal_size,
+                                                      revision - 1)
+        Datastore.journals[self.domain].append(revision, key)
+        return revision
 
     def set_state(self, updater=None, **kwargs):
         """Update the datastore.
@@ -127,6 +678,8 @@ class Datastore(object):
 
     def __contains__(self, key):
         """Test whether key is set."""
+        if self.pending is not None and key in self.pending:
+            return True
         return key in self.data
 
     def init(self, key_value_pairs=None, **kwargs):
@@ -147,30 +700,160 @@ class Datastore(object):
 
     def close(self):
         """Close and delete instance."""
+        if self.closed:
+            return
+        self.closed = True
 
         # remove callbacks
+        index = Datastore.indexes[self.domain]
+        for subscription in self.subscriptions:
+            index.remove(subscription)
+        if not len(index):
+            del Datastore.indexes[self.domain]
         Datastore.stores[self.domain].remove(self)
 
-        # delete data after the last instance is gone
-        if self.release_storage and not Datastore.stores[self.domain]:
-            del Datastore.global_data[self.domain]
+        # last instance is gone: delete data or mark domain as idle
+        if not Datastore.stores[self.domain]:
+            del Datastore.stores[self.domain]
+            if self.release_storage:
+                Datastore.release(self.domain)
+            elif self.evictable:
+                Datastore.idle_domains[self.domain] = time.time()
+                Datastore.evict()
 
         del self
 
+    @staticmethod
+    def release(domain):
+        """Delete all data of a domain from memory."""
+        Datastore.idle_domains.pop(domain, None)
+        Datastore.global_data.pop(domain, None)
+        Datastore.global_cache.pop(domain, None)
+        Datastore.global_revisions.pop(domain, None)
+        Datastore.global_buffers.pop(domain, None)
+        Datastore.journals.pop(domain, None)
+
+    @staticmethod
+    def evict(now=None):
+        """Evict idle domains according to the eviction settings.
+
+        This is called when a domain becomes idle. Call it periodically
+        to enforce ``idle_ttl``.
+
+        :param float now: current time, default is `time.time()`
+        :returns: evicted domains
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+
+        evicted = []
+        for domain, idle_since in list(Datastore.idle_domains.items()):
+            expired = (Datastore.idle_ttl is not None and
+                       now - idle_since > Datastore.idle_ttl)
+            too_many = (Datastore.max_idle_domains is not None and
+                        len(Datastore.idle_domains) >
+                        Datastore.max_idle_domains)
+            if not expired and not too_many:
+                break
+
+            del Datastore.idle_domains[domain]
+            if Datastore.spill_path is not None:
+                Datastore.spill(domain)
+            Datastore.release(domain)
+            evicted.append(domain)
+
+        if evicted:
+            log.debug('evicted {} idle datastore domains'.format(len(evicted)))
+        return evicted
+
+    @staticmethod
+    def spill_file(domain):
+        return os.path.join(Datastore.spill_path,
+                            quote(domain, safe='') + '.json')
+
+    @staticmethod
+    def spill(domain):
+        """Write the data of a domain to ``spill_path``."""
+        if not Datastore.global_data.get(domain):
+            return
+        buffers = {
+            key: {id_: base64.b64encode(data).decode('ascii')
+                  for id_, data in key_buffers.items()}
+            for key, key_buffers in Datastore.global_buffers[domain].items()
+        }
+        encoded = encode({'data': Datastore.global_data[domain],
+                          'buffers': buffers})
+        if not isinstance(encoded, bytes):  # text in Python 3
+            encoded = encoded.encode('utf-8')
+        with io.open(Datastore.spill_file(domain), 'wb') as f:
+            f.write(encoded)
+
+    @staticmethod
+    def restore(domain):
+        """Restore the data of a domain from ``spill_path`` if present."""
+        if Datastore.spill_path is None:
+            return
+        file_name = Datastore.spill_file(domain)
+        if not os.path.isfile(file_name):
+            return
+        with io.open(file_name, 'rb') as f:
+            spilled = decode(f.read())
+        Datastore.global_data[domain] = spilled['data']
+        for key, key_buffers in spilled['buffers'].items():
+            Datastore.global_buffers[domain][key] = {
+                id_: base64.b64decode(data)
+                for id_, data in key_buffers.items()
+            }
+        os.remove(file_name)
+        log.debug('restored datastore domain {}'.format(domain))
+
+    @staticmethod
+    def stats():
+        """Counts and sizes of the stored data.
+
+        Sizes are the lengths of the encoded values and of the binary
+        buffers.
+
+        :rtype: dict
+        """
+        spilled = 0
+        if Datastore.spill_path is not None and \
+           os.path.isdir(Datastore.spill_path):
+            spilled = sum(1 for f in os.listdir(Datastore.spill_path)
+                          if f.endswith('.json'))
+        return {
+            'domains': len(Datastore.global_data),
+            'idle_domains': len(Datastore.idle_domains),
+            'spilled_domains': spilled,
+            'keys': sum(len(d) for d in Datastore.global_data.values()),
+            'bytes': sum(len(v)
+                         for d in Datastore.global_data.values()
+                         for v in d.values()),
+            'buffer_bytes': sum(len(data)
+                                for d in Datastore.global_buffers.values()
+                                for buffers in d.values()
+                                for data in buffers.values()),
+            'subscriptions': sum(len(i) for i in Datastore.indexes.values()),
+        }
+
     def __len__(self):
         """Length of the dictionary."""
-        return len(self.data)
+        return len(self.keys())
 
     def __iter__(self):
         """Iterator."""
-        return (k for k in self.data.keys())
+        return (k for k in self.keys())
 
     def __repr__(self):
         """repr"""
-        return {k: self[k] for k in self}.__repr__()
+        return {k: self.view(k) for k in self}.__repr__()
 
     def keys(self):
         """Keys."""
+        if self.pending:
+            return list(self.data.keys()) + [k for k in self.pending
+                                             if k not in self.data]
         return self.data.keys()
 
     def values(self):
@@ -0,0 +1,359 @@
+"""Pools of threads and processes that run action handlers."""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from .datastore import freeze
+import concurrent.futures
+import copy
+import functools
+import itertools
+import logging
+import multiprocessing
+import sys
+import threading
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import types
+
+log = logging.getLogger(__name__)
+
+# the IOLoop of the server in worker threads of an action pool
+_worker = threading.local()
+
+# the queue to the server in worker processes of an action pool
+_queue = None
+
+#: whether process pools are available, they need the initializer argument
+#: of `concurrent.futures.ProcessPoolExecutor`
+PROCESS_POOLS = sys.version_info >= (3, 7)
+
+
+def check_kind(kind):
+    """Raise a `ValueError` for an executor kind that is not available."""
+    if kind not in ActionExecutor.kinds:
+        raise ValueError('unknown executor {}'.format(kind))
+    if kind == 'process' and not PROCESS_POOLS:
+        raise ValueError('process executors need Python 3.7 or newer')
+
+
+def in_worker():
+    """Whether this is a worker thread of an :class:`ActionExecutor`."""
+    return getattr(_worker, 'ioloop', None) is not None
+
+
+def ioloop_call(fn, *args, **kwargs):
+    """Call a function on the IOLoop of the server.
+
+    In a worker thread of an action pool, the call is scheduled on the
+    IOLoop that started the action and a future for its result is returned.
+    The future is resolved on the event loop of the worker thread.
+    Futures and lists of futures returned by the function are resolved
+    first. Everywhere else, the function is called directly.
+
+    :rtype: tornado.concurrent.Future
+    """
+    if not in_worker():
+        return fn(*args, **kwargs)
+
+    future = concurrent.futures.Future()
+    result_future = tornado.concurrent.Future()
+    worker_ioloop = tornado.ioloop.IOLoop.current()
+    future.add_done_callback(lambda f: worker_ioloop.add_callback(
+        tornado.concurrent.chain_future, f, result_future))
+
+    def call():
+        try:
+            result = fn(*args, **kwargs)
+            if isinstance(result, list) or \
+               tornado.concurrent.is_future(result):
+                tornado.concurrent.chain_future(
+                    tornado.gen.convert_yielded(result), future)
+                return
+        except Exception as e:
+            future.set_exception(e)
+            return
+        future.set_result(result)
+
+    _worker.ioloop.add_callback(call)
+    return result_future
+
+
+def run_thread(ioloop, fn, args=(), kwargs=None):
+    """Run an action handler on the event loop of this worker thread.
+
+    Calls of :func:`ioloop_call` in the handler are run on the given IOLoop.
+    """
+    _worker.ioloop = ioloop
+    worker_ioloop = getattr(_worker, 'worker_ioloop', None)
+    if worker_ioloop is None:
+        worker_ioloop = tornado.ioloop.IOLoop()
+        _worker.worker_ioloop = worker_ioloop
+    return worker_ioloop.run_sync(
+        lambda: tornado.gen.coroutine(fn)(*args, **(kwargs or {})))
+
+
+def _plain(datastore):
+    """Copy of the contents of a datastore as a dictionary."""
+    if datastore is None:
+        return {}
+    return {key: datastore.get(key) for key in datastore.data}
+
+
+def _init_process(queue):
+    global _queue
+    _queue = queue
+
+
+class ProcessState(dict):
+    """Copy of a datastore in a worker process.
+
+    Reads work like on a :class:`~databench.Datastore`: :meth:`get` and
+    item access return modifiable copies and :meth:`view` returns a
+    read-only view. Changes are only made with
+    :meth:`ProcessAnalysis.set_state` and
+    :meth:`ProcessAnalysis.set_class_state`.
+    """
+
+    def __getitem__(self, key):
+        """Return a copy of the entry at key. Same as :meth:`get`."""
+        if key not in self:
+            raise IndexError
+        return self.get(key)
+
+    def get(self, key, default=None):
+        """Return a modifiable copy of the entry at key or a default."""
+        if key not in self:
+            return default
+        return copy.deepcopy(dict.__getitem__(self, key))
+
+    def view(self, key, default=None):
+        """Return a read-only view of the entry at key or a default."""
+        if key not in self:
+            return default
+        return freeze(dict.__getitem__(self, key))
+
+
+class ProcessAnalysis(object):
+    """Stands in for an analysis instance in a worker process.
+
+    ``data`` and ``class_data`` are :class:`ProcessState` copies of the
+    datastores when the action started. :meth:`emit`, :meth:`set_state` and
+    :meth:`set_class_state` are sent to the analysis instance in the server.
+    """
+
+    def __init__(self, task_id, id_, data, class_data, cli_args,
+                 request_args):
+        self.task_id = task_id
+        self.id_ = id_
+        self.data = ProcessState(data)
+        self.class_data = ProcessState(class_data)
+        self.cli_args = cli_args
+        self.request_args = request_args
+
+    def emit(self, signal, message='__nomessagetoken__'):
+        _queue.put((self.task_id, 'emit', (signal, message)))
+
+    def set_state(self, updater=None, **kwargs):
+        state_change = self._state_change(self.data, updater, kwargs)
+        self.data.update(state_change)
+        _queue.put((self.task_id, 'set_state', (state_change,)))
+
+    def set_class_state(self, updater=None, **kwargs):
+        state_change = self._state_change(self.class_data, updater, kwargs)
+        self.class_data.update(state_change)
+        _queue.put((self.task_id, 'set_class_state', (state_change,)))
+
+    @staticmethod
+    def _state_change(state, updater, kwargs):
+        if callable(updater):
+            return updater(state)
+        elif updater is not None:
+            return updater
+        return kwargs
+
+
+def _run_process(analysis_class, name, task_id, state, args, kwargs):
+    """Run an action handler in this worker process."""
+    fn = getattr(analysis_class, name).__wrapped__
+    analysis = ProcessAnalysis(task_id, **state)
+    try:
+        result = fn(analysis, *args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            for _ in result:
+                pass
+            result = None
+        return result
+    finally:
+        _queue.put((task_id, None, ()))
+
+
+class ActionExecutor(object):
+    """Runs action handlers on a pool of threads or processes.
+
+    Handlers on a thread pool run on an event loop of their worker thread.
+    Their calls of :meth:`~databench.Analysis.emit`,
+    :meth:`~databench.Analysis.set_state` and
+    :meth:`~databench.Analysis.set_class_state` are run on the IOLoop of the
+    server. Other access to the datastores should be read-only.
+
+    Handlers on a process pool receive a :class:`ProcessAnalysis` instead of
+    the analysis instance. Their arguments and the datastore contents must
+    be picklable. Process pools need Python 3.7 or newer and raise a
+    `ValueError` on older versions.
+
+    The pool is started when the first action is submitted.
+
+    :param str kind: ``thread`` or ``process``
+    :param int max_workers:
+        size of the pool, by default the number of CPUs for processes and
+        four times that for threads
+    """
+
+    kinds = ('thread', 'process')
+    defaults = {}
+
+    def __init__(self, kind='thread', max_workers=None):
+        check_kind(kind)
+        cpus = multiprocessing.cpu_count()
+        self.kind = kind
+        self.max_workers = max_workers or (4 * cpus if kind == 'thread'
+                                           else cpus)
+        self.pool = None
+        self.queue = None
+        self.in_flight = 0
+        self.completed = 0
+        self.tasks = {}
+        self.task_ids = itertools.count()
+
+    @classmethod
+    def default(cls, kind):
+        """Shared executor for analyses that are not run by an App."""
+        if kind not in cls.defaults:
+            cls.defaults[kind] = cls(kind)
+        return cls.defaults[kind]
+
+    def start(self):
+        if self.pool is not None:
+            return
+        if self.kind == 'thread':
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                self.max_workers)
+            return
+
+        self.queue = multiprocessing.Queue()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.max_workers,
+            initializer=_init_process, initargs=(self.queue,),
+        )
+        drain = threading.Thread(target=self.drain, args=(self.queue,))
+        drain.daemon = True
+        drain.start()
+
+    def shutdown(self):
+        """Shut down the pool without waiting for running actions."""
+        if self.pool is None:
+            return
+        self.pool.shutdown(wait=False)
+        if self.queue is not None:
+            self.queue.put(None)
+        self.pool, self.queue = None, None
+
+    def stats(self):
+        """Queue depth and utilization of the pool.
+
+        :rtype: dict
+        """
+        running = min(self.in_flight, self.max_workers)
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'running': running,
+            'queued': self.in_flight - running,
+            'completed': self.completed,
+            'utilization': running / self.max_workers,
+        }
+
+    @tornado.gen.coroutine
+    def run(self, analysis, fn, args=(), kwargs=None):
+        """Run an action handler on the pool.
+
+        :param Analysis analysis: the analysis instance
+        :param fn: the undecorated action handler bound to the analysis
+        :param list args: positional arguments
+        :param dict kwargs: keyword arguments
+        :returns: resolves to the return value of the handler
+        :rtype: tornado.concurrent.Future
+        """
+        self.start()
+        self.in_flight += 1
+        try:
+            if self.kind == 'thread':
+                result = yield self.pool.submit(
+                    run_thread, tornado.ioloop.IOLoop.current(),
+                    fn, args, kwargs or {})
+            else:
+                result = yield self.run_process(analysis, fn, args,
+                                                kwargs or {})
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def run_process(self, analysis, fn, args, kwargs):
+        task_id = next(self.task_ids)
+        done = tornado.concurrent.Future()
+        self.tasks[task_id] = (analysis, done,
+                               tornado.ioloop.IOLoop.current())
+        state = {
+            'id_': analysis.id_,
+            'data': _plain(analysis.data),
+            'class_data': _plain(analysis.class_data),
+            'cli_args': analysis.cli_args,
+            'request_args': analysis.request_args,
+        }
+        try:
+            result = yield self.pool.submit(
+                _run_process, type(analysis), fn.__name__, task_id, state,
+                args, kwargs)
+            # messages of the action arrive before it is done
+            yield done
+        finally:
+            del self.tasks[task_id]
+        raise tornado.gen.Return(result)
+
+    def drain(self, queue):
+        """Hand messages from worker processes to the IOLoops."""
+        while True:
+            message = queue.get()
+            if message is None:
+                return
+            task = self.tasks.get(message[0])
+            if task is not None:
+                task[2].add_callback(self.apply, *message)
+
+    def apply(self, task_id, method, args):
+        task = self.tasks.get(task_id)
+        if task is None:
+            return
+        analysis, done, _ = task
+        if method is None:
+            if not done.done():
+                done.set_result(None)
+            return
+        try:
+            result = getattr(analysis, method)(*args)
+        except Exception:
+            log.exception('{} from a worker process failed'.format(method))
+            return
+        if tornado.concurrent.is_future(result):
+            result.add_done_callback(functools.partial(self.log_error,
+                                                       method))
+
+    @staticmethod
+    def log_error(method, future):
+        try:
+            future.result()
+        except Exception:
+            log.exception('{} from a worker process failed'.format(method))
@@ -0,0 +1,157 @@
+"""Build steps for compiled language kernels."""
+
+from __future__ import absolute_import, unicode_literals
+
+import concurrent.futures
+import hashlib
+import logging
+import os
+import subprocess
+import tornado.concurrent
+
+log = logging.getLogger(__name__)
+
+
+class KernelBuild(object):
+    """The build step of a language kernel.
+
+    The command runs in the analysis directory on a thread pool, so builds
+    of different analyses run in parallel and do not block the IOLoop. A
+    build is skipped when the files in the directory and the command are
+    unchanged since the last successful build. The content hash after that
+    build, including build outputs in the directory and the modification
+    time of ``output``, is stored in :attr:`cache_file` in the analysis
+    directory. Remove it to force a new build. A build also runs when
+    ``output`` is missing, for example when it was removed from
+    ``$GOPATH/bin``. When the cache file cannot be written, the build
+    succeeds and runs again next time.
+
+    :param command:
+        a list of arguments or a string that is run in a shell
+    :param str path: analysis directory
+    :param str output:
+        executable that the build creates: a path relative to the analysis
+        directory or a name that is looked up in ``PATH``
+    """
+
+    #: name of the file that stores the hash of the last successful build
+    cache_file = '.databench_build'
+
+    #: runs the builds of all analyses
+    executor = concurrent.futures.ThreadPoolExecutor(4)
+
+    def __init__(self, command, path, output=None):
+        self.command = command
+        self.path = path
+        self.output = output
+
+    def output_path(self):
+        """Path of the build output or None if it does not exist.
+
+        :rtype: str
+        """
+        if self.output is None:
+            return None
+        if os.path.dirname(self.output):
+            candidates = [os.path.join(self.path, self.output)]
+        else:
+            candidates = [os.path.join(d, self.output)
+                          for d in os.environ.get('PATH', '').split(os.pathsep)
+                          if d]
+        for candidate in candidates:
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def build_hash(self):
+        """Hash of the sources and the modification time of the output.
+
+        :returns: the hash or None if the output does not exist
+        :rtype: str
+        """
+        source_hash = self.source_hash()
+        if self.output is None:
+            return source_hash
+        output_path = self.output_path()
+        if output_path is None:
+            return None
+        return '{}-{}'.format(source_hash, os.path.getmtime(output_path))
+
+    def source_hash(self):
+        """Content hash of the command and the files in the analysis
+        directory.
+
+        Hidden files and directories are ignored.
+
+        :rtype: str
+        """
+        h = hashlib.sha1(repr(self.command).encode('utf-8'))
+        for root, dirs, files in os.walk(self.path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(files):
+                if name.startswith('.'):
+                    continue
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, self.path)
+                         .replace(os.sep, '/').encode('utf-8'))
+                with open(file_path, 'rb') as f:
+                    h.update(hashlib.sha1(f.read()).digest())
+        return h.hexdigest()
+
+    def cached_hash(self):
+        try:
+            with open(os.path.join(self.path, self.cache_file)) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def run(self):
+        """Run the build unless it is up to date.
+
+        :returns: whether the build succeeded or was up to date
+        :rtype: bool
+        """
+        build_hash = self.build_hash()
+        if build_hash is not None and build_hash == self.cached_hash():
+            log.info('build of {} is up to date'.format(self.path))
+            return True
+
+        log.info('building {}: {}'.format(self.path, self.command))
+        try:
+            returncode = subprocess.call(
+                self.command, cwd=self.path,
+                shell=not isinstance(self.command, list),
+            )
+        except OSError:
+            log.error('build of {} failed'.format(self.path), exc_info=True)
+            return False
+        if returncode != 0:
+            log.error('build of {} failed with code {}'
+                      ''.format(self.path, returncode))
+            return False
+
+        log.info('build of {} done'.format(self.path))
+
+        build_hash = self.build_hash()
+        if build_hash is None:
+            log.warning('build of {} did not create {}'
+                        ''.format(self.path, self.output))
+            return True
+        try:
+            with open(os.path.join(self.path, self.cache_file), 'w') as f:
+                f.write(build_hash)
+        except (IOError, OSError):
+            log.warning('could not store the build hash of {}'
+                        ''.format(self.path), exc_info=True)
+        return True
+
+    def start(self):
+        """Run the build on the thread pool.
+
+        :returns: resolves to whether the build succeeded
+        :rtype: tornado.concurrent.Future
+        """
+        future = tornado.concurrent.Future()
+        tornado.concurrent.chain_future(
+            KernelBuild.executor.submit(self.run), future)
+        return future
@@ -0,0 +1,586 @@
+"""Language kernel processes connected over ZMQ."""
+
+from __future__ import absolute_import, unicode_literals, division
+
+from . import utils
+import atexit
+import functools
+import logging
+import os
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import zmq
+import zmq.eventloop.zmqstream
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+#: names of the resource limits that can be applied to kernel processes
+RLIMITS = ('address_space', 'cpu_time')
+
+
+# sets the limits given as NAME=VALUE arguments before "--" and then
+# executes the command after it in the same process
+_RLIMITS_SCRIPT = (
+    'import os, resource, sys\n'
+    'i = sys.argv.index("--")\n'
+    'for arg in sys.argv[1:i]:\n'
+    '    name, value = arg.split("=")\n'
+    '    resource.setrlimit(getattr(resource, name), '
+    '(int(value), int(value)))\n'
+    'os.execvp(sys.argv[i + 1], sys.argv[i + 1:])\n'
+)
+
+
+def _with_rlimits(args, limits):
+    """Command that applies resource limits and then executes ``args``.
+
+    The limits are set in a wrapper process that replaces itself with the
+    command, so the kernel runs with the limits from its first instruction
+    and has the process id that ``Popen`` returns. Unlike a ``preexec_fn``,
+    this is safe when the server runs threads.
+    """
+    names = {'address_space': 'RLIMIT_AS', 'cpu_time': 'RLIMIT_CPU'}
+    return ([sys.executable, '-c', _RLIMITS_SCRIPT] +
+            ['{}={}'.format(names[name], int(value))
+             for name, value in sorted(limits.items())] +
+            ['--'] + list(args))
+
+
+def process_usage(pid):
+    """Resident memory and CPU time of a process.
+
+    Read from ``/proc`` and not available on other platforms.
+
+    :param int pid: process id
+    :returns: resident set size in bytes and user plus system CPU time in
+        seconds, or ``(None, None)``
+    :rtype: tuple
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the command name in parentheses can contain spaces
+            fields = f.read().rpartition(')')[2].split()
+        with open('/proc/{}/statm'.format(pid)) as f:
+            resident_pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+    rss = resident_pages * os.sysconf('SC_PAGE_SIZE')
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return rss, cpu
+
+
+class KernelRouter(object):
+    """The ZMQ transport to all language kernels.
+
+    A single ROUTER socket in the shared ZMQ context. Kernels connect with a
+    DEALER socket and use their kernel id as identity, so messages are
+    routed to exactly one kernel and messages from kernels are dispatched
+    by their identity.
+
+    With the ``ipc`` transport, the socket is a Unix domain socket in a
+    new runtime directory that is removed on exit.
+
+    :param int port: bind to this port or a random port if not given
+    :param str transport: ``tcp`` or ``ipc``
+    """
+
+    #: kernels are started per analysis id and do not acknowledge disconnects
+    legacy = False
+
+    def __init__(self, port=None, transport='tcp'):
+        self.kernels = {}
+        self.runtime_dir = None
+
+        self.zmq_socket = zmq.Context.instance().socket(zmq.ROUTER)
+        # a restarted kernel can take over the identity of an old one
+        self.zmq_socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        if transport == 'ipc':
+            self.runtime_dir = tempfile.mkdtemp(prefix='databench-')
+            atexit.register(shutil.rmtree, self.runtime_dir, True)
+            self.endpoint = 'ipc://{}'.format(
+                os.path.join(self.runtime_dir, 'kernels'))
+            self.zmq_socket.bind(self.endpoint)
+        elif transport == 'tcp':
+            if port is None:
+                port = self.zmq_socket.bind_to_random_port(
+                    'tcp://127.0.0.1', min_port=6000,
+                )
+            else:
+                self.zmq_socket.bind('tcp://127.0.0.1:{}'.format(port))
+            self.endpoint = 'tcp://127.0.0.1:{}'.format(port)
+        else:
+            raise ValueError('unknown transport {}'.format(transport))
+        self.port = port
+        log.debug('main routing on {}'.format(self.endpoint))
+
+        self.zmq_stream = zmq.eventloop.zmqstream.ZMQStream(
+            self.zmq_socket,
+            tornado.ioloop.IOLoop.current(),
+        )
+        self.zmq_stream.on_recv(self.zmq_listener, copy=False)
+
+    def kernel_args(self, kernel):
+        """The endpoint is part of the kernel executable."""
+        return []
+
+    def register(self, kernel):
+        self.kernels[kernel.kernel_id] = kernel
+
+    def unregister(self, kernel):
+        if self.kernels.get(kernel.kernel_id) is kernel:
+            del self.kernels[kernel.kernel_id]
+
+    def send(self, kernel_id, data):
+        self.zmq_stream.send_multipart([
+            kernel_id.encode('utf-8'),
+            utils.dumps(data).encode('utf-8'),
+        ])
+
+    def zmq_listener(self, multipart):
+        # frames are received without a copy, only the identity and the
+        # header are copied
+        identity = multipart[0].bytes.decode('utf-8')
+        kernel = self.kernels.get(identity)
+        if kernel is None:
+            log.debug('message from unknown kernel {}'.format(identity))
+            return
+        kernel.zmq_listener([multipart[1].bytes] +
+                            [frame.buffer for frame in multipart[2:]])
+
+    def close(self):
+        self.zmq_stream.close()
+        if self.runtime_dir is not None:
+            shutil.rmtree(self.runtime_dir, True)
+
+
+class KernelPubSub(object):
+    """The legacy PUB/SUB transport for kernels that do not connect to a
+    :class:`KernelRouter`, like the Go kernels of ``databench_go``.
+
+    Messages to kernels are published on one PUB socket with the analysis id
+    as topic. Every kernel publishes to a SUB socket of its own that is
+    bound when the kernel is registered. Legacy kernels are started for one
+    analysis id and do not acknowledge disconnects. Only the ``tcp``
+    transport on localhost is supported.
+
+    The messages of legacy kernels are converted to the headers and frames
+    that :class:`KernelZMQ` receives from a :class:`KernelRouter`.
+    """
+
+    #: kernels are started per analysis id and do not acknowledge disconnects
+    legacy = True
+
+    def __init__(self):
+        self.kernels = {}
+        self.subscribers = {}
+
+        self.zmq_socket = zmq.Context.instance().socket(zmq.PUB)
+        self.port = self.zmq_socket.bind_to_random_port(
+            'tcp://127.0.0.1', min_port=3000, max_port=9000,
+        )
+        log.debug('main publishing on port {}'.format(self.port))
+        self.zmq_stream = zmq.eventloop.zmqstream.ZMQStream(
+            self.zmq_socket,
+            tornado.ioloop.IOLoop.current(),
+        )
+
+    def kernel_args(self, kernel):
+        return ['--zmq-subscribe={}'.format(self.port),
+                '--zmq-publish={}'.format(
+                    self.subscribers[kernel.kernel_id][1])]
+
+    def register(self, kernel):
+        self.unregister(self.kernels.get(kernel.kernel_id))
+        self.kernels[kernel.kernel_id] = kernel
+
+        zmq_socket = zmq.Context.instance().socket(zmq.SUB)
+        zmq_socket.setsockopt(zmq.SUBSCRIBE, b'')
+        port = zmq_socket.bind_to_random_port(
+            'tcp://127.0.0.1', min_port=3000, max_port=9000,
+        )
+        stream = zmq.eventloop.zmqstream.ZMQStream(
+            zmq_socket,
+            tornado.ioloop.IOLoop.current(),
+        )
+        stream.on_recv(functools.partial(self.zmq_listener, kernel))
+        self.subscribers[kernel.kernel_id] = (stream, port)
+
+    def unregister(self, kernel):
+        if kernel is None or self.kernels.get(kernel.kernel_id) is not kernel:
+            return
+        del self.kernels[kernel.kernel_id]
+        stream, _ = self.subscribers.pop(kernel.kernel_id)
+        stream.close()
+
+    def send(self, kernel_id, data):
+        self.zmq_stream.send('{}|{}'.format(
+            kernel_id, utils.dumps(data)).encode('utf-8'))
+
+    def zmq_listener(self, kernel, multipart):
+        data = b''.join(multipart)
+        msg = utils.loads(data.decode('utf-8'))
+        if 'frame' not in msg:
+            kernel.zmq_listener([data])
+            return
+
+        frame, binary = utils.encode_frame(msg['frame'])
+        header = {'analysis_id': msg.get('analysis_id'),
+                  'signal': msg['frame'].get('signal')}
+        if binary:
+            header['binary'] = True
+        kernel.zmq_listener([utils.dumps(header).encode('utf-8'), frame])
+
+    def close(self):
+        for kernel in list(self.kernels.values()):
+            self.unregister(kernel)
+        self.zmq_stream.close()
+
+
+class KernelZMQ(object):
+    """A language kernel process and its ZMQ connection.
+
+    Without an analysis id, the kernel is started for a pool: it imports
+    the analysis code, completes the handshake and then waits to be
+    assigned to an analysis instance with :meth:`assign`.
+
+    A multiplexed kernel hosts many analysis instances. It creates an
+    instance for every analysis id it receives messages for and stays
+    running when instances are released.
+
+    The kernel starts with a handshake. The ROUTER socket can only address
+    the kernel once it is connected, so messages sent before the handshake
+    are buffered and sent in order once it arrives. The :attr:`ready`
+    future resolves at that point.
+
+    A kernel process that exited can be started again with
+    :meth:`restart`. The new process has the same identity and the assigned
+    analysis instances replay their initialization. A kernel that was
+    reaped with :meth:`reap` is restarted by the next message sent to it.
+
+    The kernel acknowledges the ``disconnected`` action of an analysis
+    instance once it has sent its last messages for it. A kernel that is not
+    multiplexed then exits by itself. :meth:`shutdown` waits for that
+    without blocking the IOLoop and terminates and then kills kernels that
+    do not exit in time.
+
+    :param list executable: command to start the kernel
+    :param router: transport to the kernels, a :class:`KernelRouter` or a
+        :class:`KernelPubSub` for legacy kernels
+    :param str analysis_id: start the kernel for this analysis id
+    :param bool multiplex: start a multiplexed kernel
+    :param dict limits:
+        resource limits for the kernel process: ``address_space`` in bytes
+        and ``cpu_time`` in seconds. Only applied on Unix.
+    """
+
+    #: seconds to wait for a kernel to acknowledge a disconnect and exit
+    shutdown_timeout = 2.0
+
+    #: seconds to wait for a terminated kernel before killing it
+    kill_timeout = 1.0
+
+    #: seconds a legacy kernel is given to process the ``disconnected``
+    #: action as it does not acknowledge it
+    legacy_disconnect_delay = 0.1
+
+    def __init__(self, executable, router, analysis_id=None,
+                 multiplex=False, limits=None):
+        if router.legacy and (analysis_id is None or multiplex):
+            raise ValueError('legacy kernels are started for one analysis id')
+        self.executable = executable
+        self.router = router
+        self.analysis_id = analysis_id
+        self.multiplex = multiplex
+        self.limits = {k: v for k, v in (limits or {}).items()
+                       if v is not None}
+        for name in self.limits:
+            if name not in RLIMITS:
+                raise ValueError('unknown resource limit {}'.format(name))
+        self.kernel_id = analysis_id or KernelZMQ.__create_id()
+        self.handshake = False
+        self.ready = tornado.concurrent.Future()
+        self.pending = []
+        self.pooled = analysis_id is None and not multiplex
+        self.analyses = {}
+        self.disconnects = {}
+        self.process = None
+        self.closed = False
+        self.reaped = False
+        self.crashes = 0
+        self.last_activity = time.time()
+
+        self.start()
+
+    @staticmethod
+    def __create_id():
+        return 'k' + ''.join(random.choice(string.ascii_letters +
+                                           string.digits)
+                             for _ in range(8))
+
+    def start(self):
+        """Register with the router and launch the kernel process."""
+        self.router.register(self)
+
+        if self.multiplex:
+            id_args = ['--kernel-id={}'.format(self.kernel_id), '--multiplex']
+        elif self.pooled:
+            id_args = ['--kernel-id={}'.format(self.kernel_id)]
+        else:
+            id_args = ['--analysis-id={}'.format(self.analysis_id)]
+        e_params = self.executable + id_args + self.router.kernel_args(self)
+        log.debug('launching: {}'.format(e_params))
+        if self.limits:
+            if resource is not None:
+                e_params = _with_rlimits(e_params, self.limits)
+            else:
+                log.warning('resource limits are not supported on this '
+                            'platform')
+        try:
+            self.process = subprocess.Popen(
+                e_params, shell=False,
+                env=dict(os.environ,
+                         DATABENCH_SERIALIZER=utils.serializer.name),
+            )
+        except OSError:
+            self.close()
+            raise
+        self.last_activity = time.time()
+
+    def restart(self):
+        """Start a new kernel process with the same identity.
+
+        Messages that were not delivered to the old process are dropped.
+        The assigned analysis instances replay their initialization.
+        """
+        log.info('restarting kernel {}'.format(self.kernel_id))
+        self.terminate()
+        self.reaped = False
+        self.handshake = False
+        self.pending = []
+        if self.ready.done():
+            self.ready = tornado.concurrent.Future()
+        if self.pooled and self.analysis_id is not None:
+            self.pending.append({'__assign': self.analysis_id})
+        self.start()
+        for analysis in list(self.analyses.values()):
+            analysis.on_kernel_restart()
+
+    def reap(self):
+        """Terminate an idle kernel process.
+
+        The kernel stays assigned and is restarted when it is sent the next
+        message.
+        """
+        log.info('reaping idle kernel {}'.format(self.kernel_id))
+        self.terminate()
+        self.reaped = True
+        self.handshake = False
+        if self.ready.done():
+            self.ready = tornado.concurrent.Future()
+
+    def wake(self):
+        """Restart the kernel if it was reaped."""
+        if self.reaped and not self.closed:
+            self.restart()
+
+    def alive(self):
+        """Whether the kernel process is running."""
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def load(self):
+        """Number of analysis instances assigned to this kernel."""
+        return len(self.analyses)
+
+    def idle(self):
+        """Seconds since the last message to or from the kernel."""
+        return time.time() - self.last_activity
+
+    def stats(self):
+        """Resource usage of the kernel process.
+
+        ``rss`` is the resident memory in bytes and ``cpu`` the CPU time in
+        seconds. Both are ``None`` when the process is not running or the
+        platform does not provide them.
+
+        :rtype: dict
+        """
+        rss, cpu = None, None
+        if self.alive():
+            rss, cpu = process_usage(self.process.pid)
+        return {
+            'kernel_id': self.kernel_id,
+            'pid': self.process.pid if self.process is not None else None,
+            'alive': self.alive(),
+            'reaped': self.reaped,
+            'analyses': self.load,
+            'idle': self.idle(),
+            'crashes': self.crashes,
+            'rss': rss,
+            'cpu': cpu,
+        }
+
+    def assign(self, analysis):
+        """Assign this kernel to an analysis instance.
+
+        :param AnalysisZMQ analysis:
+            receives the messages from the kernel for its id
+        """
+        self.analyses[analysis.id_] = analysis
+        if self.pooled and self.analysis_id is None:
+            self.analysis_id = analysis.id_
+            self.send({'__assign': analysis.id_})
+        log.debug('kernel {} assigned to {}'.format(self.kernel_id,
+                                                    analysis.id_))
+
+    def disconnected(self, analysis_id):
+        """A future that resolves when the kernel acknowledges the
+        ``disconnected`` action of an analysis instance.
+
+        Call before sending the action.
+
+        :param str analysis_id: id of the analysis instance
+        :rtype: tornado.concurrent.Future
+        """
+        if analysis_id not in self.disconnects:
+            future = tornado.concurrent.Future()
+            self.disconnects[analysis_id] = future
+            if self.router.legacy:
+                tornado.ioloop.IOLoop.current().call_later(
+                    self.legacy_disconnect_delay,
+                    lambda: future.done() or future.set_result(None))
+        return self.disconnects[analysis_id]
+
+    @tornado.gen.coroutine
+    def release(self, analysis_id):
+        """Release an analysis instance.
+
+        Shuts the kernel down unless it is multiplexed.
+
+        :param str analysis_id: id of the analysis instance
+        """
+        self.analyses.pop(analysis_id, None)
+        self.disconnects.pop(analysis_id, None)
+        if not self.multiplex:
+            yield self.shutdown()
+
+    def send(self, data):
+        """Send a message to the kernel or buffer it until the handshake
+        is complete."""
+        self.wake()
+        self.last_activity = time.time()
+        if not self.handshake:
+            self.pending.append(data)
+            return
+        self.router.send(self.kernel_id, data)
+
+    def on_handshake(self):
+        self.handshake = True
+        pending, self.pending = self.pending, []
+        for data in pending:
+            self.router.send(self.kernel_id, data)
+        if not self.ready.done():
+            self.ready.set_result(None)
+        log.debug('kernel {} ready'.format(self.kernel_id))
+
+    def zmq_listener(self, multipart):
+        self.last_activity = time.time()
+        msg = utils.loads(multipart[0])
+
+        if '__zmq_handshake' in msg:
+            if self.router.legacy:
+                # legacy kernels repeat the handshake until it is answered
+                self.router.send(self.kernel_id, {'__zmq_ack': None})
+            if not self.handshake:
+                self.on_handshake()
+            return
+
+        if '__zmq_disconnected' in msg:
+            future = self.disconnects.get(msg['__zmq_disconnected'])
+            if future is not None and not future.done():
+                future.set_result(None)
+            return
+
+        if 'batch' in msg:
+            i = 1
+            for header in msg['batch']:
+                self.dispatch(header, multipart[i:i + header['frames']])
+                i += header['frames']
+            return
+
+        self.dispatch(msg, multipart[1:])
+
+    def dispatch(self, header, frames):
+        analysis = self.analyses.get(header.get('analysis_id'))
+        if analysis is not None:
+            analysis.zmq_listener(header, frames)
+
+    def terminate(self):
+        """Terminate the kernel process."""
+        log.debug('terminating kernel process {}'.format(self.kernel_id))
+        if self.process is not None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+
+    @tornado.gen.coroutine
+    def wait(self, timeout):
+        """Wait for the kernel process to exit.
+
+        :param float timeout: seconds
+        :returns: whether the process exited
+        :rtype: tornado.concurrent.Future
+        """
+        deadline = time.time() + timeout
+        while self.process is not None and self.process.poll() is None:
+            if time.time() > deadline:
+                raise tornado.gen.Return(False)
+            yield tornado.gen.sleep(0.02)
+        raise tornado.gen.Return(True)
+
+    @tornado.gen.coroutine
+    def shutdown(self):
+        """Wait for the kernel process to exit, terminate it after
+        :attr:`shutdown_timeout` and kill it after another
+        :attr:`kill_timeout`. Then unregister it."""
+        self.closed = True
+        # legacy kernels do not exit by themselves
+        timeout = 0.0 if self.router.legacy else self.shutdown_timeout
+        if not (yield self.wait(timeout)):
+            if not self.router.legacy:
+                log.warning('kernel {} did not exit, terminating'
+                            ''.format(self.kernel_id))
+            self.terminate()
+            if not (yield self.wait(self.kill_timeout)):
+                log.warning('kernel {} did not terminate, killing'
+                            ''.format(self.kernel_id))
+                try:
+                    self.process.kill()
+                except OSError:
+                    pass
+                yield self.wait(self.kill_timeout)
+        self.close()
+
+    def close(self):
+        """Terminate the kernel process and unregister it."""
+        self.closed = True
+        self.terminate()
+        self.router.unregister(self)
+        self.handshake = False
+        self.pending = []
+        if not self.ready.done():
+            self.ready.set_result(None)
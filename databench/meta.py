@@ -3,16 +3,17 @@
 from __future__ import absolute_import, unicode_literals, division
 
 from . import __version__ as DATABENCH_VERSION
-from .analysis import ActionHandler
+from .analysis import ActionHandler, valid_revisions
 from .readme import Readme
-from .utils import json_encoder_default
+from .utils import EncodedFrame, encode_frame, loads
 from collections import defaultdict
 import functools
 import glob
-import json
 import logging
 import os
+import tornado.autoreload
 import tornado.gen
+import tornado.ioloop
 import tornado.web
 import tornado.websocket
 
@@ -34,14 +35,18 @@ class Meta(object):
     :param str analysis_path: Path of the analysis class.
     :param list extra_routes: [(route, handler, data), ...]
     :param list cli_args: Arguments from the command line.
+    :param dict executors: :class:`.ActionExecutor` instances by kind for
+        action handlers that run on a pool. Shared pools are used by default.
     """
 
     def __init__(self, name, analysis_class, analysis_path, extra_routes=None,
-                 cli_args=None, main_template='index.html', info=None):
+                 cli_args=None, main_template='index.html', info=None,
+                 executors=None):
         self.name = name
         self.analysis_class = analysis_class
         self.analysis_path = analysis_path
         self.cli_args = cli_args if cli_args is not None else []
+        self.executors = executors
 
         # detect whether a thumbnail image is present
         thumbnail = False
@@ -169,6 +174,7 @@ class Meta(object):
 
 
 class FrontendHandler(tornado.websocket.WebSocketHandler):
+    open_handlers = set()
 
     def initialize(self, meta):
         self.meta = meta
@@ -176,7 +182,12 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
         self.ping_callback = tornado.ioloop.PeriodicCallback(self.do_ping,
                                                              PING_INTERVAL)
         self.ping_callback.start()
-        tornado.autoreload.add_reload_hook(self.on_close)
+
+    @staticmethod
+    def close_all():
+        """Close all open handlers (before an autoreload)."""
+        for handler in list(FrontendHandler.open_handlers):
+            handler.on_close()
 
     def do_ping(self):
         if self.ws_connection is None:
@@ -186,11 +197,18 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
 
     def open(self):
         log.debug('WebSocket connection opened.')
+        FrontendHandler.open_handlers.add(self)
 
     @tornado.gen.coroutine
     def on_close(self):
+        if self not in FrontendHandler.open_handlers:
+            return
+        FrontendHandler.open_handlers.remove(self)
+
         log.debug('WebSocket connection closed.')
         yield self.meta.run_process(self.analysis, 'disconnected')
+        if self.analysis is not None:
+            self.analysis.close_datastores()
 
     @tornado.gen.coroutine
     def on_message(self, message):
@@ -198,7 +216,7 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
             log.debug('empty message received.')
             return
 
-        msg = json.loads(message)
+        msg = loads(message)
         if '__connect' in msg:
             if self.analysis is not None:
                 log.error('Connection already has an analysis. Abort.')
@@ -209,6 +227,8 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
             self.analysis = self.meta.analysis_class()
             self.analysis.init_databench(requested_id)
             self.analysis.set_emit_fn(self.emit)
+            if self.meta.executors is not None:
+                self.analysis.executors = self.meta.executors
             log.info('Analysis {} instanciated.'.format(self.analysis.id_))
             yield self.emit('__connect', {
                 'analysis_id': self.analysis.id_,
@@ -216,6 +236,14 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
                 'analyses_version': self.meta.info['version'],
             })
 
+            # reconnect: only send what the frontend missed
+            if requested_id == self.analysis.id_ and \
+               msg.get('__revisions') and \
+               valid_revisions(msg['__revisions']):
+                yield self.analysis.resync(msg['__revisions'])
+            else:
+                yield self.analysis.emit_snapshot()
+
             yield self.meta.run_process(self.analysis, 'connect')
 
             args = {'cli_args': self.meta.cli_args, 'request_args': {}}
@@ -232,6 +260,11 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
             log.warning('no analysis connected. Abort.')
             return
 
+        # the frontend lost track of the state, e.g. a patch without value
+        if '__resync' in msg:
+            yield self.analysis.emit_snapshot(force=True)
+            return
+
         if 'signal' not in msg:
             log.info('message not processed: {}'.format(message))
             return
@@ -244,17 +277,27 @@ class FrontendHandler(tornado.websocket.WebSocketHandler):
                                         msg['signal'], msg['load'])
 
     def emit(self, signal, message='__nomessagetoken__'):
-        data = {'signal': signal}
-        if message != '__nomessagetoken__':
-            data['load'] = message
-
+        if isinstance(message, EncodedFrame):
+            # encoded in the language kernel
+            frame, binary = message.frame, message.binary
+        else:
+            data = {'signal': signal}
+            if message != '__nomessagetoken__':
+                data['load'] = message
+            if getattr(message, 'revision', None) is not None:
+                data['revision'] = message.revision
+
+            binary_arrays = getattr(self.analysis, 'binary_arrays', False)
+            frame, binary = encode_frame(data, binary=binary_arrays)
         try:
-            return self.write_message(
-                json.dumps(data, default=json_encoder_default).encode('utf-8'))
+            return self.write_message(frame, binary=binary)
         except tornado.websocket.WebSocketClosedError:
             pass
 
 
+tornado.autoreload.add_reload_hook(FrontendHandler.close_all)
+
+
 class RenderTemplate(tornado.web.RequestHandler):
     def initialize(self, info, path, template_name=None):
         self.info = info
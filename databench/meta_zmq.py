@@ -1,7 +1,13 @@
+import atexit
+import datetime
 import logging
+import tornado.autoreload
 import tornado.gen
+import tornado.ioloop
 
 from .analysis_zmq import AnalysisZMQ
+from .kernel_build import KernelBuild
+from .kernel_zmq import KernelZMQ
 from .meta import Meta
 
 log = logging.getLogger(__name__)
@@ -13,15 +19,250 @@ class MetaZMQ(Meta):
     The entire ZMQ interface of Databench is defined here and in
     :class`AnalysisZMQ`.
 
+    :param router: transport to the kernels, a :class:`.KernelRouter` or a
+        :class:`.KernelPubSub` for legacy kernels that are started for one
+        analysis instance each
+
+    :param int kernel_pool:
+        Number of pre-started kernels to keep ready for new connections.
+        Pooled kernels have already imported the analysis code and are
+        assigned an analysis id when a frontend connects.
+    :param int kernel_processes:
+        Number of multiplexed kernel processes that host all instances of
+        this analysis. With the default of zero, every connection starts its
+        own kernel process.
+    :param float kernel_max_memory:
+        Maximum address space of a kernel process in MB.
+    :param float kernel_max_cpu:
+        Maximum CPU time of a kernel process in seconds. The limit applies
+        to the lifetime of the process which for multiplexed kernels spans
+        many connections.
+    :param float kernel_idle_timeout:
+        Terminate assigned kernels without messages for this many seconds.
+        They are restarted on the next message from the frontend and the
+        analysis instances replay their initialization.
+    :param kernel_build:
+        Command that builds the kernel in the analysis directory, see
+        :class:`KernelBuild`. Kernels are started once the build succeeded
+        and :attr:`ready` is true.
+
+    Kernels are supervised while they run. A kernel process that exits while
+    analysis instances are assigned to it is restarted up to
+    :attr:`max_restarts` times before the instances are sent an error.
     """
 
-    def __init__(self, name, executable, zmq_publish,
-                 analysis_path, extra_routes, cmd_args=None):
+    instances = []
+
+    #: restarts of a crashed kernel before giving up
+    max_restarts = 3
+
+    #: interval in seconds between checks of the kernel processes
+    supervise_interval = 1.0
+
+    def __init__(self, name, executable, router,
+                 analysis_path, extra_routes, cmd_args=None, kernel_pool=0,
+                 kernel_processes=0, kernel_max_memory=None,
+                 kernel_max_cpu=None, kernel_idle_timeout=None,
+                 kernel_build=None):
         super(MetaZMQ, self).__init__(name, AnalysisZMQ,
                                       analysis_path, extra_routes, cmd_args)
 
+        if router.legacy and (kernel_pool or kernel_processes):
+            log.warning('legacy kernels of {} cannot be pooled or '
+                        'multiplexed'.format(name))
+            kernel_pool, kernel_processes = 0, 0
+
         self.executable = executable
-        self.zmq_publish = zmq_publish
+        self.router = router
+        self.kernel_pool = kernel_pool
+        self.kernel_processes = kernel_processes
+        self.kernel_limits = {
+            'address_space': (int(kernel_max_memory * 1024 * 1024)
+                              if kernel_max_memory else None),
+            'cpu_time': int(kernel_max_cpu) if kernel_max_cpu else None,
+        }
+        self.kernel_idle_timeout = kernel_idle_timeout
+        self.pool = []
+        self.kernels = []
+        self.assigned = []
+        self.supervisor = None
+
+        self.build = None
+
+        MetaZMQ.instances.append(self)
+        if kernel_build is not None:
+            self.build = KernelBuild(kernel_build, analysis_path,
+                                     output=executable[0]).start()
+            tornado.ioloop.IOLoop.current().add_future(
+                self.build, lambda _: self.start_background_kernels())
+        else:
+            tornado.ioloop.IOLoop.current().add_callback(
+                self.start_background_kernels)
+
+    @property
+    def ready(self):
+        """Whether the kernel build succeeded or there is none."""
+        if self.build is None:
+            return True
+        return self.build.done() and self.build.exception() is None and \
+            self.build.result()
+
+    def start_background_kernels(self):
+        """Start the multiplexed kernels or fill the pool."""
+        if not self.ready:
+            return
+        if self.kernel_processes:
+            self.start_kernels()
+        elif self.kernel_pool:
+            self.fill_pool()
+
+    def start_kernel(self, analysis_id=None, multiplex=False):
+        """Start a supervised kernel process.
+
+        :param str analysis_id: start the kernel for this analysis id
+        :param bool multiplex: start a multiplexed kernel
+        :rtype: KernelZMQ
+        """
+        kernel = KernelZMQ(self.executable, self.router,
+                           analysis_id=analysis_id, multiplex=multiplex,
+                           limits=self.kernel_limits)
+        if self.supervisor is None:
+            self.supervisor = tornado.ioloop.PeriodicCallback(
+                self.supervise, self.supervise_interval * 1000.0)
+            self.supervisor.start()
+        return kernel
+
+    def supervise(self):
+        """Restart crashed kernels and reap idle ones."""
+        self.assigned = [k for k in self.assigned if not k.closed]
+        for kernel in self.assigned + self.kernels:
+            if kernel.reaped or kernel.closed:
+                continue
+            if not kernel.alive():
+                self.on_kernel_exit(kernel)
+            elif self.kernel_idle_timeout and kernel.handshake and \
+                    kernel.analyses and \
+                    kernel.idle() > self.kernel_idle_timeout:
+                kernel.reap()
+
+    def on_kernel_exit(self, kernel):
+        """Restart a kernel process that exited unexpectedly.
+
+        :param KernelZMQ kernel: the kernel
+        """
+        log.warning('kernel {} for {} exited with code {}'
+                    ''.format(kernel.kernel_id, self.name,
+                              kernel.process.returncode))
+        kernel.crashes += 1
+        if kernel.crashes > self.max_restarts:
+            log.error('kernel {} for {} crashed {} times, giving up'
+                      ''.format(kernel.kernel_id, self.name, kernel.crashes))
+            for analysis in list(kernel.analyses.values()):
+                analysis.emit('error', 'kernel crashed')
+            kernel.close()
+            if kernel in self.kernels:
+                self.kernels.remove(kernel)
+            return
+
+        try:
+            kernel.restart()
+        except OSError:
+            log.warning('could not restart kernel for {}'.format(self.name),
+                        exc_info=True)
+            return
+        for analysis in kernel.analyses.values():
+            analysis.emit('warn', 'kernel restarted')
+
+    def kernel_stats(self):
+        """Resource usage of all kernel processes of this analysis.
+
+        :rtype: list
+        """
+        self.assigned = [k for k in self.assigned if not k.closed]
+        return [dict(k.stats(), pooled=k in self.pool)
+                for k in self.assigned + self.kernels + self.pool]
+
+    def fill_pool(self):
+        """Start kernels until the pool has the configured size."""
+        for kernel in self.pool:
+            if not kernel.alive():
+                # unregister it from the router
+                kernel.close()
+        self.pool = [k for k in self.pool if k.alive()]
+        while len(self.pool) < self.kernel_pool:
+            try:
+                kernel = self.start_kernel()
+            except OSError:
+                log.warning('could not start kernel for {}'.format(self.name),
+                            exc_info=True)
+                break
+            self.pool.append(kernel)
+        log.debug('kernel pool for {} has {} kernels'
+                  ''.format(self.name, len(self.pool)))
+
+    def start_kernels(self):
+        """Start multiplexed kernels and restart the ones that exited."""
+        for kernel in self.kernels:
+            if not kernel.alive() and not kernel.reaped:
+                self.on_kernel_exit(kernel)
+        while len(self.kernels) < self.kernel_processes:
+            try:
+                kernel = self.start_kernel(multiplex=True)
+            except OSError:
+                log.warning('could not start kernel for {}'.format(self.name),
+                            exc_info=True)
+                break
+            self.kernels.append(kernel)
+
+    def close_kernels(self):
+        """Terminate all unassigned and multiplexed kernels."""
+        for kernel in self.pool + self.kernels:
+            kernel.close()
+        self.pool = []
+        self.kernels = []
+        if self.supervisor is not None:
+            self.supervisor.stop()
+            self.supervisor = None
+
+    @staticmethod
+    def close_all_kernels():
+        for meta in MetaZMQ.instances:
+            meta.close_kernels()
+
+    @staticmethod
+    def terminate_all_kernels():
+        """Terminate all kernel processes at interpreter exit."""
+        for meta in MetaZMQ.instances:
+            for kernel in meta.pool + meta.kernels + meta.assigned:
+                kernel.terminate()
+
+    def kernel(self, analysis_id):
+        """A kernel for a new analysis instance.
+
+        This is the least loaded multiplexed kernel, a kernel from the pool
+        or a newly started one.
+
+        :param str analysis_id: id of the analysis instance
+        :rtype: KernelZMQ
+        """
+        if self.kernel_processes:
+            self.start_kernels()
+            if self.kernels:
+                return min(self.kernels, key=lambda k: k.load)
+
+        while self.pool:
+            kernel = self.pool.pop(0)
+            if kernel.alive():
+                break
+            kernel.close()
+        else:
+            kernel = self.start_kernel(analysis_id=analysis_id)
+        self.assigned.append(kernel)
+
+        # replenish the pool in the background
+        if self.kernel_pool:
+            tornado.ioloop.IOLoop.current().add_callback(self.fill_pool)
+        return kernel
 
     @tornado.gen.coroutine
     def run_process(self, analysis, action_name, message='__nomessagetoken__'):
@@ -31,16 +272,46 @@ class MetaZMQ(Meta):
         is given.
         """
 
+        if not self.ready:
+            try:
+                yield self.build
+            except Exception:
+                log.error('kernel build for {} failed'.format(self.name),
+                          exc_info=True)
+            if not self.ready:
+                if action_name == 'connect':
+                    analysis.emit('error', 'kernel build failed')
+                return
+
         if action_name == 'connect':
-            analysis.on_connect(self.executable, self.zmq_publish)
+            analysis.on_connect(self.kernel(analysis.id_))
+
+        kernel = analysis.kernel
+        if action_name == 'disconnected' and kernel.reaped:
+            # nothing to tell a kernel that is not running
+            yield analysis.on_disconnected()
+            return
 
-        while not analysis.zmq_handshake:
-            yield tornado.gen.sleep(0.1)
+        kernel.wake()
+        yield kernel.ready
+
+        if action_name == 'disconnected':
+            disconnected = kernel.disconnected(analysis.id_)
 
         log.debug('sending action {}'.format(action_name))
         analysis.zmq_send({'signal': action_name, 'load': message})
 
         if action_name == 'disconnected':
-            # Give kernel time to process disconnected message.
-            yield tornado.gen.sleep(0.1)
-            analysis.on_disconnected()
+            # the kernel sends its last messages before the acknowledgement
+            try:
+                yield tornado.gen.with_timeout(
+                    datetime.timedelta(seconds=kernel.shutdown_timeout),
+                    disconnected)
+            except tornado.gen.TimeoutError:
+                log.warning('kernel {} did not acknowledge disconnect of {}'
+                            ''.format(kernel.kernel_id, analysis.id_))
+            yield analysis.on_disconnected()
+
+
+atexit.register(MetaZMQ.terminate_all_kernels)
+tornado.autoreload.add_reload_hook(MetaZMQ.close_all_kernels)
@@ -1,4 +1,5 @@
 from .meta import Meta
+from .utils import resolve_raw_json
 
 
 class AnalysisTest(object):
@@ -42,12 +43,13 @@ class AnalysisTest(object):
         # initialize
         self.analysis_instance.init_databench()
         self.analysis_instance.set_emit_fn(self.emulate_emit_to_frontend)
+        self.analysis_instance.emit_snapshot()
         self.trigger('connect')
         self.trigger('args', [cli_args, request_args])
         self.trigger('connected')
 
     def emulate_emit_to_frontend(self, signal, message):
-        self.emitted_messages.append((signal, message))
+        self.emitted_messages.append((signal, resolve_raw_json(message)))
 
     def trigger(self, action_name, message='__nomessagetoken__', **kwargs):
         """Trigger an `on` callback.
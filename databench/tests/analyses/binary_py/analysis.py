@@ -0,0 +1,31 @@
+import databench
+import databench_py.singlethread
+import numpy as np
+
+
+class Binary_Py(databench.Analysis):
+    binary_arrays = True
+
+    @databench.on
+    def image(self, width, height):
+        """Emit an image as a binary array."""
+        image = np.arange(width * height, dtype='float32')
+        yield self.emit('image', {'image': image.reshape(height, width)})
+
+    @databench.on
+    def raw(self, size):
+        """Emit bytes."""
+        yield self.emit('raw', bytes(bytearray(range(256))) * (size // 256))
+
+    @databench.on
+    def burst(self, n):
+        """Emit arrays and text without yielding to the event loop."""
+        for i in range(n):
+            a = np.full(i % 8, i % 256, dtype='uint8')
+            self.emit('burst', {'i': i, 'a': a})
+            self.emit('burst', {'i': i})
+
+
+if __name__ == "__main__":
+    analysis = databench_py.singlethread.Meta('binary_py', Binary_Py)
+    analysis.event_loop()
@@ -29,6 +29,12 @@ class Parameters_Py(databench.Analysis):
         """Store key-value in class data."""
         yield self.class_data.set(key, value)
 
+    @databench.on
+    def test_domains(self):
+        """Emit the datastore domains held by the kernel."""
+        yield self.emit('test_domains',
+                        sorted(databench.Datastore.global_data))
+
 
 if __name__ == "__main__":
     analysis = databench_py.singlethread.Meta('parameters_py', Parameters_Py)
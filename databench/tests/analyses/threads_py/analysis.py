@@ -0,0 +1,36 @@
+import databench
+import databench_py.multithread
+import threading
+import time
+
+
+class Threads_Py(databench.Analysis):
+
+    writers = set()
+
+    def emit_state(self, signal, key_value):
+        """Record the threads that write to the datastores."""
+        self.writers.add(threading.current_thread().name)
+        return super(Threads_Py, self).emit_state(signal, key_value)
+
+    @databench.on
+    def work(self, seconds):
+        """Block the worker thread."""
+        time.sleep(seconds)
+        yield self.set_state(worked=seconds)
+        yield self.emit('work', seconds)
+
+    @databench.on
+    def write(self):
+        """Report the threads that wrote to the datastore."""
+        yield self.set_state(written=True)
+        yield self.emit('writers', sorted(self.writers))
+
+    @databench.on
+    def ping(self):
+        yield self.emit('pong')
+
+
+if __name__ == "__main__":
+    analysis = databench_py.multithread.Meta('threads_py', Threads_Py)
+    analysis.event_loop()
@@ -0,0 +1,23 @@
+import databench
+import databench_py.spark
+
+
+class Spark_Pyspark(databench.Analysis):
+
+    @databench.on
+    def count(self, n):
+        """Count in a Spark job and report the context and pool."""
+        sc = self.spark_context
+        yield self.emit('count', {
+            'count': sc.parallelize(range(n)).count(),
+            'application_id': sc.applicationId,
+            'pool': sc.getLocalProperty('spark.scheduler.pool'),
+        })
+
+
+if __name__ == "__main__":
+    analysis = databench_py.spark.Meta(
+        'spark_pyspark', Spark_Pyspark,
+        spark_conf={'spark.ui.enabled': 'false'},
+    )
+    analysis.event_loop()
@@ -0,0 +1,36 @@
+"""A kernel that speaks the legacy PUB/SUB protocol of databench_go.
+
+It answers every action with a ``pong`` that contains the load.
+"""
+
+import json
+import sys
+import zmq
+
+
+def main():
+    args = dict(a.lstrip('-').partition('=')[::2] for a in sys.argv[1:])
+    analysis_id = args['analysis-id']
+
+    ctx = zmq.Context()
+    publish = ctx.socket(zmq.PUB)
+    publish.connect('tcp://127.0.0.1:{}'.format(args['zmq-publish']))
+    subscribe = ctx.socket(zmq.SUB)
+    subscribe.setsockopt(zmq.SUBSCRIBE, analysis_id.encode('utf-8'))
+    subscribe.connect('tcp://127.0.0.1:{}'.format(args['zmq-subscribe']))
+
+    # send handshakes until the ack arrives
+    while not subscribe.poll(500):
+        publish.send_json({'__zmq_handshake': None})
+
+    while True:
+        msg = json.loads(subscribe.recv().decode('utf-8').partition('|')[2])
+        if 'signal' not in msg:
+            continue
+        publish.send_json({'analysis_id': analysis_id,
+                           'frame': {'signal': 'pong',
+                                     'load': [msg['signal'], msg['load']]}})
+
+
+if __name__ == '__main__':
+    main()
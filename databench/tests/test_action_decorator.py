@@ -1,4 +1,6 @@
 import databench
+import databench.testing
+import tornado.testing
 
 
 @databench.on
@@ -19,3 +21,18 @@ def test_action_decorator_docstring():
 
 def test_action_decorator_docstring_2():
     assert fn_with_doc_2.__doc__ == 'Function with docstring.'
+
+
+class ActionName(databench.Analysis):
+    @databench.on_action('bla')
+    def fn_with_other_name(self):
+        self.emit('bla_done')
+
+
+class ActionDecorator(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_action_name(self):
+        test = databench.testing.AnalysisTest(ActionName)
+        yield test.trigger('bla')
+        self.assertIn(('bla_done', '__nomessagetoken__'),
+                      test.emitted_messages)
@@ -1,6 +1,7 @@
 import databench
 from databench.analyses_packaged.dummypi.analysis import Dummypi
 from databench.testing import AnalysisTest
+import tornado.gen
 import tornado.testing
 
 
@@ -9,6 +10,37 @@ class Parameters(databench.Analysis):
     def test_data(self, key, value):
         yield self.set_state({key: value})
 
+    @databench.on
+    def test_merge(self):
+        self.set_state(light='red')
+        self.set_state(light='green', sound='on')
+        yield self.data.set_state({'size': 3})
+
+    @databench.on
+    def test_transaction(self):
+        with self.transaction():
+            self.set_state(light='red')
+            self.set_state(light='green', sound='on')
+            self.set_class_state(runs=1)
+
+    @databench.on
+    def test_order(self):
+        self.set_state(light='red')
+        yield self.emit('log', 'after state change')
+
+
+class ParametersPatch(Parameters):
+    json_patch = True
+
+    @databench.on
+    def test_append(self, value):
+        yield self.set_state(samples=self.data['samples'] + [value])
+
+    @databench.on
+    def test_append_twice(self, value):
+        self.set_state(samples=self.data['samples'] + [value])
+        yield self.set_state(samples=self.data['samples'] + [value])
+
 
 class Example(tornado.testing.AsyncTestCase):
     @tornado.testing.gen_test
@@ -29,6 +61,132 @@ class Example(tornado.testing.AsyncTestCase):
             ('__process', {'id': 3, 'status': 'end'}),
         ], test.emitted_messages)
 
+    @tornado.testing.gen_test
+    def test_merge(self):
+        test = AnalysisTest(Parameters)
+        yield test.trigger('test_merge')
+        self.assertEqual([
+            ('data', {'light': 'green', 'sound': 'on', 'size': 3}),
+        ], test.emitted_messages)
+
+    @tornado.testing.gen_test
+    def test_transaction(self):
+        test = AnalysisTest(Parameters)
+        test.analysis_instance.data.subscribe(test.emitted_messages.append)
+        yield test.trigger('test_transaction')
+        yield tornado.gen.moment  # merged state is emitted next iteration
+        self.assertIn({'light': 'green', 'sound': 'on'},
+                      test.emitted_messages)
+        self.assertIn(('data', {'light': 'green', 'sound': 'on'}),
+                      test.emitted_messages)
+        self.assertIn(('class_data', {'runs': 1}), test.emitted_messages)
+        self.assertEqual(len(test.emitted_messages), 3)
+
+    @tornado.testing.gen_test
+    def test_order(self):
+        test = AnalysisTest(Parameters)
+        yield test.trigger('test_order')
+        self.assertEqual([
+            ('data', {'light': 'red'}),
+            ('log', 'after state change'),
+        ], test.emitted_messages)
+
+    @tornado.testing.gen_test
+    def test_json_patch(self):
+        test = AnalysisTest(ParametersPatch)
+        yield test.trigger('test_data', ['samples', list(range(100))])
+        test.analysis_instance.set_emit_fn(
+            lambda signal, message: test.emitted_messages.append(
+                (signal, message['samples'].encoded)))
+        yield test.trigger('test_append', 100)
+        self.assertEqual(
+            test.emitted_messages[-1],
+            ('data', '{"__patch": [{"op": "add", "path": "/100", '
+                     '"value": 100}]}'))
+
+        # the second change would patch a buffered patch: send full value
+        yield test.trigger('test_append_twice', 101)
+        self.assertEqual(test.emitted_messages[-1],
+                         ('data', str(list(range(102)) + [101])))
+
+    @tornado.testing.gen_test
+    def test_json_patch_before_snapshot(self):
+        class ClassPatch(databench.Analysis):
+            json_patch = True
+
+        a = AnalysisTest(ClassPatch).analysis_instance
+        yield a.set_class_state(xs=list(range(100)))
+
+        # b is subscribed to class_data before it sent a snapshot
+        b = ClassPatch().init_databench()
+        emitted = []
+        b.set_emit_fn(lambda signal, message: emitted.append(
+            (signal, message['xs'].encoded)))
+        yield a.set_class_state(xs=list(range(101)))
+        self.assertEqual(emitted, [('class_data', str(list(range(101))))])
+
+        b.set_emit_fn(lambda signal, message: None)
+        b.emit_snapshot()
+        b.set_emit_fn(lambda signal, message: emitted.append(
+            (signal, message['xs'].encoded)))
+        yield a.set_class_state(xs=list(range(102)))
+        self.assertEqual(emitted[-1][1], '{"__patch": [{"op": "add", '
+                                         '"path": "/101", "value": 101}]}')
+        a.close_datastores()
+        b.close_datastores()
+
+    @tornado.testing.gen_test
+    def test_revision(self):
+        test = AnalysisTest(Parameters)
+        test.analysis_instance.set_emit_fn(
+            lambda signal, message: test.emitted_messages.append(
+                (signal, message.revision)))
+        yield test.trigger('test_merge')
+        self.assertEqual(test.emitted_messages,
+                         [('data', test.analysis_instance.data.revision())])
+
+    @tornado.testing.gen_test
+    def test_resync(self):
+        test = AnalysisTest(Parameters)
+        yield test.trigger('test_data', ['light', 'red'])
+        revision = test.analysis_instance.data.revision()
+        yield test.trigger('test_data', ['sound', 'on'])
+
+        test.emitted_messages = []
+        yield test.analysis_instance.resync({'data': revision})
+        self.assertEqual(test.emitted_messages, [('data', {'sound': 'on'})])
+
+    @tornado.testing.gen_test
+    def test_resync_snapshot(self):
+        test = AnalysisTest(Parameters)
+        yield test.trigger('test_data', ['light', 'red'])
+        revision = test.analysis_instance.data.revision()
+
+        for revisions in (['data'], {'data': 'red'}, {'data': True}):
+            test.emitted_messages = []
+            yield test.analysis_instance.resync(revisions)
+            self.assertEqual(test.emitted_messages[0][0], '__snapshot')
+
+        # the journal is gone when the domain was evicted
+        databench.Datastore.journals.pop(test.analysis_instance.id_)
+        test.emitted_messages = []
+        yield test.analysis_instance.resync({'data': revision})
+        self.assertEqual(test.emitted_messages[0][0], '__snapshot')
+
+    @tornado.testing.gen_test
+    def test_snapshot(self):
+        test = AnalysisTest(Parameters)
+        yield test.trigger('test_data', ['light', 'red'])
+        test.emitted_messages = []
+        yield test.analysis_instance.emit_snapshot()
+        signal, message = test.emitted_messages[0]
+        self.assertEqual(signal, '__snapshot')
+        self.assertEqual(
+            databench.utils.resolve_raw_json(message['data']),
+            {'light': 'red'})
+        self.assertEqual(message.revision['data'],
+                         test.analysis_instance.data.revision())
+
     @tornado.testing.gen_test
     def test_multiple_emits(self):
         test = AnalysisTest(Dummypi)
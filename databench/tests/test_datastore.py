@@ -1,4 +1,8 @@
 import databench
+import numpy as np
+import shutil
+import tempfile
+import timeit
 import unittest
 
 
@@ -151,6 +155,223 @@ class Datastore(unittest.TestCase):
         self.d.set_state(lambda ds: {'test': 'modified{}'.format(ds['cnt'])})
         self.assertEqual(self.after['test'], 'modified2')
 
+    def test_raw_subscriber(self):
+        raw_after = {}
+        d2 = databench.Datastore('abcdef').subscribe(raw_after.update,
+                                                     raw=True)
+        self.d.set('test', {'key': 'value'})
+        d2.close()
+        self.assertEqual(self.after, {'test': {'key': 'value'}})
+        self.assertIsInstance(raw_after['test'], databench.utils.RawJSON)
+        self.assertIs(raw_after['test'].encoded, self.d.get_encoded('test'))
+
+    def test_view(self):
+        self.d.set('test', {'key': ['value']})
+        view = self.d.view('test')
+        self.assertEqual(view, {'key': ['value']})
+        self.assertIs(self.d.view('test'), view)
+        self.assertRaises(TypeError, view.update, {'key': 'modified'})
+        self.assertRaises(TypeError, view['key'].append, 'modified')
+
+    def test_view_invalidated(self):
+        self.d.set('test', {'key': 'value'})
+        self.d.view('test')
+        self.d.set('test', {'key': 'modified'})
+        self.assertEqual(self.d.view('test'), {'key': 'modified'})
+
+    def test_get_copy(self):
+        self.d.set('test', {'key': 'value'})
+        self.d.view('test')
+        copy = self.d['test']
+        copy['key'] = 'modified'
+        self.assertEqual(self.d['test'], {'key': 'value'})
+        self.assertEqual(self.d.view('test'), {'key': 'value'})
+
+    def test_view_benchmark(self):
+        self.d.set('test', {'samples': [
+            {'x': i * 0.5, 'y': [i, i + 1, i + 2], 'label': str(i)}
+            for i in range(10000)
+        ]})
+        self.d.view('test')
+        t_get = min(timeit.repeat(lambda: self.d.get('test'),
+                                  number=10, repeat=3))
+        t_view = min(timeit.repeat(lambda: self.d.view('test'),
+                                   number=10, repeat=3))
+        print('get: {:.2e}s, view: {:.2e}s, speedup: {:.0f}x'
+              ''.format(t_get / 10, t_view / 10, t_get / t_view))
+
+    def test_json_patch(self):
+        patch = databench.datastore.json_patch(
+            {'a': [1, 2], 'b/c': 1, 'd': 'removed'},
+            {'a': [1, 2, 3], 'b/c': 2},
+        )
+        self.assertEqual(sorted(patch, key=lambda op: op['path']), [
+            {'op': 'add', 'path': '/a/2', 'value': 3},
+            {'op': 'replace', 'path': '/b~1c', 'value': 2},
+            {'op': 'remove', 'path': '/d'},
+        ])
+
+    def test_json_patch_mode(self):
+        raw_after = {}
+        d2 = databench.Datastore('abcdef', json_patch=True)
+        d2.subscribe(raw_after.update, raw=True)
+        d2.set('test', list(range(100)))
+        d2.set('test', list(range(101)))
+        d2.close()
+        self.assertEqual(self.after['test'], list(range(101)))
+        self.assertIsInstance(raw_after['test'],
+                              databench.datastore.RawJSONPatch)
+        self.assertEqual(
+            raw_after['test'].encoded,
+            '{"__patch": [{"op": "add", "path": "/100", "value": 100}]}')
+        self.assertEqual(raw_after['test'].decode(), list(range(101)))
+
+    def test_json_patch_mode_large_change(self):
+        raw_after = {}
+        d2 = databench.Datastore('abcdef', json_patch=True)
+        d2.subscribe(raw_after.update, raw=True)
+        d2.set('test', [1, 2])
+        d2.set('test', [3, 4])
+        d2.close()
+        self.assertNotIsInstance(raw_after['test'],
+                                 databench.datastore.RawJSONPatch)
+
+    def test_subscribe_keys(self):
+        keys_after, prefix_after = {}, {}
+        d2 = databench.Datastore('abcdef')
+        d2.subscribe(keys_after.update, keys=['a', 'b'])
+        d2.subscribe(prefix_after.update, prefix='plot_')
+        self.d.set_state({'a': 1, 'c': 2, 'plot_x': 3})
+        d2.close()
+        self.assertEqual(keys_after, {'a': 1})
+        self.assertEqual(prefix_after, {'plot_x': 3})
+        self.assertEqual(self.after, {'a': 1, 'c': 2, 'plot_x': 3})
+
+    def test_subscribe_keys_and_prefix(self):
+        self.assertRaises(ValueError, self.d.subscribe,
+                          self.datastore_callback, keys=['a'], prefix='a')
+
+    def test_subscriber_index_cleanup(self):
+        d2 = databench.Datastore('index_cleanup')
+        d2.subscribe(self.datastore_callback, keys=['a'])
+        d2.subscribe(self.datastore_callback, prefix='a')
+        self.assertIn('index_cleanup', databench.Datastore.indexes)
+        d2.close()
+        self.assertNotIn('index_cleanup', databench.Datastore.indexes)
+
+    def test_revision(self):
+        updates = []
+        self.d.subscribe(updates.append)
+        self.d['first'] = 1
+        self.d['second'] = 2
+        self.assertLess(self.d.revision('first'), self.d.revision('second'))
+        self.assertEqual(self.d.revision(), self.d.revision('second'))
+        self.assertEqual(updates[-1].revision, self.d.revision('second'))
+
+    def test_changes_since(self):
+        self.d['first'] = 1
+        revision = self.d.revision()
+        self.d['second'] = 2
+        self.d['third'] = 3
+        self.d['second'] = 4
+        self.assertEqual(self.d.changes_since(revision), ['third', 'second'])
+        self.assertEqual(self.d.changes_since(self.d.revision()), [])
+
+    def test_changes_since_truncated(self):
+        d = databench.Datastore('changes_truncated')
+        d['first'] = 1
+        revision = d.revision()
+        for i in range(databench.Datastore.journal_size + 1):
+            d['second'] = i
+        self.assertEqual(sorted(d.changes_since(revision)),
+                         ['first', 'second'])
+        self.assertEqual(d.changes_since(d.revision()), [])
+        d.close()
+
+    def test_snapshot(self):
+        d = databench.Datastore('snapshot', release_storage=True)
+        d['first'] = {'a': 1}
+        d['second'] = 2
+        snapshot = d.snapshot()
+        self.assertEqual(snapshot.revision, d.revision())
+        self.assertEqual(databench.utils.json_dumps(snapshot),
+                         '{"first": {"a": 1}, "second": 2}')
+        d.close()
+
+    def test_trigger_all_callbacks_subset(self):
+        d = databench.Datastore('trigger_all', release_storage=True)
+        d.subscribe(self.datastore_callback)
+        d['first'] = 1
+        updates = []
+        d2 = databench.Datastore('trigger_all').subscribe(updates.append)
+        n_callbacks_before = self.n_callbacks
+        d2.trigger_all_callbacks(d2.subscriptions)
+        self.assertEqual(updates, [{'first': 1}])
+        self.assertEqual(self.n_callbacks, n_callbacks_before)
+        d2.close()
+        d.close()
+
+    def test_transaction(self):
+        updates = []
+        self.d.subscribe(updates.append)
+        with self.d.transaction():
+            self.d['samples'] = [1]
+            self.d['samples'] = self.d['samples'] + [2]
+            self.d['count'] = len(self.d['samples'])
+            self.assertEqual(updates, [])
+            self.assertIn('count', self.d)
+        self.assertEqual(updates, [{'samples': [1, 2], 'count': 2}])
+        self.assertEqual(updates[0].revision, self.d.revision())
+
+    def test_transaction_unchanged(self):
+        self.d['unchanged'] = 1
+        updates = []
+        self.d.subscribe(updates.append)
+        with self.d.transaction():
+            self.d['unchanged'] = 2
+            self.d['unchanged'] = 1
+        self.assertEqual(updates, [])
+
+    def test_transaction_exception(self):
+        try:
+            with self.d.transaction():
+                self.d['dropped'] = 1
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertNotIn('dropped', self.d)
+        self.assertIsNone(self.d.pending)
+
+    def test_transaction_nested(self):
+        updates = []
+        self.d.subscribe(updates.append)
+        with self.d.transaction():
+            with self.d.transaction():
+                self.d['inner'] = 1
+            self.d['outer'] = 2
+            self.assertEqual(updates, [])
+        self.assertEqual(updates, [{'inner': 1, 'outer': 2}])
+
+    def test_binary(self):
+        d = databench.Datastore('binary', release_storage=True, binary=True)
+        updates = []
+        d.subscribe(updates.append, raw=True)
+        d['a'] = {'x': np.arange(4, dtype='float32')}
+        self.assertEqual(len(updates), 1)
+        raw = updates[0]['a']
+        self.assertEqual(len(raw.buffers), 1)
+        np.testing.assert_array_equal(raw.decode()['x'], np.arange(4))
+
+        # equal arrays are no change
+        d['a'] = {'x': np.arange(4, dtype='float32')}
+        self.assertEqual(len(updates), 1)
+
+        value = d['a']['x']
+        value[0] = 10.0
+        self.assertEqual(d['a']['x'][0], 0.0)
+        self.assertRaises(ValueError, d.view('a')['x'].__setitem__, 0, 1.0)
+        d.close()
+
     def test_analysis_datastore(self):
         a = databench.Analysis().init_databench()
         a.set_emit_fn(lambda s, pl: None)
@@ -161,6 +382,111 @@ class Datastore(unittest.TestCase):
         self.assertEqual(self.after['test'], 'analysis_datastore')
 
 
+class DatastoreEviction(unittest.TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        databench.Datastore.idle_ttl = None
+        databench.Datastore.max_idle_domains = None
+        databench.Datastore.spill_path = None
+        for domain in ('evict_a', 'evict_b', 'evict_c'):
+            databench.Datastore.idle_domains.pop(domain, None)
+            databench.Datastore.release(domain)
+        shutil.rmtree(self.spill_dir)
+
+    def store(self, domain, value):
+        d = databench.Datastore(domain)
+        d['test'] = value
+        d.close()
+
+    def test_close_idempotent(self):
+        d = databench.Datastore('evict_a')
+        d['test'] = 'value'
+        d.close()
+        d.close()
+        self.assertIn('evict_a', databench.Datastore.idle_domains)
+        self.assertNotIn('evict_a', databench.Datastore.stores)
+
+    def test_release_idle(self):
+        self.store('evict_a', 'value')
+        databench.Datastore.release('evict_a')
+        self.assertNotIn('evict_a', databench.Datastore.idle_domains)
+        self.assertNotIn('evict_a', databench.Datastore.global_data)
+
+    def test_idle_ttl(self):
+        databench.Datastore.idle_ttl = 10.0
+        d = databench.Datastore('evict_a')
+        d['test'] = 'value'
+        d.close()
+        idle_since = databench.Datastore.idle_domains['evict_a']
+        self.assertNotIn('evict_a',
+                         databench.Datastore.evict(now=idle_since + 5.0))
+        self.assertIn('evict_a',
+                      databench.Datastore.evict(now=idle_since + 20.0))
+        self.assertNotIn('evict_a', databench.Datastore.global_data)
+
+    def test_not_evictable(self):
+        databench.Datastore.max_idle_domains = 0
+        d = databench.Datastore('evict_a', evictable=False)
+        d['test'] = 'value'
+        d.close()
+        self.assertNotIn('evict_a', databench.Datastore.idle_domains)
+        self.assertIn('evict_a', databench.Datastore.global_data)
+
+    def test_reopen_not_idle(self):
+        databench.Datastore.idle_ttl = 10.0
+        self.store('evict_a', 'value')
+        d = databench.Datastore('evict_a')
+        self.assertNotIn('evict_a', databench.Datastore.idle_domains)
+        self.assertNotIn('evict_a', databench.Datastore.evict(now=1e12))
+        self.assertEqual(d['test'], 'value')
+        d.close()
+
+    def test_max_idle_domains(self):
+        databench.Datastore.max_idle_domains = 1
+        self.store('evict_a', 'a')
+        self.store('evict_b', 'b')
+        self.assertNotIn('evict_a', databench.Datastore.global_data)
+        self.assertIn('evict_b', databench.Datastore.global_data)
+
+    def test_spill(self):
+        databench.Datastore.max_idle_domains = 0
+        databench.Datastore.spill_path = self.spill_dir
+        self.store('evict_a', {'a': [1, 2], 'b': u'\u00e9t\u00e9'})
+        self.assertNotIn('evict_a', databench.Datastore.global_data)
+        self.assertEqual(databench.Datastore.stats()['spilled_domains'], 1)
+
+        d = databench.Datastore('evict_a')
+        self.assertEqual(d['test'], {'a': [1, 2], 'b': u'\u00e9t\u00e9'})
+        self.assertEqual(databench.Datastore.stats()['spilled_domains'], 0)
+        d.close()
+
+    def test_spill_binary(self):
+        databench.Datastore.max_idle_domains = 0
+        databench.Datastore.spill_path = self.spill_dir
+        d = databench.Datastore('evict_a', binary=True)
+        d['test'] = np.arange(3, dtype='int16')
+        d.close()
+        self.assertNotIn('evict_a', databench.Datastore.global_buffers)
+
+        d = databench.Datastore('evict_a')
+        np.testing.assert_array_equal(d['test'], [0, 1, 2])
+        d.close()
+
+    def test_stats(self):
+        d = databench.Datastore('evict_c')
+        d.subscribe(lambda key_value: None)
+        before = databench.Datastore.stats()
+        d['test'] = 'value'
+        after = databench.Datastore.stats()
+        self.assertEqual(after['keys'], before['keys'] + 1)
+        self.assertEqual(after['bytes'], before['bytes'] + len('"value"'))
+        self.assertGreaterEqual(after['subscriptions'], 1)
+        d.close()
+        self.assertIn('evict_c', databench.Datastore.idle_domains)
+
+
 class DatastoreLegacy(unittest.TestCase):
     def setUp(self):
         self.n_callbacks = 0
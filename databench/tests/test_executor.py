@@ -0,0 +1,173 @@
+import databench
+import databench.executor
+import databench.testing
+import logging
+import os
+import threading
+import tornado.gen
+import tornado.testing
+import unittest
+
+release = threading.Event()
+
+
+class Pools(databench.Analysis):
+    @databench.on(executor='thread')
+    def blocking(self):
+        release.wait(5.0)
+        self.emit('released', threading.current_thread().name)
+        yield self.set_state(blocking='done')
+        self.set_class_state(runs=1)
+
+    if databench.executor.PROCESS_POOLS:
+        @databench.on(executor='process')
+        def compute(self, n):
+            self.emit('pid', os.getpid())
+            self.set_state(total=sum(range(n)))
+            self.set_state(lambda data: {'double': 2 * data.view('total')})
+
+        @databench.on_action('generate', executor='process')
+        def generate_in_process(self, n):
+            for i in range(n):
+                self.emit('step', i)
+                yield
+
+
+class Records(logging.Handler):
+    """Collects log records."""
+
+    def __init__(self, level=logging.NOTSET):
+        super(Records, self).__init__(level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class ActionExecutors(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(ActionExecutors, self).setUp()
+        release.clear()
+        self.executors = {'thread': databench.ActionExecutor('thread', 2)}
+        if databench.executor.PROCESS_POOLS:
+            self.executors['process'] = databench.ActionExecutor('process', 1)
+        Pools.executors = self.executors
+
+    def tearDown(self):
+        Pools.executors = None
+        for executor in self.executors.values():
+            executor.shutdown()
+        super(ActionExecutors, self).tearDown()
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_thread(self):
+        test = databench.testing.AnalysisTest(Pools)
+        running = test.trigger('blocking')
+
+        # the IOLoop is not blocked by the action
+        yield tornado.gen.sleep(0.1)
+        self.assertFalse(running.done())
+        self.assertEqual(self.executors['thread'].stats()['running'], 1)
+
+        release.set()
+        yield running
+        thread_name = [m for s, m in test.emitted_messages
+                       if s == 'released'][0]
+        self.assertNotEqual(thread_name, threading.current_thread().name)
+        self.assertEqual(test.analysis_instance.data['blocking'], 'done')
+        self.assertEqual(test.analysis_instance.class_data['runs'], 1)
+        self.assertEqual(self.executors['thread'].stats()['completed'], 1)
+
+    @tornado.testing.gen_test(timeout=10)
+    def test_stats(self):
+        tests = [databench.testing.AnalysisTest(Pools) for _ in range(3)]
+        running = [test.trigger('blocking') for test in tests]
+        yield tornado.gen.sleep(0.1)
+        stats = self.executors['thread'].stats()
+        self.assertEqual(stats['running'], 2)
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['utilization'], 1.0)
+
+        release.set()
+        yield running
+        stats = self.executors['thread'].stats()
+        self.assertEqual((stats['running'], stats['queued']), (0, 0))
+        self.assertEqual(stats['completed'], 3)
+
+    @unittest.skipIf(not databench.executor.PROCESS_POOLS,
+                     'needs Python 3.7')
+    @unittest.skipIf(not hasattr(os, 'fork'), 'needs fork')
+    @tornado.testing.gen_test(timeout=30)
+    def test_process(self):
+        test = databench.testing.AnalysisTest(Pools)
+        yield test.trigger('compute', [10])
+        pids = [m for s, m in test.emitted_messages if s == 'pid']
+        self.assertNotEqual(pids, [os.getpid()])
+        self.assertEqual(test.analysis_instance.data['total'], 45)
+        self.assertEqual(test.analysis_instance.data['double'], 90)
+
+    @unittest.skipIf(not databench.executor.PROCESS_POOLS,
+                     'needs Python 3.7')
+    @unittest.skipIf(not hasattr(os, 'fork'), 'needs fork')
+    @tornado.testing.gen_test(timeout=30)
+    def test_process_generator(self):
+        test = databench.testing.AnalysisTest(Pools)
+        yield test.trigger('generate', [3])
+        self.assertEqual([m for s, m in test.emitted_messages if s == 'step'],
+                         [0, 1, 2])
+
+    def test_process_state(self):
+        state = databench.executor.ProcessState({'samples': [1, 2]})
+        state.get('samples').append(3)
+        state['samples'].append(3)
+        self.assertEqual(state.view('samples'), [1, 2])
+        with self.assertRaises(TypeError):
+            state.view('samples').append(3)
+        self.assertEqual(state.get('missing', 0), 0)
+        self.assertIsNone(state.view('missing'))
+
+    def test_unknown_kind(self):
+        def run(self):
+            pass
+
+        with self.assertRaises(ValueError):
+            databench.on(executor='gpu')(run)
+        with self.assertRaises(ValueError):
+            databench.ActionExecutor('gpu')
+
+    def test_process_unavailable(self):
+        process_pools = databench.executor.PROCESS_POOLS
+        databench.executor.PROCESS_POOLS = False
+        try:
+            with self.assertRaises(ValueError):
+                databench.ActionExecutor('process')
+        finally:
+            databench.executor.PROCESS_POOLS = process_pools
+
+    @tornado.testing.gen_test
+    def test_apply_error(self):
+        class Failing(object):
+            def emit(self, signal, message):
+                raise RuntimeError('emit failed')
+
+            @tornado.gen.coroutine
+            def set_state(self, state_change):
+                raise RuntimeError('set_state failed')
+
+        executor = self.executors['thread']
+        executor.tasks[0] = (Failing(), None, self.io_loop)
+        records = Records(logging.ERROR)
+        logger = logging.getLogger('databench.executor')
+        logger.addHandler(records)
+        try:
+            executor.apply(0, 'emit', ('signal', 'message'))
+            executor.apply(0, 'set_state', ({'a': 1},))
+            yield tornado.gen.moment
+        finally:
+            logger.removeHandler(records)
+        self.assertEqual(len(records.records), 2)
+        del executor.tasks[0]
+
+
+if __name__ == '__main__':
+    unittest.main()
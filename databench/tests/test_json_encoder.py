@@ -1,5 +1,7 @@
-from databench.utils import json_encoder_default
+from databench import utils
+from databench.utils import json_dumps, json_encoder_default, RawJSON
 import json
+import numpy as np
 import unittest
 
 
@@ -33,6 +35,133 @@ class TestJsonEncoder(unittest.TestCase):
         data = json.dumps((1, float('inf')), default=json_encoder_default)
         self.assertEqual(data, '[1, Infinity]')
 
+    def test_raw_json(self):
+        data = json.dumps({'raw': RawJSON('[1, 2]')},
+                          default=json_encoder_default)
+        self.assertEqual(data, '{"raw": [1, 2]}')
+
+    def test_json_dumps_splice(self):
+        data = json_dumps({'signal': 'data',
+                           'load': {'key': RawJSON('{"a": Infinity}')}})
+        self.assertEqual(data, '{"signal": "data", '
+                               '"load": {"key": {"a": Infinity}}}')
+
+    def test_json_dumps_plain(self):
+        data = {'one': [1, 2], 'two': {'three': {'four': {4}}}, 5: 'five'}
+        self.assertEqual(json.loads(json_dumps(data)),
+                         json.loads(json.dumps(data,
+                                               default=json_encoder_default)))
+
+
+class TestBinaryFrames(unittest.TestCase):
+    def test_extract_restore(self):
+        data = {'a': np.arange(6, dtype='float32').reshape(2, 3),
+                'b': [np.array([1, -2], dtype='>i2')], 'c': 'text'}
+        buffers = {}
+        placeholders = utils.extract_buffers(data, buffers)
+        self.assertEqual(placeholders['a'],
+                         {'__ndarray': 'b0', 'dtype': 'float32',
+                          'shape': [2, 3]})
+        restored = utils.restore_buffers(
+            json.loads(json.dumps(placeholders)), buffers)
+        np.testing.assert_array_equal(restored['a'], data['a'])
+        np.testing.assert_array_equal(restored['b'][0], data['b'][0])
+        self.assertEqual(restored['c'], 'text')
+
+    def test_content_ids(self):
+        buffers = {}
+        a = utils.extract_buffers(np.arange(3, dtype='int32'), buffers, True)
+        b = utils.extract_buffers(np.arange(3, dtype='int32'), buffers, True)
+        self.assertEqual(a, b)
+        self.assertEqual(len(buffers), 1)
+
+    def test_int64(self):
+        buffers = {}
+        placeholder = utils.extract_buffers(np.arange(3), buffers)
+        self.assertEqual(placeholder['dtype'], 'float64')
+        self.assertIs(utils.extract_buffers(
+            np.array([2 ** 60]), buffers).dtype, np.dtype('int64'))
+
+    def test_unsupported_dtype(self):
+        buffers = {}
+        self.assertEqual(utils.extract_buffers(np.array(['x']), buffers)[0],
+                         'x')
+        self.assertEqual(buffers, {})
+
+    def test_frame(self):
+        data = {'signal': 'data',
+                'load': {'a': np.arange(3, dtype='uint8'),
+                         'b': np.linspace(0.0, 1.0, 5)}}
+        frame, binary = utils.encode_frame(data, binary=True)
+        self.assertTrue(binary)
+        message, buffers = utils.unpack_frame(frame)
+        header_length = len(frame) - sum(len(b) for b in buffers.values())
+        self.assertEqual(frame.index(buffers['b1']) % 8, 0)
+        self.assertGreater(header_length, 0)
+        restored = utils.restore_buffers(message, buffers)
+        np.testing.assert_array_equal(restored['load']['b'],
+                                      data['load']['b'])
+
+    def test_frame_text(self):
+        frame, binary = utils.encode_frame({'a': np.arange(3)})
+        self.assertFalse(binary)
+        self.assertEqual(frame, b'{"a": [0, 1, 2]}')
+
+    def test_frame_raw_json_buffers(self):
+        buffers = {}
+        encoded = json.dumps(
+            utils.extract_buffers(np.arange(2, dtype='int8'), buffers))
+        frame, binary = utils.encode_frame(
+            {'load': {'a': RawJSON(encoded, buffers)}})
+        self.assertTrue(binary)
+        message, buffers = utils.unpack_frame(frame)
+        self.assertEqual(
+            utils.restore_buffers(message, buffers)['load']['a'].tolist(),
+            [0, 1])
+
+    def test_bytes(self):
+        buffers = {}
+        placeholders = utils.extract_buffers(
+            {'a': b'abc', 'b': bytearray(b'de'), 'c': 'text'}, buffers)
+        self.assertEqual(placeholders['a']['dtype'], 'uint8')
+        self.assertEqual(placeholders['c'], 'text')
+        restored = utils.restore_buffers(placeholders, buffers)
+        self.assertEqual(restored['a'].tobytes(), b'abc')
+        self.assertEqual(restored['b'].tobytes(), b'de')
+
+    def test_no_copy(self):
+        data = np.arange(4, dtype='float64')
+        buffers = {}
+        utils.extract_buffers(data, buffers, copy=False)
+        self.assertIsInstance(buffers['b0'], memoryview)
+        data[0] = 5.0
+        self.assertEqual(np.frombuffer(buffers['b0'])[0], 5.0)
+
+        # big-endian data is converted
+        utils.extract_buffers(data.astype('>f8'), buffers, copy=False)
+        self.assertEqual(np.frombuffer(buffers['b1'])[0], 5.0)
+
+    def test_frame_parts(self):
+        data = {'signal': 'data',
+                'load': {'a': np.arange(3, dtype='uint8'),
+                         'b': np.linspace(0.0, 1.0, 5)}}
+        parts, binary = utils.encode_frame_parts(data, binary=True,
+                                                 copy=False)
+        self.assertTrue(binary)
+        self.assertEqual(b''.join(parts),
+                         utils.encode_frame(data, binary=True)[0])
+
+    def test_encoded_frame(self):
+        data = {'signal': 'data', 'load': {'a': np.arange(3, dtype='uint8')}}
+        frame = utils.EncodedFrame(*utils.encode_frame(data, binary=True))
+        self.assertTrue(frame.binary)
+        self.assertEqual(frame.decode()['load']['a'].tolist(), [0, 1, 2])
+
+        frame = utils.EncodedFrame(*utils.encode_frame(data))
+        self.assertFalse(frame.binary)
+        self.assertEqual(frame.decode(), {'signal': 'data',
+                                          'load': {'a': [0, 1, 2]}})
+
 
 if __name__ == '__main__':
     unittest.main()
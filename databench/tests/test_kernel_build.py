@@ -0,0 +1,83 @@
+from databench.kernel_build import KernelBuild
+import os
+import shutil
+import tempfile
+import unittest
+
+# counts the builds in a file outside of the analysis directory
+COUNT = ('import sys; '
+         'f = open(sys.argv[1], "a"); f.write("x"); f.close()')
+
+
+class TestKernelBuild(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.counter_dir = tempfile.mkdtemp()
+        self.counter = os.path.join(self.counter_dir, 'builds')
+        with open(os.path.join(self.path, 'main.go'), 'w') as f:
+            f.write('package main\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        shutil.rmtree(self.counter_dir)
+
+    def builds(self):
+        if not os.path.exists(self.counter):
+            return 0
+        with open(self.counter) as f:
+            return len(f.read())
+
+    def test_cache(self):
+        build = KernelBuild(['python', '-c', COUNT, self.counter], self.path)
+        self.assertTrue(build.run())
+        self.assertTrue(build.run())
+        self.assertEqual(self.builds(), 1)
+
+        with open(os.path.join(self.path, 'main.go'), 'a') as f:
+            f.write('func main() {}\n')
+        self.assertTrue(build.run())
+        self.assertEqual(self.builds(), 2)
+
+    def test_command_change(self):
+        KernelBuild(['python', '-c', COUNT, self.counter], self.path).run()
+        KernelBuild('python -c \'{}\' {}'.format(COUNT, self.counter),
+                    self.path).run()
+        self.assertEqual(self.builds(), 2)
+
+    def test_build_output(self):
+        build = KernelBuild('echo x > kernel.bin', self.path)
+        self.assertTrue(build.run())
+        self.assertEqual(build.cached_hash(), build.source_hash())
+
+    def test_missing_output(self):
+        # installed outside of the analysis directory like with go install
+        output = os.path.join(self.counter_dir, 'kernel')
+        command = ['python', '-c', COUNT + '; open(sys.argv[2], "w")',
+                   self.counter, output]
+        build = KernelBuild(command, self.path, output=output)
+        self.assertTrue(build.run())
+        self.assertTrue(build.run())
+        self.assertEqual(self.builds(), 1)
+
+        os.remove(output)
+        self.assertTrue(build.run())
+        self.assertEqual(self.builds(), 2)
+
+    def test_unwritable_cache(self):
+        os.mkdir(os.path.join(self.path, KernelBuild.cache_file))
+        build = KernelBuild(['python', '-c', COUNT, self.counter], self.path)
+        self.assertTrue(build.run())
+        self.assertTrue(build.run())
+        self.assertEqual(self.builds(), 2)
+
+    def test_failure(self):
+        build = KernelBuild(['python', '-c', 'import sys; sys.exit(1)'],
+                            self.path)
+        self.assertFalse(build.run())
+        self.assertIsNone(build.cached_hash())
+        self.assertFalse(KernelBuild(['not-a-build-command'],
+                                     self.path).run())
+
+
+if __name__ == '__main__':
+    unittest.main()
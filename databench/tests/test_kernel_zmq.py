@@ -0,0 +1,714 @@
+from databench import utils
+from databench.kernel_build import KernelBuild
+from databench.kernel_zmq import KernelRouter, KernelZMQ as Kernel
+import databench
+import databench_py.multithread
+import json
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tornado.gen
+import tornado.testing
+import tornado.websocket
+import unittest
+import zmq
+
+try:
+    import pyspark
+except ImportError:
+    pyspark = None
+
+
+class KernelZMQ(tornado.testing.AsyncHTTPTestCase):
+    analyses = 'databench.tests.analyses'
+    kernel_pool = 0
+    kernel_processes = 0
+    zmq_transport = 'tcp'
+
+    def get_app(self):
+        self.app = databench.App(self.analyses,
+                                 kernel_pool=self.kernel_pool,
+                                 kernel_processes=self.kernel_processes,
+                                 zmq_transport=self.zmq_transport)
+        return self.app.tornado_app()
+
+    def meta(self, name):
+        return next(m for m in self.app.metas if m.name == name)
+
+    def tearDown(self):
+        for meta in self.app.metas:
+            if isinstance(meta, databench.MetaZMQ):
+                meta.close_kernels()
+        self.app.kernel_router.close()
+        super(KernelZMQ, self).tearDown()
+
+    @tornado.gen.coroutine
+    def connect(self, name='parameters_py'):
+        url = 'ws://127.0.0.1:{}/{}/ws'.format(self.get_http_port(), name)
+        ws = yield tornado.websocket.websocket_connect(url)
+        ws.write_message(json.dumps({'__connect': None}))
+        msg = json.loads((yield ws.read_message()))
+        self.assertEqual(msg['signal'], '__connect')
+        ws.analysis_id = msg['load']['analysis_id']
+        raise tornado.gen.Return(ws)
+
+    @tornado.gen.coroutine
+    def echo(self, ws):
+        ws.write_message(json.dumps({'signal': 'test_fn', 'load': [1, 2]}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_fn':
+                raise tornado.gen.Return(msg['load'])
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_kernel(self):
+        ws = yield self.connect()
+        self.assertEqual((yield self.echo(ws)), [1, 2])
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+
+class KernelIPC(KernelZMQ):
+    zmq_transport = 'ipc'
+
+    def test_endpoint(self):
+        self.assertTrue(self.app.zmq_endpoint.startswith('ipc://'))
+
+
+class RoundTripLatency(KernelZMQ):
+    """Round trips from the frontend to the parameters_py kernel and back
+    with tcp and ipc transport."""
+
+    @tornado.gen.coroutine
+    def round_trips(self, n=200):
+        ws = yield self.connect()
+        yield self.echo(ws)
+        start = time.time()
+        for _ in range(n):
+            yield self.echo(ws)
+        latency = (time.time() - start) / n
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+        raise tornado.gen.Return(latency)
+
+    @tornado.testing.gen_test(timeout=60)
+    def test_benchmark(self):
+        tcp_latency = yield self.round_trips()
+
+        self.app.kernel_router.close()
+        self.app.init_zmq(zmq_transport='ipc')
+        meta = self.meta('parameters_py')
+        meta.router = self.app.kernel_router
+        meta.executable = meta.executable[:-1] + [
+            '--zmq-router={}'.format(self.app.zmq_endpoint)]
+        ipc_latency = yield self.round_trips()
+
+        print('round trip latency: tcp {:.2e}s, ipc {:.2e}s'
+              ''.format(tcp_latency, ipc_latency))
+
+    def test_transport_benchmark(self):
+        """Only the ZMQ sockets without the WebSocket and the kernel."""
+        latencies = []
+        for transport in ('tcp', 'ipc'):
+            router = KernelRouter(transport=transport)
+            dealer = zmq.Context.instance().socket(zmq.DEALER)
+            dealer.setsockopt(zmq.IDENTITY, b'benchmark')
+            dealer.connect(router.endpoint)
+            message = utils.dumps({'signal': 'test_fn', 'load': [1, 2]})
+
+            def round_trip():
+                dealer.send(message.encode('utf-8'))
+                identity, frame = router.zmq_socket.recv_multipart()
+                router.zmq_socket.send_multipart([identity, frame])
+                dealer.recv()
+
+            round_trip()
+            latencies.append(min(timeit.repeat(round_trip,
+                                               number=1000, repeat=3)) / 1000)
+            dealer.close()
+            router.close()
+        print('transport round trip latency: tcp {:.2e}s, ipc {:.2e}s'
+              ''.format(*latencies))
+
+
+class BinaryFrames(KernelZMQ):
+
+    @tornado.gen.coroutine
+    def request(self, ws, signal, load):
+        ws.write_message(json.dumps({'signal': signal, 'load': load}))
+        while True:
+            frame = yield ws.read_message()
+            if isinstance(frame, bytes):
+                message, buffers = utils.unpack_frame(frame)
+                raise tornado.gen.Return(
+                    utils.restore_buffers(message, buffers)['load'])
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_image(self):
+        ws = yield self.connect('binary_py')
+        image = yield self.request(ws, 'image', [4, 3])
+        self.assertEqual(image['image'].dtype, np.float32)
+        self.assertEqual(image['image'].shape, (3, 4))
+        self.assertEqual(image['image'][2, 3], 11.0)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_bytes(self):
+        ws = yield self.connect('binary_py')
+        raw = yield self.request(ws, 'raw', 512)
+        self.assertEqual(raw.tobytes(), bytes(bytearray(range(256))) * 2)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_batch(self):
+        ws = yield self.connect('binary_py')
+        kernel = self.meta('binary_py').assigned[0]
+        zmq_messages = []
+        kernel_listener = kernel.zmq_listener
+
+        def zmq_listener(multipart):
+            zmq_messages.append(multipart)
+            kernel_listener(multipart)
+        kernel.zmq_listener = zmq_listener
+
+        ws.write_message(json.dumps({'signal': 'burst', 'load': 20}))
+        received = []
+        while len(received) < 40:
+            frame = yield ws.read_message()
+            if isinstance(frame, bytes):
+                message, buffers = utils.unpack_frame(frame)
+                message = utils.restore_buffers(message, buffers)
+            else:
+                message = json.loads(frame)
+            if message['signal'] == 'burst':
+                received.append(message['load'])
+
+        self.assertEqual([m['i'] for m in received],
+                         [i // 2 for i in range(40)])
+        self.assertEqual(received[10]['a'].tolist(), [5] * 5)
+        self.assertLess(len(zmq_messages), 40)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=60)
+    def test_benchmark(self):
+        ws = yield self.connect('binary_py')
+        yield self.request(ws, 'image', [10, 10])
+        start = time.time()
+        for _ in range(20):
+            yield self.request(ws, 'image', [1024, 1024])
+        duration = (time.time() - start) / 20
+        print('4MB image from kernel to frontend: {:.2e}s'.format(duration))
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+
+class Forwarding(unittest.TestCase):
+    """Kernel frames are forwarded to the frontend without decoding."""
+
+    def analysis(self):
+        analysis = databench.AnalysisZMQ().init_databench(None)
+        analysis.emitted = []
+        analysis.set_emit_fn(lambda s, m: analysis.emitted.append((s, m)))
+        return analysis
+
+    def test_forward(self):
+        analysis = self.analysis()
+        frame, binary = utils.encode_frame(
+            {'signal': 'data', 'load': {'x': 1}})
+        analysis.zmq_listener({'analysis_id': analysis.id_,
+                               'signal': 'data'}, [frame])
+        signal, message = analysis.emitted[0]
+        self.assertEqual(signal, 'data')
+        self.assertEqual(message.frame, frame)
+        self.assertFalse(message.binary)
+
+    def test_log(self):
+        analysis = self.analysis()
+        frame, binary = utils.encode_frame({'signal': 'log', 'load': 'hi'})
+        analysis.zmq_listener({'analysis_id': analysis.id_,
+                               'signal': 'log'}, [frame])
+        self.assertEqual(analysis.emitted, [('log', 'hi')])
+
+    def test_benchmark(self):
+        analysis = self.analysis()
+        timings = []
+        for size in (10, 100000):
+            frame, binary = utils.encode_frame(
+                {'signal': 'data', 'load': {'x': list(range(size))}})
+            header = {'analysis_id': analysis.id_, 'signal': 'data'}
+            t = min(timeit.repeat(
+                lambda: analysis.zmq_listener(header, [frame]),
+                number=100, repeat=3)) / 100
+            timings.append('{} bytes: {:.2e}s'.format(len(frame), t))
+        print('main process per kernel message: {}'
+              ''.format(', '.join(timings)))
+
+
+class KernelPool(KernelZMQ):
+    kernel_pool = 2
+
+    @tornado.gen.coroutine
+    def wait_for_pool(self, meta):
+        while len(meta.pool) < meta.kernel_pool or \
+                not all(k.handshake for k in meta.pool):
+            yield tornado.gen.sleep(0.1)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_assign(self):
+        meta = self.meta('parameters_py')
+        yield self.wait_for_pool(meta)
+        pooled = list(meta.pool)
+
+        ws1 = yield self.connect()
+        ws2 = yield self.connect()
+        self.assertEqual((yield self.echo(ws1)), [1, 2])
+        self.assertEqual((yield self.echo(ws2)), [1, 2])
+
+        # both connections used a warm kernel and the pool is refilled
+        self.assertTrue(all(k.analysis_id is not None for k in pooled))
+        self.assertEqual(len(meta.pool), 2)
+        self.assertFalse(any(k in pooled for k in meta.pool))
+
+        ws1.close()
+        ws2.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_dead_kernel(self):
+        meta = self.meta('parameters_py')
+        yield self.wait_for_pool(meta)
+        dead = meta.pool[0]
+        dead.process.kill()
+        dead.process.wait()
+
+        meta.fill_pool()
+        self.assertNotIn(dead, meta.pool)
+        self.assertEqual(len(meta.pool), 2)
+        self.assertTrue(dead.closed)
+        self.assertNotIn(dead.kernel_id, self.app.kernel_router.kernels)
+
+    def test_index_yaml(self):
+        self.assertEqual(self.meta('parameters_py').kernel_pool, 2)
+        self.assertEqual(self.meta('simple1_py').kernel_pool, 0)
+
+
+class KernelProcesses(KernelZMQ):
+    kernel_processes = 2
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_multiplex(self):
+        meta = self.meta('parameters_py')
+        connections = []
+        for _ in range(4):
+            connections.append((yield self.connect()))
+        for ws in connections:
+            self.assertEqual((yield self.echo(ws)), [1, 2])
+
+        # four analysis instances in two kernel processes
+        self.assertEqual(len(meta.kernels), 2)
+        self.assertEqual([k.load for k in meta.kernels], [2, 2])
+
+        # the kernel processes keep running after disconnects
+        for ws in connections:
+            ws.close()
+        yield tornado.gen.sleep(0.5)
+        self.assertEqual([k.load for k in meta.kernels], [0, 0])
+        self.assertTrue(all(k.alive() for k in meta.kernels))
+
+        ws = yield self.connect()
+        self.assertEqual((yield self.echo(ws)), [1, 2])
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+
+class OneKernelProcess(KernelZMQ):
+    kernel_processes = 1
+
+    @tornado.gen.coroutine
+    def domains(self, ws):
+        ws.write_message(json.dumps({'signal': 'test_domains', 'load': []}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'test_domains':
+                raise tornado.gen.Return(msg['load'])
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_release(self):
+        ws = yield self.connect()
+        analysis_id = ws.analysis_id
+        ws.write_message(json.dumps({'signal': 'test_state',
+                                     'load': ['key', 'value']}))
+        self.assertIn(analysis_id, (yield self.domains(ws)))
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+        # the data of the closed instance is gone from the kernel
+        ws = yield self.connect()
+        self.assertNotIn(analysis_id, (yield self.domains(ws)))
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_snapshot(self):
+        ws = yield self.connect()
+        ws.write_message(json.dumps({'signal': 'test_class_data',
+                                     'load': ['shared', 5]}))
+        yield self.domains(ws)
+
+        # the kernel sends the class data to a new session
+        ws2 = yield self.connect()
+        msg = json.loads((yield ws2.read_message()))
+        self.assertEqual(msg['signal'], '__snapshot')
+        self.assertEqual(msg['load']['class_data'], {'shared': 5})
+        self.assertIn('class_data', msg['revision'])
+        self.assertEqual((yield self.echo(ws2)), [1, 2])
+
+        # a frontend that lost track of the state requests a snapshot
+        ws2.write_message(json.dumps({'__resync': True}))
+        while True:
+            msg = json.loads((yield ws2.read_message()))
+            if msg['signal'] == '__snapshot':
+                break
+        self.assertEqual(msg['load']['class_data'], {'shared': 5})
+        ws.close()
+        ws2.close()
+        yield tornado.gen.sleep(0.3)
+
+
+class Build(KernelZMQ):
+
+    def build_meta(self, command):
+        meta = self.meta('parameters_py')
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        return databench.MetaZMQ('parameters_py', meta.executable,
+                                 self.app.kernel_router, self.path, [],
+                                 kernel_build=command)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_ready(self):
+        meta = self.build_meta(['python', '-c',
+                                'import time; time.sleep(0.3)'])
+        self.assertFalse(meta.ready)
+        self.assertTrue((yield meta.build))
+        self.assertTrue(meta.ready)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.path, KernelBuild.cache_file)))
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_failed(self):
+        meta = self.build_meta(['python', '-c', 'import sys; sys.exit(1)'])
+        analysis = databench.AnalysisZMQ().init_databench(None)
+        errors = []
+        analysis.set_emit_fn(lambda s, m: errors.append(m))
+        yield meta.run_process(analysis, 'connect')
+        self.assertFalse(meta.ready)
+        self.assertEqual(errors, ['kernel build failed'])
+        self.assertIsNone(analysis.kernel)
+
+
+class Supervision(KernelZMQ):
+
+    def setUp(self):
+        super(Supervision, self).setUp()
+        self.meta('parameters_py').supervise_interval = 0.1
+
+    @tornado.gen.coroutine
+    def wait_for(self, condition):
+        while not condition():
+            yield tornado.gen.sleep(0.05)
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_restart(self):
+        meta = self.meta('parameters_py')
+        ws = yield self.connect()
+        self.assertEqual((yield self.echo(ws)), [1, 2])
+        kernel = meta.assigned[0]
+        pid = kernel.process.pid
+
+        kernel.process.kill()
+        while json.loads((yield ws.read_message()))['signal'] != 'warn':
+            pass
+        self.assertEqual((yield self.echo(ws)), [1, 2])
+        self.assertEqual(kernel.crashes, 1)
+        self.assertNotEqual(kernel.process.pid, pid)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_give_up(self):
+        meta = self.meta('parameters_py')
+        meta.max_restarts = 0
+        ws = yield self.connect()
+        yield self.echo(ws)
+        kernel = meta.assigned[0]
+
+        kernel.process.kill()
+        while json.loads((yield ws.read_message()))['signal'] != 'error':
+            pass
+        self.assertTrue(kernel.closed)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_idle(self):
+        meta = self.meta('parameters_py')
+        meta.kernel_idle_timeout = 0.3
+        ws = yield self.connect()
+        yield self.echo(ws)
+        kernel = meta.assigned[0]
+
+        yield self.wait_for(lambda: kernel.reaped)
+        yield self.wait_for(lambda: not kernel.alive())
+        self.assertEqual((yield self.echo(ws)), [1, 2])
+        self.assertFalse(kernel.reaped)
+        self.assertEqual(kernel.crashes, 0)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_stats(self):
+        meta = self.meta('parameters_py')
+        ws = yield self.connect()
+        yield self.echo(ws)
+        stats = meta.kernel_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['analyses'], 1)
+        self.assertGreater(stats[0]['rss'], 0)
+        self.assertGreaterEqual(stats[0]['cpu'], 0.0)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    def test_limits(self):
+        code = ('import resource, sys; '
+                'sys.exit(resource.getrlimit(resource.RLIMIT_CPU)[0])')
+        kernel = Kernel(['python', '-c', code], self.app.kernel_router,
+                        limits={'cpu_time': 7, 'address_space': None})
+        self.assertEqual(kernel.process.wait(), 7)
+        kernel.close()
+
+        code = ('import resource, sys; '
+                'sys.exit(resource.getrlimit(resource.RLIMIT_AS)[0] >> 30)')
+        kernel = Kernel(['python', '-c', code], self.app.kernel_router,
+                        limits={'address_space': 8 << 30})
+        self.assertEqual(kernel.process.wait(), 8)
+        kernel.close()
+
+    def test_unknown_limit(self):
+        with self.assertRaises(ValueError):
+            Kernel(['python'], self.app.kernel_router, limits={'files': 1})
+
+
+class Shutdown(KernelZMQ):
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_exit(self):
+        meta = self.meta('parameters_py')
+        ws = yield self.connect()
+        yield self.echo(ws)
+        kernel = meta.assigned[0]
+
+        ws.close()
+        while kernel.alive() or kernel.kernel_id in kernel.router.kernels:
+            yield tornado.gen.sleep(0.05)
+        # the kernel exited by itself and was not terminated
+        self.assertEqual(kernel.process.returncode, 0)
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_kill(self):
+        code = ('import signal, time; '
+                'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                'time.sleep(30)')
+        kernel = Kernel(['python', '-c', code], self.app.kernel_router)
+        kernel.shutdown_timeout = 0.2
+        kernel.kill_timeout = 0.5
+        yield tornado.gen.sleep(0.3)
+        yield kernel.shutdown()
+        self.assertEqual(kernel.process.returncode, -9)
+        self.assertNotIn(kernel.kernel_id, self.app.kernel_router.kernels)
+
+
+class LegacyTransport(KernelZMQ):
+
+    @tornado.testing.gen_test(timeout=30)
+    def test_pubsub(self):
+        router = self.app.kernel_transport({'kernel': 'go'})
+        self.assertTrue(router.legacy)
+        self.assertIs(self.app.kernel_transport({'kernel': 'go'}), router)
+        path = os.path.dirname(__file__)
+        meta = databench.MetaZMQ(
+            'legacy', [sys.executable, os.path.join(path, 'legacy_kernel.py')],
+            router, path, [], kernel_pool=2)
+        self.assertEqual(meta.kernel_pool, 0)
+
+        emitted = []
+        analysis = databench.AnalysisZMQ().init_databench('legacy1')
+        analysis.set_emit_fn(lambda s, m: emitted.append((s, m)))
+        yield meta.run_process(analysis, 'connect')
+        yield meta.run_process(analysis, 'ping', [1, 2])
+        while ('pong', ['ping', [1, 2]]) not in [
+                (s, m.decode()['load']) for s, m in emitted]:
+            yield tornado.gen.sleep(0.05)
+
+        kernel = analysis.kernel
+        yield meta.run_process(analysis, 'disconnected')
+        self.assertFalse(kernel.alive())
+        self.assertNotIn(kernel.kernel_id, router.kernels)
+        router.close()
+
+    def test_no_pool(self):
+        router = self.app.kernel_transport({'kernel': 'go'})
+        with self.assertRaises(ValueError):
+            Kernel(['true'], router)
+        router.close()
+
+    def test_router_option(self):
+        self.assertIs(self.app.kernel_transport(
+            {'kernel': 'go', 'kernel_transport': 'router'}),
+            self.app.kernel_router)
+
+
+class Threads(KernelZMQ):
+
+    @tornado.gen.coroutine
+    def signals(self, ws, n):
+        signals = []
+        while len(signals) < n:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] in ('work', 'pong'):
+                signals.append((msg['signal'], msg.get('load')))
+        raise tornado.gen.Return(signals)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_responsive(self):
+        ws = yield self.connect('threads_py')
+        ws.write_message(json.dumps({'signal': 'work', 'load': 1.0}))
+        ws.write_message(json.dumps({'signal': 'ping'}))
+        self.assertEqual((yield self.signals(ws, 2)),
+                         [('pong', None), ('work', 1.0)])
+        kernel = self.meta('threads_py').assigned[0]
+        ws.close()
+        while kernel.alive():
+            yield tornado.gen.sleep(0.05)
+        self.assertEqual(kernel.process.returncode, 0)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_action_order(self):
+        ws = yield self.connect('threads_py')
+        ws.write_message(json.dumps({'signal': 'work', 'load': 0.3}))
+        ws.write_message(json.dumps({'signal': 'work', 'load': 0.0}))
+        self.assertEqual((yield self.signals(ws, 2)),
+                         [('work', 0.3), ('work', 0.0)])
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=20)
+    def test_state_on_kernel_loop(self):
+        ws = yield self.connect('threads_py')
+        ws.write_message(json.dumps({'signal': 'write'}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'writers':
+                break
+        self.assertEqual(msg['load'], ['MainThread'])
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    def test_ordering(self):
+        with self.assertRaises(ValueError):
+            databench_py.multithread.Meta('threads_py', databench.Analysis,
+                                          ordering='random')
+
+
+@unittest.skipIf(pyspark is None, 'pyspark is not installed')
+class SharedSpark(KernelZMQ):
+    # a separate package, so that other tests do not start a Spark driver
+    analyses = 'databench.tests.analyses_spark'
+
+    @tornado.gen.coroutine
+    def count(self, ws, n):
+        ws.write_message(json.dumps({'signal': 'count', 'load': n}))
+        while True:
+            msg = json.loads((yield ws.read_message()))
+            if msg['signal'] == 'count':
+                raise tornado.gen.Return(msg['load'])
+
+    @tornado.testing.gen_test(timeout=300)
+    def test_kernel(self):
+        ws = yield self.connect('spark_pyspark')
+        count = yield self.count(ws, 10)
+        self.assertEqual(count['count'], 10)
+        self.assertEqual(count['pool'], ws.analysis_id)
+        ws.close()
+        yield tornado.gen.sleep(0.3)
+
+    @tornado.testing.gen_test(timeout=300)
+    def test_shared_context(self):
+        ws1 = yield self.connect('spark_pyspark')
+        ws2 = yield self.connect('spark_pyspark')
+        count1, count2 = yield [self.count(ws1, 100), self.count(ws2, 200)]
+
+        self.assertEqual((count1['count'], count2['count']), (100, 200))
+        self.assertEqual(count1['application_id'], count2['application_id'])
+        self.assertNotEqual(count1['pool'], count2['pool'])
+        self.assertEqual(len(self.meta('spark_pyspark').kernels), 1)
+        ws1.close()
+        ws2.close()
+        yield tornado.gen.sleep(0.3)
+
+
+class ConnectLatency(tornado.testing.AsyncHTTPTestCase):
+    """Time from opening the WebSocket to the first state update from
+    the dummypi_py kernel."""
+
+    def get_app(self):
+        self.app = databench.App('databench.analyses_packaged',
+                                 kernel_pool=1)
+        return self.app.tornado_app()
+
+    def tearDown(self):
+        for meta in self.app.metas:
+            if isinstance(meta, databench.MetaZMQ):
+                meta.close_kernels()
+        super(ConnectLatency, self).tearDown()
+
+    @tornado.gen.coroutine
+    def connect_latency(self):
+        url = 'ws://127.0.0.1:{}/dummypi_py/ws'.format(self.get_http_port())
+        start = time.time()
+        ws = yield tornado.websocket.websocket_connect(url)
+        ws.write_message(json.dumps({'__connect': None}))
+        while json.loads((yield ws.read_message()))['signal'] != 'data':
+            pass
+        latency = time.time() - start
+        ws.close()
+        raise tornado.gen.Return(latency)
+
+    @tornado.gen.coroutine
+    def wait_for_pool(self, meta):
+        while not meta.pool or not meta.pool[0].handshake:
+            yield tornado.gen.sleep(0.01)
+
+    @tornado.testing.gen_test(timeout=60)
+    def test_benchmark(self):
+        meta = next(m for m in self.app.metas if m.name == 'dummypi_py')
+        cold, warm = [], []
+        for _ in range(3):
+            meta.kernel_pool = 0
+            meta.close_kernels()
+            cold.append((yield self.connect_latency()))
+
+            meta.kernel_pool = 1
+            meta.fill_pool()
+            yield self.wait_for_pool(meta)
+            warm.append((yield self.connect_latency()))
+        yield tornado.gen.sleep(0.3)
+        print('dummypi_py connect latency: cold start {:.3f}s, '
+              'warm pool {:.3f}s'.format(min(cold), min(warm)))
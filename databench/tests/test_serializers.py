@@ -0,0 +1,87 @@
+from databench import utils
+import databench
+import numpy as np
+import timeit
+import unittest
+
+PAYLOADS = {
+    'scalars': {'progress': 0.5, 'status': 'running', 'count': 42},
+    'records': [{'x': i * 0.5, 'y': [i, i + 1, i + 2], 'label': str(i)}
+                for i in range(1000)],
+    'array': np.arange(10000, dtype=np.float64),
+}
+
+
+def available_serializers():
+    serializers = []
+    for serializer_class in utils.SERIALIZERS.values():
+        try:
+            serializers.append(serializer_class())
+        except ImportError:
+            pass
+    return serializers
+
+
+class Serializers(unittest.TestCase):
+    def tearDown(self):
+        utils.use_serializer('json')
+
+    def test_default(self):
+        self.assertEqual(utils.serializer.name, 'json')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, utils.use_serializer, 'unknown')
+
+    def test_auto(self):
+        serializer = utils.use_serializer('auto')
+        self.assertIs(utils.serializer, serializer)
+        self.assertIn(serializer.name, utils.SERIALIZERS)
+
+    def test_round_trip(self):
+        for serializer in available_serializers():
+            for name, payload in PAYLOADS.items():
+                decoded = serializer.loads(serializer.dumps(payload))
+                if name == 'array':
+                    payload = payload.tolist()
+                self.assertEqual(decoded, payload,
+                                 (serializer.name, name))
+
+    def test_set(self):
+        for serializer in available_serializers():
+            self.assertEqual(serializer.loads(serializer.dumps({1, 2})),
+                             [1, 2])
+
+    def test_datastore(self):
+        for serializer in available_serializers():
+            utils.use_serializer(serializer.name)
+            d = databench.Datastore('serializers', release_storage=True)
+            d['records'] = PAYLOADS['records'][:10]
+            self.assertEqual(d['records'], PAYLOADS['records'][:10])
+            self.assertEqual(d.set('records', PAYLOADS['records'][:10]), [])
+            d.close()
+
+    def test_register(self):
+        class Custom(utils.StdlibSerializer):
+            name = 'custom'
+
+        utils.register_serializer(Custom)
+        self.assertEqual(utils.use_serializer('custom').name, 'custom')
+        del utils.SERIALIZERS['custom']
+
+    def test_benchmark(self):
+        for name, payload in PAYLOADS.items():
+            timings = []
+            for serializer in available_serializers():
+                encoded = serializer.dumps(payload)
+                t_dumps = min(timeit.repeat(
+                    lambda: serializer.dumps(payload), number=10, repeat=3))
+                t_loads = min(timeit.repeat(
+                    lambda: serializer.loads(encoded), number=10, repeat=3))
+                timings.append('{}: dumps {:.2e}s, loads {:.2e}s'
+                               ''.format(serializer.name,
+                                         t_dumps / 10, t_loads / 10))
+            print('{}: {}'.format(name, '; '.join(timings)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,19 @@
 """Utility functions."""
 
+from collections import OrderedDict
 import base64
+import hashlib
 import io
 import json
+import struct
 
 try:
     import numpy as np
 except ImportError:
     np = None
 
+STRING_TYPES = (str, type(u''))
+
 
 def json_encoder_default(obj):
     """Handle more data types than the default JSON encoder.
@@ -24,7 +29,9 @@ def json_encoder_default(obj):
             elif np.issubdtype(obj.dtype, np.floating):
                 return float(obj)
 
-    if isinstance(obj, set):
+    if isinstance(obj, RawJSON):
+        return obj.decode()
+    elif isinstance(obj, set):
         return list(obj)
     elif hasattr(obj, 'to_native'):
         # DatastoreList, DatastoreDict
@@ -36,6 +43,202 @@ def json_encoder_default(obj):
     return obj
 
 
+class RawJSON(object):
+    """A value that is already JSON encoded.
+
+    Wrapping an encoded string in this class marks it to be spliced verbatim
+    into outgoing messages by :func:`json_dumps` instead of being decoded and
+    encoded again.
+
+    :param str encoded: JSON encoded value.
+    :param dict buffers: binary data for array placeholders in the encoded
+        value (see :func:`extract_buffers`)
+    """
+    __slots__ = ('encoded', 'buffers')
+
+    def __init__(self, encoded, buffers=None):
+        self.encoded = encoded
+        self.buffers = buffers
+
+    def decode(self):
+        """Return the decoded value."""
+        if self.buffers:
+            return restore_buffers(loads(self.encoded), self.buffers)
+        return loads(self.encoded)
+
+    def __repr__(self):
+        return 'RawJSON({})'.format(self.encoded)
+
+
+class Serializer(object):
+    """JSON serializer backend.
+
+    Serializers are registered with :func:`register_serializer` and
+    selected with :func:`use_serializer`. All encoding and decoding for
+    datastores and messages goes through :func:`dumps` and :func:`loads`.
+    """
+    name = None
+
+    def dumps(self, obj):
+        """Encode to a JSON `str`."""
+        raise NotImplementedError
+
+    def loads(self, encoded):
+        """Decode a JSON `str` or `bytes`."""
+        raise NotImplementedError
+
+
+class StdlibSerializer(Serializer):
+    """Serializer using the `json` module from the standard library."""
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=json_encoder_default)
+
+    def loads(self, encoded):
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode('utf-8')
+        return json.loads(encoded)
+
+
+class UjsonSerializer(Serializer):
+    """Serializer using `ujson`.
+
+    :raises ImportError: when ujson is not installed
+    """
+    name = 'ujson'
+
+    def __init__(self):
+        import ujson
+        self.ujson = ujson
+
+    def dumps(self, obj):
+        return self.ujson.dumps(obj, default=json_encoder_default,
+                                escape_forward_slashes=False)
+
+    def loads(self, encoded):
+        return self.ujson.loads(encoded)
+
+
+class OrjsonSerializer(Serializer):
+    """Serializer using `orjson` with native support for numpy arrays.
+
+    orjson encodes `NaN` and `Infinity` as `null`. Values that orjson
+    cannot handle (e.g. integers that do not fit into 64 bits) are encoded
+    with the standard library.
+
+    :raises ImportError: when orjson is not installed
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj):
+        try:
+            return self.orjson.dumps(obj, default=json_encoder_default,
+                                     option=self.options).decode('utf-8')
+        except TypeError:
+            return json.dumps(obj, default=json_encoder_default)
+
+    def loads(self, encoded):
+        try:
+            return self.orjson.loads(encoded)
+        except ValueError:
+            # NaN and Infinity from the standard library
+            return StdlibSerializer().loads(encoded)
+
+
+SERIALIZERS = OrderedDict([
+    ('orjson', OrjsonSerializer),
+    ('ujson', UjsonSerializer),
+    ('json', StdlibSerializer),
+])
+serializer = StdlibSerializer()
+
+
+def register_serializer(serializer_class):
+    """Register a :class:`Serializer` class under its name."""
+    SERIALIZERS[serializer_class.name] = serializer_class
+
+
+def use_serializer(name='json'):
+    """Select the serializer for datastores and messages.
+
+    :param str name: name of a registered serializer or ``auto`` for the
+        first available of orjson, ujson and json
+    :raises ImportError: when the serializer is not installed
+    :rtype: Serializer
+    """
+    global serializer
+
+    if name == 'auto':
+        for serializer_class in SERIALIZERS.values():
+            try:
+                serializer = serializer_class()
+            except ImportError:
+                continue
+            break
+        return serializer
+
+    if name not in SERIALIZERS:
+        raise ValueError('unknown serializer {}'.format(name))
+    serializer = SERIALIZERS[name]()
+    return serializer
+
+
+def dumps(obj):
+    """Encode with the current serializer.
+
+    :rtype: str
+    """
+    return serializer.dumps(obj)
+
+
+def loads(encoded):
+    """Decode with the current serializer."""
+    return serializer.loads(encoded)
+
+
+def json_dumps(obj, depth=3):
+    """JSON encode with support for :class:`RawJSON`.
+
+    `RawJSON` values inside dictionaries up to the given nesting depth are
+    spliced into the output without decoding. Deeper `RawJSON` values are
+    decoded and encoded again by :func:`json_encoder_default`. Everything
+    else is encoded with the current serializer (see :func:`dumps`).
+
+    :param obj: object to encode
+    :param int depth: nesting depth of dictionaries to search for `RawJSON`
+    :rtype: str
+    """
+    if isinstance(obj, RawJSON):
+        return obj.encoded
+    if depth and isinstance(obj, dict) and \
+       all(isinstance(k, STRING_TYPES) for k in obj):
+        return '{' + ', '.join(
+            '{}: {}'.format(json.dumps(k), json_dumps(v, depth - 1))
+            for k, v in obj.items()
+        ) + '}'
+    return dumps(obj)
+
+
+def resolve_raw_json(obj):
+    """Replace :class:`RawJSON` values in a (dict) message with decoded values.
+
+    :rtype: same type as obj
+    """
+    if isinstance(obj, RawJSON):
+        return obj.decode()
+    if isinstance(obj, dict) and \
+       any(isinstance(v, RawJSON) for v in obj.values()):
+        return {k: v.decode() if isinstance(v, RawJSON) else v
+                for k, v in obj.items()}
+    return obj
+
+
 def fig_to_src(figure, image_format='png', dpi=80):
     """Convert a matplotlib figure to an inline HTML image.
 
@@ -65,6 +268,250 @@ def png_to_src(png):
     return 'data:image/png;base64,' + base64.b64encode(png).decode()
 
 
+# dtypes that map to JavaScript TypedArrays
+BINARY_DTYPES = ('int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32',
+                 'float32', 'float64', 'bool')
+
+
+def _array_data(array, copy=True):
+    """Little-endian data of an array or None if it has no binary form.
+
+    Without ``copy``, the data is a memoryview that shares memory with the
+    array if it is contiguous and little-endian already.
+    """
+    if array.dtype.name in ('int64', 'uint64'):
+        # JavaScript numbers are doubles: send as float64 if lossless
+        if array.size and np.abs(array).max() >= 2 ** 53:
+            return None, None
+        array = array.astype('float64')
+    if array.dtype.name not in BINARY_DTYPES:
+        return None, None
+    data = np.ascontiguousarray(array,
+                                dtype=array.dtype.newbyteorder('<'))
+    if not copy:
+        return array.dtype.name, memoryview(data.reshape(-1).view('uint8'))
+    return array.dtype.name, data.tobytes()
+
+
+def _bytes_data(obj, copy=True):
+    """Data of bytes, bytearray and memoryview objects."""
+    if isinstance(obj, bytes):
+        return obj
+    if copy or np is None:
+        return bytes(obj)
+    return memoryview(np.frombuffer(obj, dtype='uint8'))
+
+
+def extract_buffers(obj, buffers, content_ids=False, copy=True):
+    """Replace numpy arrays with placeholders and collect their data.
+
+    An array is replaced by
+    ``{"__ndarray": id, "dtype": dtype, "shape": shape}`` and its
+    little-endian data is added to ``buffers`` under that id. Arrays with
+    dtypes that do not map to a JavaScript TypedArray are left in place
+    and are encoded as lists. Binary data in ``bytes``, ``bytearray`` and
+    ``memoryview`` objects becomes a ``uint8`` array. The buffers of
+    :class:`RawJSON` values are collected as well.
+
+    :param obj: object to search for arrays
+    :param dict buffers: collects the binary data by id
+    :param bool content_ids: use a hash of the data as id instead of a
+        counter, so that equal arrays have equal placeholders
+    :param bool copy: collect copies of the data instead of memoryviews
+        that share memory with the arrays where possible
+    :returns: obj with placeholders
+    """
+    if isinstance(obj, RawJSON):
+        if obj.buffers:
+            buffers.update(obj.buffers)
+        return obj
+    if isinstance(obj, dict):
+        return {k: extract_buffers(v, buffers, content_ids, copy)
+                for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [extract_buffers(v, buffers, content_ids, copy) for v in obj]
+    if np is not None and isinstance(obj, np.ndarray):
+        dtype, data = _array_data(obj, copy)
+        if data is None:
+            return obj
+        shape = list(obj.shape)
+    elif isinstance(obj, (bytes, bytearray, memoryview)) and \
+            not isinstance(obj, str):
+        # (in Python 2, str is bytes and stays text)
+        dtype, data = 'uint8', _bytes_data(obj, copy)
+        shape = [len(data)]
+    else:
+        return obj
+    if content_ids:
+        id_ = hashlib.sha1(data).hexdigest()
+    else:
+        id_ = 'b{}'.format(len(buffers))
+    buffers[id_] = data
+    return {'__ndarray': id_, 'dtype': dtype, 'shape': shape}
+
+
+def restore_buffers(obj, buffers, copy=True):
+    """Replace placeholders created by :func:`extract_buffers` with arrays.
+
+    :param obj: decoded object with placeholders
+    :param dict buffers: binary data by id
+    :param bool copy: return writable copies instead of read-only arrays
+        that share memory with the buffers
+    """
+    if isinstance(obj, dict):
+        if '__ndarray' in obj and obj['__ndarray'] in buffers and \
+           np is not None:
+            array = np.frombuffer(
+                buffers[obj['__ndarray']],
+                dtype=np.dtype(obj['dtype']).newbyteorder('<'),
+            ).reshape(obj['shape'])
+            return array.copy() if copy else array
+        return {k: restore_buffers(v, buffers, copy) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [restore_buffers(v, buffers, copy) for v in obj]
+    return obj
+
+
+def _pad(length, alignment=8):
+    return b'\x00' * (-length % alignment)
+
+
+def pack_frame(encoded, buffers):
+    """Pack an encoded message and binary buffers into one binary frame.
+
+    See :func:`pack_frame_parts` for the layout.
+
+    :param str encoded: JSON encoded message
+    :param dict buffers: binary data by id
+    :rtype: bytes
+    """
+    return b''.join(pack_frame_parts(encoded, buffers))
+
+
+def pack_frame_parts(encoded, buffers):
+    """The parts of a binary frame that concatenated give :func:`pack_frame`.
+
+    The buffers are parts of their own and are not copied.
+
+    Layout: the length of the header as little-endian uint32, the header
+    ``{"buffers": {id: [offset, length]}, "message": message}`` as UTF-8,
+    padding and the buffers. Offsets are relative to the start of the
+    buffers, which is the end of the header rounded up to a multiple of
+    eight bytes. All offsets are multiples of eight bytes so that buffers
+    can be viewed as TypedArrays without copying.
+
+    :param str encoded: JSON encoded message
+    :param dict buffers: binary data by id
+    :rtype: list
+    """
+    offsets, offset = OrderedDict(), 0
+    for id_, data in buffers.items():
+        offsets[id_] = [offset, len(data)]
+        offset += len(data) + len(_pad(len(data)))
+
+    header = '{{"buffers": {}, "message": {}}}'.format(
+        json.dumps(offsets), encoded).encode('utf-8')
+    parts = [b''.join((struct.pack('<I', len(header)), header,
+                       _pad(4 + len(header))))]
+    for data in buffers.values():
+        parts.append(data)
+        if len(data) % 8:
+            parts.append(_pad(len(data)))
+    return parts
+
+
+def unpack_frame(frame):
+    """Unpack a frame created by :func:`pack_frame`.
+
+    :returns: decoded message and binary buffers by id
+    :rtype: tuple
+    """
+    header_length = struct.unpack('<I', frame[:4])[0]
+    header = loads(frame[4:4 + header_length])
+    start = 4 + header_length + len(_pad(4 + header_length))
+    buffers = {id_: frame[start + offset:start + offset + length]
+               for id_, (offset, length) in header['buffers'].items()}
+    return header['message'], buffers
+
+
+def encode_frame(obj, binary=False):
+    """Encode a message for the frontend.
+
+    Messages with binary buffers (from numpy arrays when ``binary`` is set
+    or from :class:`RawJSON` values) are packed with :func:`pack_frame`.
+
+    :param obj: message
+    :param bool binary: send numpy arrays as binary buffers
+    :returns: encoded message and whether it is a binary frame
+    :rtype: tuple
+    """
+    parts, binary = encode_frame_parts(obj, binary)
+    if len(parts) == 1:
+        return parts[0], binary
+    return b''.join(parts), binary
+
+
+def encode_frame_parts(obj, binary=False, copy=True):
+    """Encode a message for the frontend in parts.
+
+    Like :func:`encode_frame`, but the binary buffers are not joined
+    into one frame. This lets them be sent as separate ZMQ frames.
+
+    :param obj: message
+    :param bool binary: send numpy arrays as binary buffers
+    :param bool copy: collect memoryviews instead of copies of array data
+        where possible
+    :returns: parts of the encoded message and whether it is a binary frame
+    :rtype: tuple
+    """
+    buffers = OrderedDict()
+    if binary:
+        obj = extract_buffers(obj, buffers, copy=copy)
+    else:
+        _collect_raw_buffers(obj, buffers)
+    encoded = json_dumps(obj)
+    if not buffers:
+        return [encoded.encode('utf-8')], False
+    return pack_frame_parts(encoded, buffers), True
+
+
+class EncodedFrame(object):
+    """A message for the frontend that is already encoded.
+
+    Language kernels encode their messages with :func:`encode_frame`.
+    Emitting an instance of this class sends the frame to the frontend
+    verbatim instead of decoding and encoding the message again.
+
+    :param bytes frame: encoded message
+    :param bool binary: whether this is a binary frame
+    """
+    __slots__ = ('frame', 'binary')
+
+    def __init__(self, frame, binary=False):
+        self.frame = frame
+        self.binary = binary
+
+    def decode(self):
+        """Return the decoded message."""
+        if self.binary:
+            message, buffers = unpack_frame(self.frame)
+            return restore_buffers(message, buffers)
+        return loads(self.frame)
+
+    def __repr__(self):
+        return 'EncodedFrame({} bytes, binary={})'.format(len(self.frame),
+                                                          self.binary)
+
+
+def _collect_raw_buffers(obj, buffers, depth=3):
+    if isinstance(obj, RawJSON):
+        if obj.buffers:
+            buffers.update(obj.buffers)
+    elif depth and isinstance(obj, dict):
+        for v in obj.values():
+            _collect_raw_buffers(v, buffers, depth - 1)
+
+
 def svg_to_src(svg):
     """Convert an SVG string to a format that can be passed into a src.
 
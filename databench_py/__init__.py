@@ -7,3 +7,4 @@ __version__ = "0.7b13"
 
 
 from . import singlethread
+from . import multithread
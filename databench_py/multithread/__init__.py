@@ -0,0 +1,6 @@
+"""Databench Python kernel module with a pool of worker threads."""
+# flake8: noqa
+
+__version__ = "0.1.0"
+
+from .meta import Meta
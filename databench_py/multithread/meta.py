@@ -0,0 +1,158 @@
+"""Meta class for a Databench Python kernel with worker threads."""
+
+from ..singlethread import meta as singlethread
+from databench.executor import ioloop_call, run_thread
+import concurrent.futures
+import logging
+import threading
+import tornado.concurrent
+import tornado.gen
+import zmq.eventloop.ioloop
+
+log = logging.getLogger(__name__)
+
+
+class Meta(singlethread.Meta):
+    """Class providing Meta information about analyses.
+
+    For Python kernels that run actions on a pool of worker threads. The
+    event loop of the kernel keeps receiving messages while actions run, so
+    that for example a ``cancel`` action can reach an analysis instance
+    while a long computation is in progress.
+
+    Every action runs on an event loop of its worker thread, so action
+    handlers can be coroutines as usual. Calls of ``emit``, ``set_state``
+    and ``set_class_state`` are run on the event loop of the kernel which
+    owns the ZMQ socket and the datastores. Other writes to the datastores
+    from action handlers are not thread-safe. The ``connect``,
+    ``args``, ``connected`` and ``disconnected`` actions of an instance run
+    on the event loop of the kernel after all earlier actions of the
+    instance completed and before any later action starts.
+
+    By default, calls of the same action of an instance run in order and
+    different actions of an instance run concurrently, so their handlers
+    must be thread-safe with respect to each other. Use ordering
+    ``instance`` to run all actions of an instance one after the other;
+    then a ``cancel`` action waits until the running action completed.
+
+    Args:
+        name (str): Name of this analysis.
+        analysis_class (Analysis): Analysis class.
+        max_workers (int): Number of worker threads.
+        ordering (str): ``action`` (default) runs calls of the same action
+            of an instance in order and different actions concurrently,
+            ``instance`` runs the actions of an analysis instance one after
+            the other and ``none`` runs all actions concurrently.
+
+    """
+
+    orderings = ('instance', 'action', 'none')
+    lifecycle_actions = ('connect', 'args', 'connected', 'disconnected')
+
+    def __init__(self, name, analysis_class, max_workers=4,
+                 ordering='action'):
+        if ordering not in self.orderings:
+            raise ValueError('unknown ordering {}'.format(ordering))
+        self.ordering = ordering
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.ioloop = zmq.eventloop.ioloop.IOLoop.current()
+        self.ioloop_thread = threading.current_thread()
+
+        # per analysis instance: the last lifecycle action, the actions
+        # in progress and the last action for every ordering key
+        self._barriers = {}
+        self._running = {}
+        self._tails = {}
+
+        super(Meta, self).__init__(name, analysis_class)
+
+    def emit(self, signal, message, analysis_id):
+        """Emit signal to main from any thread."""
+        if threading.current_thread() is self.ioloop_thread:
+            super(Meta, self).emit(signal, message, analysis_id)
+            return
+        self.ioloop.add_callback(super(Meta, self).emit,
+                                 signal, message, analysis_id)
+
+    def ordering_key(self, action_name):
+        """Actions with the same key run one after the other."""
+        if self.ordering == 'instance':
+            return 'instance'
+        elif self.ordering == 'action':
+            return action_name
+        return None
+
+    def run_process(self, analysis, action_name, message='__nomessagetoken__'):
+        """Schedule an action of an analysis instance.
+
+        Returns:
+            Future: resolves when the action completed
+
+        """
+        id_ = analysis.id_
+        running = self._running.setdefault(id_, set())
+        tails = self._tails.setdefault(id_, {})
+
+        if action_name in self.lifecycle_actions:
+            future = self._run_after(
+                [self._barriers.get(id_)] + list(running),
+                lambda: self.run_handlers(analysis, action_name, message),
+            )
+            self._barriers[id_] = future
+            if action_name == 'disconnected':
+                self.ioloop.add_future(future,
+                                       lambda _: self._forget(id_))
+            return future
+
+        key = self.ordering_key(action_name)
+        future = self._run_after(
+            [self._barriers.get(id_), tails.get(key)],
+            lambda: self.executor.submit(self.run_worker,
+                                         analysis, action_name, message),
+        )
+        if key is not None:
+            tails[key] = future
+        running.add(future)
+        self.ioloop.add_future(future, lambda f: running.discard(f))
+        return future
+
+    @tornado.gen.coroutine
+    def _run_after(self, dependencies, start):
+        for dependency in dependencies:
+            if dependency is None:
+                continue
+            try:
+                yield dependency
+            except Exception:
+                pass
+        try:
+            yield start()
+        except Exception:
+            log.exception('action failed in kernel {}'.format(self.kernel_id))
+
+    @tornado.gen.coroutine
+    def run_handlers(self, analysis, action_name, message):
+        """Run the handlers of an action and wait for them to complete.
+
+        Called on the thread that runs the action.
+        """
+        results = super(Meta, self).run_process(analysis, action_name,
+                                                message)
+        yield [r for r in results if tornado.concurrent.is_future(r)]
+
+    def run_worker(self, analysis, action_name, message):
+        """Run an action on the event loop of the current worker thread."""
+        def run():
+            yield self.run_handlers(analysis, action_name, message)
+            yield ioloop_call(analysis.flush_state)
+        run_thread(self.ioloop, run)
+
+    def _forget(self, analysis_id):
+        self._barriers.pop(analysis_id, None)
+        self._running.pop(analysis_id, None)
+        self._tails.pop(analysis_id, None)
+
+    def shutdown(self):
+        """Stop accepting actions and shut down."""
+        self.executor.shutdown(wait=False)
+        super(Meta, self).shutdown()
@@ -1,11 +1,13 @@
 """Meta class for Databench Python kernel."""
 
 import databench
-from databench.utils import json_encoder_default
+from databench import utils
+from databench.executor import ioloop_call
 import functools
-import json
 import logging
+import os
 import sys
+import time
 import zmq
 
 log = logging.getLogger(__name__)
@@ -16,85 +18,109 @@ class Meta(object):
 
     For Python kernels.
 
+    Started with ``--multiplex``, the kernel hosts many instances of the
+    analysis in one process. Messages are routed by their analysis id and an
+    instance is created for every new analysis id.
+
+    Messages emitted within one iteration of the event loop are sent to the
+    main process in a single ZMQ message. A batch is sent early when it
+    holds ``max_batch_size`` messages or its first message is older than
+    ``max_batch_delay`` seconds, so that actions that emit in a long
+    running loop without yielding still stream their updates.
+
     Args:
         name (str): Name of this analysis.
         analysis_class (Analysis): Analysis class.
 
     """
 
+    max_batch_size = 100
+    max_batch_delay = 0.05
+
     def __init__(self, name, analysis_class):
         self.name = name
-        analysis_id, zmq_port_subscribe, zmq_port_publish = None, None, None
+        self.analysis_class = analysis_class
+        self.analysis = None
+        self.analyses = {}
+        self.multiplex = '--multiplex' in sys.argv
+        self._outbox = []
+        self._outbox_started = None
+        analysis_id, kernel_id = None, None
+        zmq_router = None
         for cl in sys.argv:
             if cl.startswith('--analysis-id'):
                 analysis_id = cl.partition('=')[2]
-            if cl.startswith('--zmq-subscribe'):
-                zmq_port_subscribe = cl.partition('=')[2]
-            if cl.startswith('--zmq-publish'):
-                zmq_port_publish = cl.partition('=')[2]
+            if cl.startswith('--kernel-id'):
+                kernel_id = cl.partition('=')[2]
+            if cl.startswith('--zmq-router'):
+                zmq_router = cl.partition('=')[2]
+        # a kernel started for a pool waits for an analysis id
+        self.kernel_id = kernel_id or analysis_id
+
+        log.info('Analysis id: {}, kernel id: {}, router: {}'
+                 ''.format(analysis_id, self.kernel_id, zmq_router))
 
-        log.info('Analysis id: {}, port sub: {}, port pub: {}'.format(
-                 analysis_id, zmq_port_subscribe, zmq_port_publish))
+        # use the same serializer as the main process if available
+        try:
+            utils.use_serializer(
+                os.environ.get('DATABENCH_SERIALIZER', 'json'))
+        except ImportError:
+            log.warning('serializer {} not available, using json'
+                        ''.format(os.environ['DATABENCH_SERIALIZER']))
 
         databench.Meta.fill_action_handlers(analysis_class)
+        if analysis_id is not None:
+            self.assign(analysis_id)
+
+        self._init_zmq(zmq_router)
+        log.info('Language kernel {} for {} initialized.'
+                 ''.format(self.kernel_id, self.name))
 
-        self.analysis = analysis_class()
-        self.analysis.init_databench(analysis_id)
+    def assign(self, analysis_id):
+        """Create the analysis instance for the given analysis id."""
+        analysis = self.analysis_class()
+        analysis.init_databench(analysis_id)
 
         def emit(signal, message='__nomessagetoken__'):
             self.emit(signal, message, analysis_id)
-        self.analysis.set_emit_fn(emit)
+        analysis.set_emit_fn(emit)
 
-        self._init_zmq(zmq_port_publish, zmq_port_subscribe)
-        log.info('Language kernel for {} initialized with '
-                 'analysis id {}.'.format(self.name, self.analysis.id_))
+        self.analyses[analysis_id] = analysis
+        if not self.multiplex:
+            self.analysis = analysis
+        log.info('kernel {} assigned to analysis {}'
+                 ''.format(self.kernel_id, analysis_id))
+        return analysis
 
-    def _init_zmq(self, port_publish, port_subscribe):
+    def _init_zmq(self, router):
         """Initialize zmq messaging.
 
-        Listen on sub_port. This port might at
-        some point receive the message to start publishing on a certain
-        port, but until then, no publishing.
-        """
-
-        log.debug('kernel {} publishing on port {}'
-                  ''.format(self.analysis.id_, port_publish))
-        self.zmq_publish = zmq.Context().socket(zmq.PUB)
-        self.zmq_publish.connect('tcp://127.0.0.1:{}'.format(port_publish))
+        Connect a DEALER socket with the kernel id as identity to the
+        ROUTER socket of the main process and send the handshake. The
+        handshake is queued until the connection is established, so unlike
+        on the legacy PUB/SUB transport it is sent once and the main process
+        does not need to acknowledge it.
 
-        log.debug('kernel {} subscribed on port {}'
-                  ''.format(self.analysis.id_, port_subscribe))
-        self.zmq_sub_ctx = zmq.Context()
-        self.zmq_sub = self.zmq_sub_ctx.socket(zmq.SUB)
-        self.zmq_sub.setsockopt(zmq.SUBSCRIBE,
-                                self.analysis.id_.encode('utf-8'))
-        self.zmq_sub.connect('tcp://127.0.0.1:{}'.format(port_subscribe))
+        Args:
+            router (str): endpoint like ``ipc:///tmp/databench/kernels``
+                or a port on localhost.
 
-        self.zmq_stream_sub = zmq.eventloop.zmqstream.ZMQStream(self.zmq_sub)
-        self.zmq_stream_sub.on_recv(self.zmq_listener)
+        """
 
-        # send zmq handshakes until a zmq ack is received
-        self.zmq_ack = False
-        self.send_handshake()
+        if '://' not in router:
+            router = 'tcp://127.0.0.1:{}'.format(router)
+        log.debug('kernel {} connecting to {}'.format(self.kernel_id, router))
+        self.zmq_ctx = zmq.Context()
+        self.zmq_socket = self.zmq_ctx.socket(zmq.DEALER)
+        self.zmq_socket.setsockopt(zmq.IDENTITY,
+                                   self.kernel_id.encode('utf-8'))
+        self.zmq_socket.connect(router)
 
-    def send_handshake(self):
-        if self.zmq_ack:
-            return
+        self.zmq_stream = zmq.eventloop.zmqstream.ZMQStream(self.zmq_socket)
+        self.zmq_stream.on_recv(self.zmq_listener)
 
-        log.debug('kernel {} send handshake'.format(self.analysis.id_))
-        try:
-            self.zmq_publish.send_json({
-                '__zmq_handshake': None,
-            })
-        except zmq.error.ZMQError:
-            # socket was closed (maybe main databench process terminated)
-            return
-
-        # check again in a bit
-        zmq.eventloop.ioloop.IOLoop.current().call_later(
-            0.5,
-            self.send_handshake
-        )
+        log.debug('kernel {} send handshake'.format(self.kernel_id))
+        self.zmq_socket.send_json({'__zmq_handshake': None})
 
     def run_process(self, analysis, action_name, message='__nomessagetoken__'):
         """Executes an process in the analysis with the given message.
@@ -103,6 +129,10 @@ class Meta(object):
         is given.
 
         This method is similar to the method in databench.Analysis.
+
+        Returns:
+            list: the results of the action handlers, usually futures
+
         """
 
         # detect process_id
@@ -119,6 +149,7 @@ class Meta(object):
             for class_fn in (analysis._action_handlers.get(action_name, []) +
                              analysis._action_handlers.get('*', []))
         ]
+        results = []
         if fns:
             args, kwargs = [], {}
 
@@ -135,7 +166,7 @@ class Meta(object):
 
             for fn in fns:
                 log.debug('kernel calling {}'.format(fn))
-                fn(*args, **kwargs)
+                results.append(fn(*args, **kwargs))
         else:
             # default is to store action name and data as key and value
             # in analysis.data
@@ -145,7 +176,8 @@ class Meta(object):
             value = message if message != '__nomessagetoken__' else None
             if hasattr(analysis.data, 'set_state'):
                 # TODO(sven): add deprecation warning here?
-                analysis.data.set_state({action_name: value})
+                results.append(ioloop_call(analysis.data.set_state,
+                                           {action_name: value}))
             else:
                 # TODO(sven): add deprecation warning here?
                 analysis.data[action_name] = value
@@ -155,13 +187,32 @@ class Meta(object):
         if process_id:
             analysis.emit('__process', {'id': process_id, 'status': 'end'})
 
-        if action_name == 'disconnected':
+        if action_name == 'disconnected' and self.multiplex:
+            log.debug('kernel {} removing analysis {}'
+                      ''.format(self.kernel_id, analysis.id_))
+            analysis.flush_state()
+            analysis.close_datastores()
+            # the kernel outlives the instance and does not evict idle
+            # domains, so the data of the instance is deleted
+            databench.Datastore.release(analysis.id_)
+            del self.analyses[analysis.id_]
+            self.flush_outbox()
+            self.zmq_socket.send_json({'__zmq_disconnected': analysis.id_})
+        elif action_name == 'disconnected':
             log.debug('kernel {} shutting down'.format(analysis.id_))
-            self.zmq_publish.close()
+            analysis.flush_state()
+            self.flush_outbox()
+            self.zmq_socket.send_json({'__zmq_disconnected': analysis.id_})
+            self.shutdown()
+
+        return results
 
-            self.zmq_stream_sub.close()
-            self.zmq_sub.close()
-            self.zmq_sub_ctx.destroy()
+    def shutdown(self):
+        """Deliver queued messages, close the connection to main and stop
+        the event loop so that the kernel process exits."""
+        self.zmq_stream.close(linger=1000)
+        self.zmq_ctx.term()
+        zmq.eventloop.ioloop.IOLoop.current().stop()
 
     def event_loop(self):
         """Event loop."""
@@ -171,22 +222,54 @@ class Meta(object):
             zmq.eventloop.ioloop.IOLoop.current().stop()
 
     def zmq_listener(self, multipart):
-        msg = (b''.join(multipart)).decode('utf-8')
-        log.debug('kernel msg: {}'.format(msg))
-        msg = json.loads(msg.partition('|')[2])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('kernel msg: {}'.format(multipart[0]))
+        msg = utils.loads(multipart[0])
 
-        if '__zmq_ack' in msg:
-            log.debug('kernel {} received zmq_ack'.format(self.analysis.id_))
-            self.zmq_ack = True
+        if '__assign' in msg:
+            if self.analysis is None:
+                self.assign(msg['__assign'])
             return
 
         if 'signal' not in msg or 'load' not in msg:
             return
 
+        if self.multiplex:
+            analysis = self.analyses.get(msg.get('analysis_id'))
+            if analysis is None:
+                if msg['signal'] != 'connect':
+                    return
+                analysis = self.assign(msg['analysis_id'])
+        else:
+            analysis = self.analysis
+            if analysis is None:
+                return
+
+        if '__sync' in msg:
+            self.sync(analysis, msg['__sync'])
+            if msg['signal'] == '__sync':
+                return
+
         # standard message
         action_name = msg['signal']
         log.debug('kernel processing {}'.format(action_name))
-        self.run_process(self.analysis, action_name, msg['load'])
+        self.run_process(analysis, action_name, msg['load'])
+
+    def sync(self, analysis, sync):
+        """Send the state of an analysis instance to a connecting
+        frontend.
+
+        Args:
+            analysis (Analysis): The analysis instance.
+            sync (dict): ``revisions`` the frontend has from an earlier
+                connection. Without them, a snapshot is sent. With
+                ``force``, the snapshot is also sent when it is empty.
+
+        """
+        if sync.get('revisions'):
+            analysis.resync(sync['revisions'])
+        else:
+            analysis.emit_snapshot(force=sync.get('force', False))
 
     def emit(self, signal, message, analysis_id):
         """Emit signal to main.
@@ -198,9 +281,51 @@ class Meta(object):
 
         """
 
-        log.debug('kernel {} zmq send ({}): {}'
-                  ''.format(analysis_id, signal, message))
-        self.zmq_publish.send(json.dumps({
-            'analysis_id': analysis_id,
-            'frame': {'signal': signal, 'load': message},
-        }, default=json_encoder_default).encode('utf-8'))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('kernel {} zmq send ({}): {}'
+                      ''.format(analysis_id, signal, message))
+        data = {'signal': signal}
+        if message != '__nomessagetoken__':
+            data['load'] = message
+        if getattr(message, 'revision', None) is not None:
+            data['revision'] = message.revision
+
+        # The frame is encoded for the frontend here and forwarded
+        # unchanged by the main process, which only reads the header.
+        # Array data is sent in ZMQ frames of its own without a copy.
+        parts, binary = utils.encode_frame_parts(
+            data, binary=self.analysis_class.binary_arrays, copy=False)
+        header = {'analysis_id': analysis_id, 'signal': signal}
+        if binary:
+            header['binary'] = True
+
+        if not self._outbox:
+            self._outbox_started = time.time()
+            zmq.eventloop.ioloop.IOLoop.current().add_callback(
+                self.flush_outbox)
+        self._outbox.append((header, parts))
+        if len(self._outbox) >= self.max_batch_size or \
+           time.time() - self._outbox_started > self.max_batch_delay:
+            self.flush_outbox()
+
+    def flush_outbox(self):
+        """Send the buffered messages to main.
+
+        Several messages are sent as one ZMQ message with a ``batch``
+        header that lists the routing headers and the number of frames of
+        each message. Their frames follow in order.
+        """
+        outbox, self._outbox = self._outbox, []
+        if not outbox:
+            return
+
+        if len(outbox) == 1:
+            header, frames = outbox[0]
+        else:
+            batch, frames = [], []
+            for header, parts in outbox:
+                batch.append(dict(header, frames=len(parts)))
+                frames += parts
+            header = {'batch': batch}
+        self.zmq_socket.send_multipart(
+            [utils.dumps(header).encode('utf-8')] + frames, copy=False)
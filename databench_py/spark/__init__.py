@@ -0,0 +1,6 @@
+"""Databench PySpark kernel module with a shared SparkContext."""
+# flake8: noqa
+
+__version__ = "0.1.0"
+
+from .meta import Meta
@@ -0,0 +1,83 @@
+"""Meta class for a Databench PySpark kernel with a shared SparkContext."""
+
+from ..multithread import meta as multithread
+import logging
+import pyspark
+
+log = logging.getLogger(__name__)
+
+
+class Meta(multithread.Meta):
+    """Class providing Meta information about analyses.
+
+    For PySpark kernels that host many analysis instances with one
+    SparkContext. Start the kernel multiplexed with ``kernel_processes: 1``
+    in ``index.yaml`` so that a single driver process serves all
+    connections and the JVM and SparkContext start only once.
+
+    Every analysis instance has the shared context as ``spark_context``.
+    Actions run on worker threads and the Spark jobs of an analysis
+    instance run in a fair scheduler pool and a job group named after its
+    analysis id, so that concurrent sessions share the executors. Running
+    jobs of an instance are cancelled when it disconnects. The
+    ``connect``, ``args``, ``connected`` and ``disconnected`` actions run
+    on the event loop of the kernel and should not start Spark jobs.
+
+    The master is taken from the configuration of ``spark-submit``, from
+    ``spark.master`` in ``spark_conf`` or is ``local[*]``.
+
+    Args:
+        name (str): Name of this analysis.
+        analysis_class (Analysis): Analysis class.
+        max_workers (int): Number of worker threads.
+        ordering (str): Ordering of actions, see
+            :class:`databench_py.multithread.Meta`.
+        spark_conf (dict): Additional Spark configuration.
+
+    """
+
+    def __init__(self, name, analysis_class, max_workers=4,
+                 ordering='action', spark_conf=None):
+        conf = pyspark.SparkConf()
+        for key, value in (spark_conf or {}).items():
+            conf.set(key, value)
+        conf.setIfMissing('spark.master', 'local[*]')
+        conf.setIfMissing('spark.app.name', 'databench {}'.format(name))
+        conf.set('spark.scheduler.mode', 'FAIR')
+        self.spark_context = pyspark.SparkContext.getOrCreate(conf)
+        log.info('SparkContext {} on {}'
+                 ''.format(self.spark_context.applicationId,
+                           self.spark_context.master))
+
+        super(Meta, self).__init__(name, analysis_class,
+                                   max_workers=max_workers,
+                                   ordering=ordering)
+
+    def assign(self, analysis_id):
+        """Create the analysis instance with the shared SparkContext."""
+        analysis = super(Meta, self).assign(analysis_id)
+        analysis.spark_context = self.spark_context
+        return analysis
+
+    def run_process(self, analysis, action_name, message='__nomessagetoken__'):
+        if action_name == 'disconnected':
+            self.spark_context.cancelJobGroup(analysis.id_)
+        return super(Meta, self).run_process(analysis, action_name, message)
+
+    def run_worker(self, analysis, action_name, message):
+        """Run an action on the current worker thread with its Spark jobs in
+        the pool and job group of the analysis instance.
+
+        Spark keeps these properties per thread and every action sets them
+        again before it runs.
+        """
+        self.spark_context.setLocalProperty('spark.scheduler.pool',
+                                            analysis.id_)
+        self.spark_context.setJobGroup(analysis.id_, action_name,
+                                       interruptOnCancel=True)
+        return super(Meta, self).run_worker(analysis, action_name, message)
+
+    def shutdown(self):
+        """Stop the SparkContext and shut down."""
+        super(Meta, self).shutdown()
+        self.spark_context.stop()
@@ -5,7 +5,7 @@ declare module 'websocket' {
 
     onopen(): void;
     onclose: (() => void) | null;
-    onmessage(event: {data: string}): void;
+    onmessage(event: {data: string | ArrayBuffer}): void;
 
     send(message: string): void;
     close(): void;
@@ -13,11 +13,150 @@ declare module 'websocket' {
     CONNECTING: string;
     OPEN: string;
     readyState: string;
+    binaryType: string;
   }
 }
 
 import { w3cwebsocket as WebSocket } from 'websocket';
 
+/** Signals that carry state updates. Their values are kept in [[Connection.state]]. */
+const STATE_SIGNALS = ['data', 'class_data'];
+
+/**
+ * Freeze a value and all the objects and arrays it contains.
+ *
+ * TypedArrays cannot be frozen and are returned as they are.
+ *
+ * @param  value     Value to freeze.
+ * @return           The frozen value.
+ */
+export function deepFreeze(value: any): any {
+  if (value === null || typeof value !== 'object' || Object.isFrozen(value)) return value;
+  if (ArrayBuffer.isView(value)) return value;
+  Object.keys(value).forEach(key => deepFreeze(value[key]));
+  return Object.freeze(value);
+}
+
+/** Modifiable shallow copy of an object, array or TypedArray. */
+function shallowCopy(node: any): any {
+  if (Array.isArray(node)) return node.slice();
+  if (ArrayBuffer.isView(node)) {
+    const array = new node.constructor(node);
+    array.shape = node.shape;
+    return array;
+  }
+  const copy: {[key: string]: any} = {};
+  Object.keys(node).forEach(key => { copy[key] = node[key]; });
+  return copy;
+}
+
+/** Apply one operation to copies of the containers along its path. */
+function applyOperation(node: any, tokens: string[],
+                        operation: {op: string, path: string, value?: any}): any {
+  const copy = shallowCopy(node);
+  const token = tokens[0];
+  if (tokens.length > 1) {
+    copy[token] = applyOperation(node[token], tokens.slice(1), operation);
+  } else if (Array.isArray(copy)) {
+    const index = token === '-' ? copy.length : parseInt(token, 10);
+    if (operation.op === 'add') copy.splice(index, 0, deepFreeze(operation.value));
+    else if (operation.op === 'remove') copy.splice(index, 1);
+    else copy[index] = deepFreeze(operation.value);
+  } else if (operation.op === 'remove') {
+    delete copy[token];
+  } else {
+    copy[token] = deepFreeze(operation.value);
+  }
+  return ArrayBuffer.isView(copy) ? copy : Object.freeze(copy);
+}
+
+/**
+ * Apply a JSON patch (RFC 6902) to a document.
+ *
+ * Supports the `add`, `remove` and `replace` operations. The document is
+ * not modified: the objects and arrays along the patched paths are copied
+ * and the other parts are shared with the document. The copies and the
+ * patched values are frozen (see [[deepFreeze]]).
+ *
+ * @param  doc       Document to patch.
+ * @param  patch     List of operations.
+ * @return           The patched document.
+ */
+export function applyPatch(doc: any, patch: {op: string, path: string, value?: any}[]): any {
+  patch.forEach(operation => {
+    if (operation.path === '') {
+      doc = deepFreeze(operation.value);
+      return;
+    }
+
+    const tokens = operation.path.substring(1).split('/').map(
+      token => token.replace(/~1/g, '/').replace(/~0/g, '~'));
+    doc = applyOperation(doc, tokens, operation);
+  });
+  return doc;
+}
+
+/** TypedArray constructors for the dtypes of binary numpy arrays. */
+const TYPED_ARRAYS: {[dtype: string]: any} = {
+  int8: Int8Array,
+  uint8: Uint8Array,
+  int16: Int16Array,
+  uint16: Uint16Array,
+  int32: Int32Array,
+  uint32: Uint32Array,
+  float32: Float32Array,
+  float64: Float64Array,
+  bool: Uint8Array,
+};
+
+// not in the DOM type definitions of all supported TypeScript versions
+declare const TextDecoder: any;
+
+function decodeUTF8(bytes: Uint8Array): string {
+  if (typeof TextDecoder !== 'undefined') return new TextDecoder('utf-8').decode(bytes);
+
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+  }
+  return decodeURIComponent(escape(binary));
+}
+
+/**
+ * Decode a binary frame with numpy arrays.
+ *
+ * The frame starts with the length of a JSON header as a little-endian uint32
+ * followed by the header `{buffers: {id: [offset, length]}, message}` and the
+ * binary data. Buffer offsets are relative to the end of the header rounded
+ * up to a multiple of eight bytes. Placeholders of the form
+ * `{__ndarray: id, dtype, shape}` in the message are replaced by TypedArrays
+ * with a `shape` attribute that are views into the frame.
+ *
+ * @param  frame     Binary frame.
+ * @return           Decoded message.
+ */
+export function decodeFrame(frame: ArrayBuffer): any {
+  const headerLength = new DataView(frame).getUint32(0, true);
+  const header = JSON.parse(decodeUTF8(new Uint8Array(frame, 4, headerLength)));
+  const start = Math.ceil((4 + headerLength) / 8) * 8;
+
+  const restore = (node: any): any => {
+    if (node === null || typeof node !== 'object') return node;
+    if (Array.isArray(node)) return node.map(restore);
+    if (typeof node.__ndarray === 'string' && node.__ndarray in header.buffers) {
+      const [offset, length] = header.buffers[node.__ndarray];
+      const TypedArray = TYPED_ARRAYS[node.dtype];
+      const array = new TypedArray(frame, start + offset,
+                                   length / TypedArray.BYTES_PER_ELEMENT);
+      array.shape = node.shape;
+      return array;
+    }
+    Object.keys(node).forEach(key => { node[key] = restore(node[key]); });
+    return node;
+  };
+  return restore(header.message);
+}
+
 /**
  * Connection to the backend.
  *
@@ -50,6 +189,14 @@ export class Connection {
   databenchBackendVersion?: string;
   analysesVersion?: string;
 
+  /**
+   * Local copy of the state values received for `data` and `class_data`.
+   * The values are frozen.
+   */
+  state: {[signal: string]: {[key: string]: any}};
+  /** Latest revision of the state received for `data` and `class_data`. */
+  revisions: {[signal: string]: number};
+
   errorCB: (message?: string) => void;
   private onCallbacks: {[field: string]: ((message: any, signal?: string) => void)[]};
   private onProcessCallbacks: {[field: string]: ((status: any) => void)[]};
@@ -74,6 +221,9 @@ export class Connection {
     this.requestArgs = (!requestArgs && (typeof window !== 'undefined')) ?
                         window.location.search : requestArgs;
     this.analysisId = analysisId;
+    this.state = {};
+    this.revisions = {};
+    STATE_SIGNALS.forEach(signal => { this.state[signal] = {}; });
 
     this.errorCB = msg => (msg != null ? console.log(`connection error: ${msg}`) : null);
     this.onCallbacks = {};
@@ -107,6 +257,7 @@ export class Connection {
     this.connectCallback = callback ? callback : () => this;
 
     this.socket = new WebSocket(this.wsUrl);
+    this.socket.binaryType = 'arraybuffer';
     this.socketCheckOpen = setInterval(this.wsCheckOpen.bind(this), 2000);
     this.socket.onopen = this.wsOnOpen.bind(this);
     this.socket.onclose = this.wsOnClose.bind(this);
@@ -156,6 +307,8 @@ export class Connection {
     this.socket.send(JSON.stringify({
       __connect: this.analysisId ? this.analysisId : null,
       __request_args: this.requestArgs,  // eslint-disable-line camelcase
+      // on reconnect, only request the state changes that were missed
+      __revisions: this.analysisId ? this.revisions : null,
     }));
   }
 
@@ -193,8 +346,9 @@ export class Connection {
     this.onCallbacks[signal].forEach(cb => cb(message, signal));
   }
 
-  wsOnMessage(event: {data: string}) {
-    const message = JSON.parse(event.data);
+  wsOnMessage(event: {data: string | ArrayBuffer}) {
+    const message = typeof event.data === 'string' ?
+                    JSON.parse(event.data) : decodeFrame(event.data);
 
     // connect response
     if (message.signal === '__connect') {
@@ -216,12 +370,83 @@ export class Connection {
       this.onProcessCallbacks[id].forEach(cb => cb(status));
     }
 
+    // initial state: replace the local copy
+    if (message.signal === '__snapshot') {
+      this.applySnapshot(message.load, message.revision);
+    }
+
+    // state updates: apply patches and keep a local copy
+    if (STATE_SIGNALS.indexOf(message.signal) !== -1) {
+      this.updateState(message.signal, message.load);
+      if (message.revision != null) this.revisions[message.signal] = message.revision;
+    }
+
     // normal message
     if (message.signal in this.onCallbacks) {
       this.trigger(message.signal, message.load);
     }
   }
 
+  /**
+   * Replace the local state with a snapshot of the complete state.
+   *
+   * Callbacks for the state signals are triggered with the new values.
+   *
+   * @param load       Map of state signals to their complete state.
+   * @param revisions  Map of state signals to the revision of their state.
+   */
+  applySnapshot(load: {[signal: string]: {[key: string]: any}},
+                revisions: {[signal: string]: number}) {
+    Object.keys(load).forEach(signal => {
+      this.state[signal] = {};
+      this.updateState(signal, load[signal]);
+      if (revisions && revisions[signal] != null) this.revisions[signal] = revisions[signal];
+      if (signal in this.onCallbacks && Object.keys(load[signal]).length) {
+        this.trigger(signal, load[signal]);
+      }
+    });
+  }
+
+  /**
+   * Update the local state with new values or patches.
+   *
+   * Values of the form `{__patch: [operations]}` are applied to the local
+   * copy and replaced by the patched value in `load`. A patch for a key
+   * without a local value is removed from `load` and the complete state is
+   * requested from the backend.
+   *
+   * State values are frozen (see [[deepFreeze]]), so values that were passed
+   * to callbacks before do not change. Copy a value to modify it.
+   *
+   * @param signal  Name of the state signal.
+   * @param load    Map of keys to values or patches.
+   */
+  updateState(signal: string, load: {[key: string]: any}) {
+    const state = this.state[signal];
+    let resync = false;
+    Object.keys(load).forEach(key => {
+      const value = load[key];
+      if (value !== null && typeof value === 'object' && '__patch' in value) {
+        if (state[key] === undefined) {
+          delete load[key];
+          resync = true;
+          return;
+        }
+        load[key] = applyPatch(state[key], value.__patch);
+      } else {
+        deepFreeze(value);
+      }
+      state[key] = load[key];
+    });
+    if (resync) this.requestSnapshot();
+  }
+
+  /** Request the complete state from the backend as a `__snapshot`. */
+  requestSnapshot() {
+    if (!this.socket || this.socket.readyState !== this.socket.OPEN) return;
+    this.socket.send(JSON.stringify({__resync: true}));
+  }
+
   /**
    * Register a callback that listens for a signal.
    *
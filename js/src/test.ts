@@ -9,6 +9,199 @@ import * as https from 'https';
 import * as request from 'request';
 
 
+/** Binary frame in the layout of `databench.utils.pack_frame`. */
+function packFrame(message: any, buffers: {[id: string]: Uint8Array}): ArrayBuffer {
+  const ids = Object.keys(buffers);
+  const offsets: {[id: string]: number[]} = {};
+  let offset = 0;
+  ids.forEach(id => {
+    offsets[id] = [offset, buffers[id].length];
+    offset += Math.ceil(buffers[id].length / 8) * 8;
+  });
+  const header = JSON.stringify({buffers: offsets, message});
+  const start = Math.ceil((4 + header.length) / 8) * 8;
+
+  const frame = new ArrayBuffer(start + offset);
+  new DataView(frame).setUint32(0, header.length, true);
+  const bytes = new Uint8Array(frame);
+  for (let i = 0; i < header.length; i++) bytes[4 + i] = header.charCodeAt(i);
+  ids.forEach(id => bytes.set(buffers[id], start + offsets[id][0]));
+  return frame;
+}
+
+/** Connection with a fake open socket that records the sent messages. */
+function fakeConnection(analysisId?: string): {c: Databench.Connection, sent: any[]} {
+  const c = new Databench.Connection('ws://localhost:5000/ws', '', analysisId);
+  const sent: any[] = [];
+  (c as any).socket = {OPEN: 1, readyState: 1, send: (msg: string) => sent.push(JSON.parse(msg))};
+  return {c, sent};
+}
+
+describe('Client State', () => {
+  describe('applyPatch', () => {
+    it('adds, removes and replaces object keys', () => {
+      const doc = {light: 'red', sound: 'on'};
+      expect(Databench.applyPatch(doc, [
+        {op: 'add', path: '/size', value: 3},
+        {op: 'remove', path: '/sound'},
+        {op: 'replace', path: '/light', value: 'green'},
+      ])).to.deep.equal({light: 'green', size: 3});
+    });
+
+    it('adds, removes and replaces array elements', () => {
+      const doc = {samples: [1, 2, 3]};
+      expect(Databench.applyPatch(doc, [
+        {op: 'add', path: '/samples/1', value: 9},
+        {op: 'remove', path: '/samples/0'},
+        {op: 'replace', path: '/samples/2', value: 4},
+        {op: 'add', path: '/samples/-', value: 5},
+      ])).to.deep.equal({samples: [9, 2, 4, 5]});
+    });
+
+    it('replaces the whole document', () => {
+      expect(Databench.applyPatch([1, 2], [{op: 'replace', path: '', value: {a: 1}}]))
+        .to.deep.equal({a: 1});
+    });
+
+    it('unescapes path tokens', () => {
+      expect(Databench.applyPatch({'a/b': 1, 'c~d': 2}, [
+        {op: 'replace', path: '/a~1b', value: 3},
+        {op: 'remove', path: '/c~0d'},
+      ])).to.deep.equal({'a/b': 3});
+    });
+
+    it('does not modify the document', () => {
+      const doc = {samples: [1, 2], meta: {name: 'a'}, other: {x: 1}};
+      const patched = Databench.applyPatch(doc, [
+        {op: 'add', path: '/samples/2', value: 3},
+        {op: 'replace', path: '/meta/name', value: 'b'},
+      ]);
+      expect(doc).to.deep.equal({samples: [1, 2], meta: {name: 'a'}, other: {x: 1}});
+      expect(patched.other).to.equal(doc.other);
+      expect(Object.isFrozen(patched)).to.equal(true);
+      expect(Object.isFrozen(patched.samples)).to.equal(true);
+    });
+
+    it('applies patches from the Python backend', () => {
+      // databench.datastore.json_patch(before, after)
+      const before = {samples: [1, 2, 3, 4], meta: {name: 'a/b', tags: ['x'], old: true}, n: 1};
+      const after = {samples: [1, 5, 3], meta: {name: 'c', tags: ['x', 'y', 'z']}, n: 1, new: {k: null}};
+      const patch = [
+        {op: 'replace', path: '/samples/1', value: 5},
+        {op: 'remove', path: '/samples/3'},
+        {op: 'remove', path: '/meta/old'},
+        {op: 'replace', path: '/meta/name', value: 'c'},
+        {op: 'add', path: '/meta/tags/1', value: 'y'},
+        {op: 'add', path: '/meta/tags/2', value: 'z'},
+        {op: 'add', path: '/new', value: {k: null}},
+      ];
+      expect(Databench.applyPatch(before, patch)).to.deep.equal(after);
+    });
+  });
+
+  describe('decodeFrame', () => {
+    it('decodes arrays with an eight byte aligned offset', () => {
+      const frame = packFrame({signal: 'data', load: {
+        xs: {__ndarray: 'b0', dtype: 'float32', shape: [2]},
+        ys: {__ndarray: 'b1', dtype: 'int16', shape: [2, 2]},
+        flags: {__ndarray: 'b2', dtype: 'bool', shape: [3]},
+      }}, {
+        b0: new Uint8Array(new Float32Array([1.5, 2.5]).buffer),
+        b1: new Uint8Array([1, 0, 254, 255, 3, 0, 4, 0]),
+        b2: new Uint8Array([1, 0, 1]),
+      });
+      const message = Databench.decodeFrame(frame);
+      expect(message.signal).to.equal('data');
+
+      const {xs, ys, flags} = message.load;
+      expect(xs).to.be.instanceof(Float32Array);
+      expect(Array.prototype.slice.call(xs)).to.deep.equal([1.5, 2.5]);
+      expect(xs.byteOffset % 8).to.equal(0);
+      expect(ys).to.be.instanceof(Int16Array);
+      expect(Array.prototype.slice.call(ys)).to.deep.equal([1, -2, 3, 4]);
+      expect(ys.shape).to.deep.equal([2, 2]);
+      expect(ys.byteOffset % 8).to.equal(0);
+      expect(flags).to.be.instanceof(Uint8Array);
+      expect(Array.prototype.slice.call(flags)).to.deep.equal([1, 0, 1]);
+    });
+
+    it('decodes a frame from the Python backend', () => {
+      // databench.utils.encode_frame({'a': np.array([1, -2], dtype='>i2')},
+      //                              binary=True): big-endian arrays are
+      // sent as little-endian data
+      const header = '{"buffers": {"b0": [0, 4]}, "message": ' +
+                     '{"a": {"__ndarray": "b0", "dtype": "int16", "shape": [2]}}}';
+      const bytes = new Uint8Array(Math.ceil((4 + header.length) / 8) * 8 + 8);
+      bytes.set([header.length, 0, 0, 0]);
+      for (let i = 0; i < header.length; i++) bytes[4 + i] = header.charCodeAt(i);
+      bytes.set([1, 0, 254, 255], bytes.length - 8);
+
+      const a = Databench.decodeFrame(bytes.buffer).a;
+      expect(a).to.be.instanceof(Int16Array);
+      expect(Array.prototype.slice.call(a)).to.deep.equal([1, -2]);
+    });
+  });
+
+  describe('Connection state', () => {
+    it('applies a snapshot', () => {
+      const {c} = fakeConnection();
+      c.state.data = {old: 1};
+      const received: any[] = [];
+      c.on('data', message => received.push(message));
+      c.wsOnMessage({data: JSON.stringify({
+        signal: '__snapshot',
+        load: {data: {light: 'red'}, class_data: {}},
+        revision: {data: 3, class_data: 1},
+      })});
+      expect(c.state).to.deep.equal({data: {light: 'red'}, class_data: {}});
+      expect(c.revisions).to.deep.equal({data: 3, class_data: 1});
+      expect(received).to.deep.equal([{light: 'red'}]);
+    });
+
+    it('applies patches to the state', () => {
+      const {c, sent} = fakeConnection();
+      const received: any[] = [];
+      c.on('data', message => received.push(message.samples));
+      c.wsOnMessage({data: JSON.stringify(
+        {signal: 'data', load: {samples: [1, 2]}, revision: 1})});
+      c.wsOnMessage({data: JSON.stringify({signal: 'data', load: {
+        samples: {__patch: [{op: 'add', path: '/2', value: 3}]},
+      }, revision: 2})});
+      expect(received).to.deep.equal([[1, 2], [1, 2, 3]]);
+      expect(Object.isFrozen(received[0])).to.equal(true);
+      expect(c.state.data.samples).to.deep.equal([1, 2, 3]);
+      expect(c.revisions.data).to.equal(2);
+      expect(sent).to.deep.equal([]);
+    });
+
+    it('requests a snapshot for a patch without a local value', () => {
+      const {c, sent} = fakeConnection();
+      c.wsOnMessage({data: JSON.stringify({signal: 'data', load: {
+        samples: {__patch: [{op: 'add', path: '/2', value: 3}]},
+      }})});
+      expect(c.state.data).to.deep.equal({});
+      expect(sent).to.deep.equal([{__resync: true}]);
+    });
+
+    it('sends the revisions on reconnect', () => {
+      const {c, sent} = fakeConnection('abcd1234');
+      c.wsOnMessage({data: JSON.stringify(
+        {signal: 'class_data', load: {runs: 1}, revision: 5})});
+      c.wsOnOpen();
+      expect(sent[0].__connect).to.equal('abcd1234');
+      expect(sent[0].__revisions).to.deep.equal({class_data: 5});
+    });
+
+    it('does not send revisions for a new analysis', () => {
+      const {c, sent} = fakeConnection();
+      c.wsOnOpen();
+      expect(sent[0].__connect).to.equal(null);
+      expect(sent[0].__revisions).to.equal(null);
+    });
+  });
+});
+
+
 describe('Standalone Process', () => {
   let databench_process_return_code = -42;
   const databench_process = child_process.spawn('python', [
@@ -12,8 +12,10 @@ setup(
     version=VERSION,
     packages=['databench', 'databench.analyses_packaged',
               'databench_py', 'databench_py.singlethread',
+              'databench_py.multithread', 'databench_py.spark',
               'databench.tests',
-              'databench.tests.analyses', 'databench.tests.analyses_broken'],
+              'databench.tests.analyses', 'databench.tests.analyses_broken',
+              'databench.tests.analyses_spark'],
     license='MIT',
     description='Realtime data analysis tool.',
     long_description=open('README.rst').read(),
@@ -26,6 +28,7 @@ setup(
     install_requires=[
         'docutils>=0.12',
         'future>=0.15',
+        'futures>=3.1; python_version < "3"',
         'markdown>=2.6.5',
         'pyyaml>=3.11',
         'pyzmq>=4.3.1',
@@ -50,6 +53,15 @@ setup(
             'requests>=2.9.1',
             'websocket-client>=0.35.0',
         ],
+        'spark': [
+            'pyspark>=2.2',
+        ],
+        'orjson': [
+            'orjson>=3.0; python_version >= "3.6"',
+        ],
+        'ujson': [
+            'ujson>=1.35',
+        ],
     },
 
     tests_require=[